@@ -21,20 +21,21 @@ def open(conf_file = None, source = None, target = None):
 
   source_conn = None
   if config.has_section(source):
-    conn_mod = importlib.import_module('%s.%s' % ('datasync.connector', source))
+    source_mod = importlib.import_module('%s.%s' % ('datasync.connector', source))
     _log.debug('Creating database connection from %s', conf_file)
-    source_conn = conn_mod.open(conf_file)
+    source_conn = source_mod.open(conf_file)
   else:
     raise AttributeError('No supported connection type found in %s for %s' % (conf_file, source))
 
   target_conn = None
   if config.has_section(target):
-    conn_mod = importlib.import_module('%s.%s' % ('datasync.connector', target))
+    target_mod = importlib.import_module('%s.%s' % ('datasync.connector', target))
     _log.debug('Creating database connection from %s', conf_file)
-    target_conn = conn_mod.open(conf_file)
+    target_conn = target_mod.open(conf_file)
   else:
     raise AttributeError('No supported connection type found in %s for %s' % (conf_file, target))
 
   ds.set_source(source_conn)
   ds.set_target(target_conn)
+  ds.set_connection_factories(lambda: source_mod.open(conf_file), lambda: target_mod.open(conf_file))
   return ds
@@ -0,0 +1,240 @@
+'''Benchmark the sync stages against a local ISPyB database and a synthetic source.
+
+Usage: python -m datasync.benchmark -c <configuration file> [options]
+
+The [ispyb] section of the configuration file must point at a scratch MariaDB or
+MySQL database: with -L it is dropped and re-created from conf/schema.sql using
+the mysql command line client. The source is a SynthUASConnector sized by the
+[synthuas] section (or its defaults) times the -s scale.
+
+Each stage runs in a child process of its own, so that the peak RSS reported is
+that of the stage alone. For generation 0 the stages insert the whole data set;
+each later generation changes change_fraction of it and syncs again. The results
+are printed as a table and written as JSON to the -o file.'''
+from __future__ import print_function
+import getopt
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+try:
+  import configparser
+except ImportError:
+  import ConfigParser as configparser
+try:
+  from queue import Empty
+except ImportError:
+  from Queue import Empty
+import datasync
+from datasync.main import SYNC_STAGES
+from datasync.instrument import QueryStats
+
+SCHEMA_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'conf', 'schema.sql'))
+
+_SIZES = ('persons', 'proposals', 'sessions')
+
+# Seconds between checks that a stage's child process is still alive
+_POLL_INTERVAL = 5
+
+def load_schema(conf_file, schema_file=SCHEMA_FILE):
+  '''Drop and re-create the [ispyb] database and load schema_file into it.'''
+  config = configparser.RawConfigParser(allow_no_value=True)
+  if not config.read(conf_file):
+    raise AttributeError('No configuration found at %s' % conf_file)
+  db = config.get('ispyb', 'db')
+  args = ['mysql', '--user=%s' % config.get('ispyb', 'user')]
+  if config.has_option('ispyb', 'pw') and config.get('ispyb', 'pw'):
+    args.append('--password=%s' % config.get('ispyb', 'pw'))
+  if config.has_option('ispyb', 'unix_socket') and config.get('ispyb', 'unix_socket'):
+    args.append('--socket=%s' % config.get('ispyb', 'unix_socket'))
+  else:
+    args += ['--host=%s' % config.get('ispyb', 'host'), '--port=%s' % config.get('ispyb', 'port')]
+  subprocess.check_call(args + ['-e', 'DROP DATABASE IF EXISTS `%s`; CREATE DATABASE `%s`' % (db, db)])
+  with open(schema_file) as f:
+    subprocess.check_call(args + [db], stdin=f)
+
+def source_settings(conf_file, scale):
+  '''The SynthUASConnector settings from the configuration file, sizes multiplied by scale.'''
+  from datasync.connector.synthuas import SynthUASConnector
+  config = configparser.RawConfigParser(allow_no_value=True)
+  config.read(conf_file)
+  settings = {}
+  if config.has_section('synthuas'):
+    settings = dict((k, v) for (k, v) in config.items('synthuas') if v is not None and v != '')
+  defaults = SynthUASConnector()
+  for size in _SIZES:
+    settings[size] = max(1, int(int(settings.get(size, getattr(defaults, 'n_' + size))) * scale))
+  return settings
+
+class _Counts:
+  def __init__(self):
+    self.rows = 0
+
+def _count_rows(conn, counts):
+  '''Count the rows returned by the extract_* and iterate_* methods of a source.'''
+  def wrap(method):
+    def counted(*args, **kwargs):
+        rs = method(*args, **kwargs)
+        if isinstance(rs, list):
+            counts.rows += len(rs)
+            return rs
+        return _counted_iter(rs)
+    return counted
+  def _counted_iter(rs):
+    for row in rs:
+        counts.rows += 1
+        yield row
+  for name in dir(conn):
+    if name.startswith('extract_') or name.startswith('iterate_'):
+        setattr(conn, name, wrap(getattr(conn, name)))
+
+def _round_trips(result):
+  '''Round trips taken by a QueryStats entry: mysql.connector sends an executemany of
+  an INSERT as one multi-row statement, other statements take one per execution.'''
+  if result['statement'].upper().startswith('INSERT'):
+    return result['count']
+  return result['executions']
+
+def _run_stage(conf_file, stage, settings, generation, mode, target_mode, results):
+  '''Child process: run one stage and put its measurements on the results queue.'''
+  from datasync.connector.synthuas import SynthUASConnector
+  # DataSync parses the command line, so only give it the options it knows
+  sys.argv[1:] = ['-c', conf_file, '-m', mode, '-t', target_mode]
+  try:
+    with datasync.open(conf_file=conf_file, source='dummyuas', target='ispyb') as ds:
+        counts = _Counts()
+        stats = QueryStats()
+        source = SynthUASConnector(generation=generation, **settings)
+        _count_rows(source, counts)
+        ds.set_source(source)
+        ds.set_query_stats(stats)
+        start = time.time()
+        ds.run_stage(stage)
+        wall_time = time.time() - start
+        queries = stats.results()
+  except Exception as e:
+    results.put({'stage': stage, 'generation': generation, 'error': repr(e)})
+    return
+  results.put({'stage': stage,
+               'generation': generation,
+               'rows': counts.rows,
+               'statements': sum(q['executions'] for q in queries),
+               'round_trips': sum(_round_trips(q) for q in queries),
+               'wall_time': wall_time,
+               'rows_per_s': counts.rows / wall_time if wall_time > 0 else None,
+               'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               'queries': queries})
+
+def run(conf_file, settings, generations=1, mode='hash', target_mode='rows', stages=None):
+  '''Run the stages for generations 0 to generations, each stage in its own process,
+  and return the list of their results.'''
+  if stages is None:
+    stages = [name for (name, deps) in SYNC_STAGES]
+  results = []
+  for generation in range(generations + 1):
+    for stage in stages:
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_run_stage, args=(conf_file, stage, settings, generation, mode, target_mode, queue))
+        child.start()
+        result = _wait_result(child, queue)
+        child.join()
+        if result is None:
+            result = {'stage': stage, 'generation': generation, 'error': 'child process exited with code %s' % child.exitcode}
+        results.append(result)
+        print_result(result)
+  return results
+
+def _wait_result(child, queue, poll_interval=_POLL_INTERVAL):
+  '''Return the result the child puts on queue, or None if it exits without one.'''
+  while True:
+    try:
+        return queue.get(timeout=poll_interval)
+    except Empty:
+        if not child.is_alive():
+            break
+  # it may have put its result just before exiting
+  try:
+    return queue.get(timeout=1)
+  except Empty:
+    return None
+
+def print_result(result):
+  if 'error' in result:
+    print('%-24s %3d  failed: %s' % (result['stage'], result['generation'], result['error']))
+  else:
+    print('%-24s %3d %10d %10.0f %10d %10d %9.2f %10d' % (result['stage'], result['generation'], result['rows'],
+          result['rows_per_s'] or 0, result['statements'], result['round_trips'], result['wall_time'],
+          result['peak_rss_kb']))
+  sys.stdout.flush()
+
+def main():
+  def print_usage():
+    print("""Syntax: %s -c <configuration file> [-L] [-o <results file>] [-s <scale>] [-g <generations>] [-m <hash|merge|range>] [-t <rows|staged>]
+        Arguments:
+             -h|--help : display this help
+             -c|--conf <conf file> : use the given configuration file
+             -L|--load-schema : drop the [ispyb] database and load conf/schema.sql into it first
+             -o|--output <file> : write the results as JSON to the given file (default benchmark-<version>.json)
+             -s|--scale <scale> : multiply the [synthuas] sizes by this (default 0.1)
+             -g|--generations <n> : number of changed generations to sync after the initial one (default 1)
+             -m|--mode <hash|merge|range>: how persons and sessions are reconciled
+             -t|--target-mode <rows|staged>: how the changes are applied to ISPyB""" % sys.argv[0])
+
+  try:
+    opts, args = getopt.gnu_getopt(sys.argv[1:], "hc:Lo:s:g:m:t:", ["help", "conf=", "load-schema", "output=", "scale=", "generations=", "mode=", "target-mode="])
+  except getopt.GetoptError:
+    print_usage()
+    sys.exit(2)
+
+  conf_file = None
+  load = False
+  output = 'benchmark-%s.json' % datasync.__version__
+  scale = 0.1
+  generations = 1
+  mode = 'hash'
+  target_mode = 'rows'
+  for o, a in opts:
+    if o in ("-h", "--help"):
+        print_usage()
+        sys.exit()
+    elif o in ("-c", "--conf"):
+        conf_file = a
+    elif o in ("-L", "--load-schema"):
+        load = True
+    elif o in ("-o", "--output"):
+        output = a
+    elif o in ("-s", "--scale"):
+        scale = float(a)
+    elif o in ("-g", "--generations"):
+        generations = int(a)
+    elif o in ("-m", "--mode"):
+        mode = a
+    elif o in ("-t", "--target-mode"):
+        target_mode = a
+  if conf_file is None:
+    print_usage()
+    sys.exit(2)
+
+  if load:
+    load_schema(conf_file)
+  settings = source_settings(conf_file, scale)
+  print('%-24s %3s %10s %10s %10s %10s %9s %10s' % ('stage', 'gen', 'rows', 'rows/s', 'statements', 'round trips', 'seconds', 'peak KB'))
+  results = run(conf_file, settings, generations, mode, target_mode)
+  with open(output, 'w') as f:
+    json.dump({'version': datasync.__version__,
+               'python': platform.python_version(),
+               'host': platform.node(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'mode': mode,
+               'target_mode': target_mode,
+               'source': settings,
+               'results': results}, f, indent=2, sort_keys=True)
+  if any('error' in result for result in results):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
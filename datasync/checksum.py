@@ -0,0 +1,55 @@
+'''Range checksums, used by the 'range' reconcile mode to find the key ranges in
+which the source and the target differ without reading their rows.
+
+Rows are grouped on the first prefix_length hex digits of their GUID / externalId.
+Each range is summarised as (number of rows, sum of the row checksums), the row
+checksum being the first 32 bits of the MD5 of the compared columns joined with
+chr(31), NULLs as empty strings and dates as 'YYYY-MM-DD HH:MM:SS'. Databases
+compute these in SQL (see checksum_persons and checksum_sessions in the
+connectors); the functions here do the same for sources that aren't databases.'''
+import hashlib
+
+SEPARATOR = u'\x1f'
+
+def text_checksum(text):
+  return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+
+def range_checksums(rows, key, text, prefix_length):
+  '''Return [(prefix, count, sum of checksums)] for rows, each row's range being the
+  prefix of key(row) and its checksum that of text(row). Rows whose text is None
+  are left out.'''
+  sums = {}
+  for row in rows:
+    t = text(row)
+    if t is None:
+        continue
+    prefix = key(row)[:prefix_length]
+    (count, total) = sums.get(prefix, (0, 0))
+    sums[prefix] = (count + 1, total + text_checksum(t))
+  return [(prefix, count, total) for (prefix, (count, total)) in sorted(sums.items())]
+
+def differing_ranges(source_sums, target_sums):
+  '''The sorted prefixes whose (count, sum) differ between the two lists of
+  (prefix, count, sum), including those on one side only.'''
+  source = dict((prefix, (int(count), int(total))) for (prefix, count, total) in source_sums)
+  target = dict((prefix, (int(count), int(total))) for (prefix, count, total) in target_sums)
+  return sorted([prefix for prefix in set(source) | set(target) if source.get(prefix) != target.get(prefix)])
+
+def _text(value):
+  if value is None:
+    return u''
+  if isinstance(value, bytes) and not isinstance(value, type(u'')):
+    return value.decode('utf-8')
+  return u'%s' % (value,)
+
+def person_text(uas_row):
+  '''The checksummed text of a UAS person row: GUID, login, title, given and family names.'''
+  return SEPARATOR.join([_text(v) for v in uas_row[0:5]])
+
+def session_text(uas_row):
+  '''The checksummed text of a UAS session row: GUID, visit, beamline, start and end,
+  beamline operators and whether scheduled. Cancelled sessions aren't checksummed.'''
+  if uas_row[6] == 'Cancelled':
+    return None
+  return SEPARATOR.join([_text(v) for v in (uas_row[0], uas_row[1], uas_row[2], uas_row[4], uas_row[5], uas_row[7])] +
+                        [u'0' if uas_row[6] == 'Queued' else u'1'])
@@ -1,4 +1,11 @@
 class DBSource:
+    # Object with a record(querystr, seconds, rows, affected, executions) method called
+    # for each statement run, e.g. a datasync.instrument.QueryStats
+    instrument = None
+
+    def set_instrument(self, instrument):
+        self.instrument = instrument
+
     def extract_proposals_have_persons(self):
         raise NotImplementedError
 
@@ -8,14 +15,39 @@ class DBSource:
     def extract_session_types(self):
         raise NotImplementedError
 
-    def extract_proposals(self):
+    def retrieve_watermark(self):
+        '''Return the source's current change mark, to pass as since to extract_* in a
+        later run, or None if the source can't extract incrementally.'''
+        raise NotImplementedError
+
+    def extract_proposals(self, since=None):
         raise NotImplementedError
 
-    def extract_sessions(self):
+    def extract_sessions(self, since=None, prefixes=None):
+        '''prefixes restricts the rows to those whose GUID starts with one of them.'''
         raise NotImplementedError
 
     def extract_components(self):
         raise NotImplementedError
 
+    def extract_persons(self, since=None, prefixes=None):
+        raise NotImplementedError
+
+    def checksum_sessions(self, prefix_length):
+        '''Return [(GUID prefix, number of rows, sum of row checksums)] for the sessions
+        that aren't cancelled, see datasync.checksum.'''
+        raise NotImplementedError
+
+    def checksum_persons(self, prefix_length):
+        raise NotImplementedError
+
+    def iterate_sessions(self):
+        '''Like extract_sessions, but a row iterator sorted on the session externalId.'''
+        raise NotImplementedError
+
+    def iterate_persons(self):
+        '''Like extract_persons, but a row iterator sorted on the person externalId.'''
+        raise NotImplementedError
+
     def retrieve_persons_for_session(self, id):
         raise NotImplementedError
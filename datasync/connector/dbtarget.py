@@ -1,4 +1,27 @@
 class DBTarget:
+    # Object with a record(querystr, seconds, rows, affected, executions) method called
+    # for each statement run, e.g. a datasync.instrument.QueryStats
+    instrument = None
+
+    def set_instrument(self, instrument):
+        self.instrument = instrument
+
+    def flush(self):
+        '''Send any writes the target has buffered.'''
+        pass
+
+    def begin_stage(self):
+        '''Called at the start of each stage: forget what other connections may have changed since.'''
+        pass
+
+    def commit(self):
+        '''Make the writes so far permanent, called at the end of each stage.'''
+        self.flush()
+
+    def rollback(self):
+        '''Undo what can be undone of the writes since the last commit, when a stage fails.'''
+        pass
+
     def extract_proposals_have_persons(self):
         raise NotImplementedError
 
@@ -11,12 +34,59 @@ class DBTarget:
     def extract_proposals(self):
         raise NotImplementedError
 
-    def extract_sessions(self):
+    def extract_sessions(self, prefixes=None, visits=None):
+        '''prefixes restricts the rows to those whose externalId starts with one of
+        them, or has none, or whose visit is one of visits.'''
         raise NotImplementedError
 
     def extract_components(self):
         raise NotImplementedError
 
+    def extract_persons(self, prefixes=None, logins=None):
+        '''As extract_sessions, with logins (compared in lower case) for visits.'''
+        raise NotImplementedError
+
+    def checksum_sessions(self, prefix_length):
+        '''Return [(externalId prefix, number of rows, sum of row checksums)] for the
+        sessions with an externalId, see datasync.checksum.'''
+        raise NotImplementedError
+
+    def checksum_persons(self, prefix_length):
+        raise NotImplementedError
+
+    def iterate_sessions(self):
+        '''Like extract_sessions, but a row iterator sorted on the session externalId.'''
+        raise NotImplementedError
+
+    def iterate_persons(self):
+        '''Like extract_persons, but a row iterator sorted on the person externalId.'''
+        raise NotImplementedError
+
+    def merge_proposals(self, uas_rs):
+        '''Apply the source rows in uas_rs (as returned by the source's extract_proposals)
+        to the target in bulk, for the 'staged' target mode. Returns the numbers of rows
+        (inserted, updated, deleted), and the list of the GUIDs of the source rows that
+        were neither matched with a target row nor inserted.'''
+        raise NotImplementedError
+
+    def merge_sessions(self, uas_rs, persons_for_session=None):
+        '''persons_for_session(guid), if given, returns the persons of a source session as
+        the source's retrieve_persons_for_session does: they are added to the new sessions
+        as insert_session adds them.'''
+        raise NotImplementedError
+
+    def merge_session_types(self, uas_rs):
+        raise NotImplementedError
+
+    def merge_persons(self, uas_rs):
+        raise NotImplementedError
+
+    def merge_proposals_have_persons(self, uas_rs):
+        raise NotImplementedError
+
+    def merge_sessions_have_persons(self, uas_rs):
+        raise NotImplementedError
+
     def delete_proposal(self, id):
         raise NotImplementedError
 
@@ -32,8 +102,15 @@ class DBTarget:
     def delete_session(self, id):
         raise NotImplementedError
 
+    def delete_sessions(self, ids):
+        '''Delete the sessions with the given ids, except those with data.'''
+        for id in ids:
+            self.delete_session(id)
+
     def update_session(self, src_id, beamline, start_date, end_date, local_contacts, scheduled, id):
         raise NotImplementedError
 
     def insert_session(self, src_id, beamline, comments, start_date, end_date, session_name, beamline_operators, scheduled, persons_rs=None):
+        '''Insert the session, and its persons, and return its id. insert_proposal, insert_session
+        and insert_person return a false value when nothing was inserted.'''
         raise NotImplementedError
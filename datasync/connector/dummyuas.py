@@ -8,6 +8,7 @@ import threading
 import time
 import sys
 from dbsource import DBSource
+from datasync.checksum import range_checksums, person_text, session_text
 
 def open(configuration_file=None):
   '''Create a dummy user admin DB connection, ignoring settings from the configuration file.'''
@@ -37,10 +38,13 @@ class DummyUASConnector(DBSource):
   def disconnect(self):
     pass
 
+  def retrieve_watermark(self):
+    return None
+
   def extract_proposals_have_persons(self):
     rs = [('99017EB35BD34E55E04017AC41627AFF', 'E70E7EB35BD34E55E04017AC41627FFB', 'PRINCIPAL_INVESTIGATOR'),
         ('99017EB35BD34E55E04017AC41627AFF', 'E70E7EB35BD34E55E04017AC41627FFC', 'CO_INVESTIGATOR')]
-    logging.getLogger().debug("Proposal - Persons: Dummy UAS database returns " + str(len(rs)) + " rows.")
+    logging.getLogger().debug("Proposal - Persons: Dummy UAS database returns %d rows.", len(rs))
     return rs
 
 
@@ -48,36 +52,50 @@ class DummyUASConnector(DBSource):
     rs = [('99017EB35BD34E55E04017AC41627AFF', 'E70E7EB35BD34E55E04017AC41627FFB', 'TEAM_LEADER', 1),
         ('99017EB35BD34E55E04017AC41627AFF', 'E70E7EB35BD34E55E04017AC41627FFC', 'TEAM_MEMBER', 1),
         ('99017EB35BD34E55E04017AC41627AFF', 'E70E7EB35BD34E55E04017AC41627FFD', 'TEAM_MEMBER', 1)]
-    logging.getLogger().debug("Session - Persons: Dummy UAS database returns " + str(len(rs)) + " rows.")
+    logging.getLogger().debug("Session - Persons: Dummy UAS database returns %d rows.", len(rs))
     return rs
 
-  def extract_proposals(self):
+  def extract_proposals(self, since=None):
     rs = [('nt20', '99017EB35BD34E55E04017AC41627AFF', 'Software testing', 'Open'),
         ('cm12345', '99017EB35BD34E55E04017AC41627BFF', 'Commissioning i03', 'Open'),
         ('cm12346', '99017EB35BD34E55E04017AC41627CFF', 'Commissioning i04', 'Open')]
-    logging.getLogger().debug("Proposals: Dummy UAS database returns " + str(len(rs)) + " rows.")
+    logging.getLogger().debug("Proposals: Dummy UAS database returns %d rows.", len(rs))
     return rs
 
-  def extract_sessions(self):
+  def extract_sessions(self, since=None, prefixes=None):
     rs = [('99017EB35BD34E55E04017AC41627AFE', 'cm12345-6', 'i03', 'Funny comment here ...', '2018-01-15 09:00:00', '2018-01-16 08:59:59', '', 'Dr Carlos Garcia'),
         ('99017EB35BD34E55E04017AC41627AFF', 'cm12346-7', 'i04', 'Even funnier comment here ...', '2018-01-15 09:00:00', '2018-01-16 08:59:59', '', 'Dr Maria de Santos')]
-    logging.getLogger().debug("Sessions: Dummy UAS database returns " + str(len(rs)) + " rows.")
+    rs = _with_prefixes(rs, prefixes)
+    logging.getLogger().debug("Sessions: Dummy UAS database returns %d rows.", len(rs))
     return rs
 
   def extract_session_types(self):
     rs = [('99017EB35BD34E55E04017AC41627AFE', 'Compulsarily remote', 'cm12345-6'),
         ('99017EB35BD34E55E04017AC41627AFF', 'In situ', 'cm12345-7'),
         ('99017EB35BD34E55E04017AC41627AFF', 'Humidity Control (HC1b)', 'cm12345-7')]
-    logging.getLogger().debug("Session types: Dummy UAS database returns " + str(len(rs)) + " rows.")
+    logging.getLogger().debug("Session types: Dummy UAS database returns %d rows.", len(rs))
     return rs
 
-  def extract_persons(self):
+  def extract_persons(self, since=None, prefixes=None):
     rs = [('E70E7EB35BD34E55E04017AC41627FFB', 'gok13476', 'Mr', 'Grok', 'Trok'),
         ('E70E7EB35BD34E55E04017AC41627FFC', 'fra47613', 'Dr', 'Spok', 'Drok'),
         ('E70E7EB35BD34E55E04017AC41627FFD', 'pro46731', 'Dr', 'Mok', 'Krok')]
-    logging.getLogger().debug("Persons: UAS database returns " + str(len(rs)) + " rows.")
+    rs = _with_prefixes(rs, prefixes)
+    logging.getLogger().debug("Persons: UAS database returns %d rows.", len(rs))
     return rs
 
+  def iterate_sessions(self):
+    return iter(sorted(self.extract_sessions()))
+
+  def iterate_persons(self):
+    return iter(sorted(self.extract_persons()))
+
+  def checksum_sessions(self, prefix_length):
+    return range_checksums(self.extract_sessions(), lambda r: r[0], session_text, prefix_length)
+
+  def checksum_persons(self, prefix_length):
+    return range_checksums(self.extract_persons(), lambda r: r[0], person_text, prefix_length)
+
   def retrieve_sessions_for_person(self, uas_id):
     rs = []
     if uas_id == 'E70E7EB35BD34E55E04017AC41627FFB':
@@ -101,3 +119,8 @@ class DummyUASConnector(DBSource):
         ('D70E7EB35BD34E55E04017AC41627FFC', '99017EB35BD34E55E04017AC41627BFF', 'Deoxyribonucleic acid', 'DNA-y', 'Accepted'),
         ('D70E7EB35BD34E55E04017AC41627FFD', '99017EB35BD34E55E04017AC41627BFF', 'Deoxyribonucleic acid', 'DNA-z', 'Accepted')]
     return rs
+
+def _with_prefixes(rs, prefixes):
+  if prefixes is None:
+    return rs
+  return [r for r in rs if r[0][:len(prefixes[0])] in prefixes] if prefixes else []
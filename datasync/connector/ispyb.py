@@ -1,4 +1,5 @@
 import mysql.connector
+import mysql.connector.pooling
 try:
   import configparser
 except ImportError:
@@ -7,8 +8,10 @@ import logging
 import threading
 import time
 import sys
+from collections import OrderedDict
 from dbsource import DBSource
 from dbtarget import DBTarget
+from datasync.rows import IdMap
 
 def open(configuration_file):
   '''Create an ISPyB connection using settings from a configuration file.'''
@@ -20,16 +23,60 @@ def open(configuration_file):
   if config.has_section('ispyb'):
     credentials = dict(config.items('ispyb'))
     logging.getLogger().debug('Creating MySQL connection from %s', configuration_file)
-    print(credentials)
     conn = ISPyBConnector(**credentials)
   else:
     raise AttributeError('No supported connection type found in %s' % configuration_file)
 
   return conn
 
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(pool_size, **kwargs):
+  '''Return the process-wide connection pool for these connection settings,
+  creating it on first use, so that all connectors to one database share it.'''
+  key = tuple(sorted(kwargs.items()))
+  with _pools_lock:
+    pool = _pools.get(key)
+    if pool is None:
+        logging.getLogger().debug('Creating MySQL connection pool of size %d', pool_size)
+        pool = mysql.connector.pooling.MySQLConnectionPool(pool_name='ispyb%d' % len(_pools), pool_size=pool_size, **kwargs)
+        _pools[key] = pool
+  return pool
+
+def _get_pooled_connection(pool, timeout):
+  '''Get a connection from pool, waiting up to timeout seconds for one to be released.'''
+  deadline = time.time() + timeout
+  while True:
+    try:
+        return pool.get_connection()
+    except mysql.connector.errors.PoolError:
+        if time.time() > deadline:
+            raise
+        time.sleep(0.1)
+
+def _set_autocommit(conn, autocommit):
+  # With a statement rather than the autocommit property: pooled connections only proxy
+  # attribute reads to the real connection
+  cursor = conn.cursor()
+  try:
+    cursor.execute('SET autocommit = %d' % (1 if autocommit else 0))
+  finally:
+    cursor.close()
+
 class ISPyBConnector(DBSource, DBTarget):
-  def __init__(self, user=None, pw=None, host='localhost', db=None, port=3306, unix_socket = None, conn_inactivity=360):
+  def __init__(self, user=None, pw=None, host='localhost', db=None, port=3306, unix_socket = None, conn_inactivity=360, batch_size=500, pool_size=0, pool_timeout=30, commit_interval=None):
     self.lock = threading.Lock()
+    self.stream_conn = None
+    self.id_cache = {}
+    self.batch_size = int(batch_size)
+    self.pending = OrderedDict()
+    self.pool_size = int(pool_size)
+    self.pool_timeout = int(pool_timeout)
+    # None (or empty): autocommit every statement. 0: commit only on commit(), i.e. at the
+    # end of each stage. N: also commit after every N write statements.
+    self.commit_interval = None if commit_interval is None or commit_interval == '' else int(commit_interval)
+    self.uncommitted = 0
     self.connect(user=user, pw=pw, host=host, db=db, port=port, unix_socket = unix_socket, conn_inactivity=conn_inactivity)
 
   def __enter__(self):
@@ -39,6 +86,10 @@ class ISPyBConnector(DBSource, DBTarget):
         raise Exception
 
   def __exit__(self, type, value, traceback):
+    if type is None:
+        self.commit()
+    else:
+        self.rollback()
     self.disconnect()
 
   def connect(self, user=None, pw=None, host='localhost', db=None, port=3306, unix_socket = None, conn_inactivity=360):
@@ -48,67 +99,144 @@ class ISPyBConnector(DBSource, DBTarget):
     self.host = host
     self.db = db
     self.port = port
+    self.unix_socket = unix_socket
     self.conn_inactivity = int(conn_inactivity)
 
-    self.conn = None
-    if unix_socket is not None and unix_socket != '':
-        self.conn = mysql.connector.connect(user=user, unix_socket=unix_socket, database=db)
-    else:
-        self.conn = mysql.connector.connect(user=user, password=pw, host=host, database=db, port=int(port))
+    self.conn = self.open_connection()
 
     if self.conn is not None:
-        self.conn.autocommit=True
+        _set_autocommit(self.conn, self.commit_interval is None)
     else:
         raise ISPyBConnectionException
     self.last_activity_ts = time.time()
 
+  def open_connection(self):
+    '''Return a new connection, or one from the shared pool if pool_size is set.'''
+    # consume_results lets a streamed cursor be closed before all its rows are read
+    kwargs = dict(user=self.user, database=self.db, consume_results=True)
+    if self.unix_socket is not None and self.unix_socket != '':
+        kwargs['unix_socket'] = self.unix_socket
+    else:
+        kwargs.update(password=self.pw, host=self.host, port=int(self.port))
+    if self.pool_size > 0:
+        return _get_pooled_connection(_get_pool(self.pool_size, **kwargs), self.pool_timeout)
+    return mysql.connector.connect(**kwargs)
+
   def __del__(self):
     self.disconnect()
 
   def disconnect(self):
-    '''Release the connection previously created.'''
+    '''Release the connection previously created, or return it to the pool.'''
     if hasattr(self, 'conn') and self.conn is not None:
     	self.conn.close()
     self.conn = None
+    if hasattr(self, 'stream_conn') and self.stream_conn is not None:
+        self.stream_conn.close()
+    self.stream_conn = None
 
   def create_cursor(self, dictionary=False):
-      if time.time() - self.last_activity_ts > self.conn_inactivity:
-          # re-connect:
-          self.connect(self.user, self.pw, self.host, self.db, self.port)
-      self.last_activity_ts = time.time()
       if self.conn is None:
           raise Exception
+      if time.time() - self.last_activity_ts > self.conn_inactivity:
+          # health check after being idle, re-connecting if the server has dropped us -
+          # unless that would silently lose the writes of an open transaction:
+          self.conn.ping(reconnect=self.uncommitted == 0, attempts=3, delay=1)
+          _set_autocommit(self.conn, self.commit_interval is None)
+      self.last_activity_ts = time.time()
 
       cursor = self.conn.cursor(dictionary=dictionary)
       if cursor is None:
           raise Exception
       return cursor
 
+  def create_stream_cursor(self):
+      '''Return an unbuffered cursor on a second connection, so that rows can be
+      streamed from it while other statements run on the main connection. With a pool,
+      the second connection is only held while a stream is open, see release_stream.'''
+      if self.stream_conn is None or not self.stream_conn.is_connected():
+          if self.stream_conn is not None:
+              self.stream_conn.close()
+          self.stream_conn = self.open_connection()
+          _set_autocommit(self.stream_conn, True)
+      return self.stream_conn.cursor()
+
+  def release_stream(self):
+      '''Return the stream connection to the pool once a stream is done with it, so
+      that each connector only takes two of the pool's connections while it streams.'''
+      if self.pool_size > 0 and self.stream_conn is not None:
+          self.stream_conn.close()
+          self.stream_conn = None
+
+  def iterate_query(self, querystr, params, arraysize=1000, log_query=True):
+        '''Generator yielding the rows of a query arraysize rows at a time.'''
+        if self.pending:
+            self.flush()
+        cursor = self.create_stream_cursor()
+
+        if log_query:
+            logging.getLogger().debug("%s %s", querystr, params)
+        start_time=time.time()
+        try:
+            cursor.execute(querystr, params)
+        except:
+            logging.getLogger().exception("%s: exception running sql statement :-(", sys.argv[0])
+            logging.getLogger().exception("%s %s", querystr, params)
+            cursor.close()
+            self.release_stream()
+            raise
+
+        # only the time spent in the database, not in the consumer, is recorded
+        elapsed = time.time() - start_time
+        count = 0
+        try:
+            while True:
+                start_time=time.time()
+                rows = cursor.fetchmany(arraysize)
+                elapsed += time.time() - start_time
+                if not rows:
+                    break
+                count += len(rows)
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+            self.release_stream()
+            if self.instrument is not None:
+                self.instrument.record(querystr, elapsed, rows=count)
+
   def do_query(self, querystr, params, return_fetch=True, return_id=False, log_query=True):
+        # Statements must see, and run after, any writes queued before them
+        if self.pending:
+            self.flush()
         cursor = self.create_cursor(dictionary=False)
+        try:
+            return self.run_query(cursor, querystr, params, return_fetch, return_id, log_query)
+        finally:
+            cursor.close()
 
+  def run_query(self, cursor, querystr, params, return_fetch=True, return_id=False, log_query=True):
         if log_query:
-            logging.getLogger().debug(querystr + " " + str(params))
-        start_time=time.time()
+            logging.getLogger().debug("%s %s", querystr, params)
+        query_start=start_time=time.time()
         try:
             ret=cursor.execute(querystr, params)
         except:
-            logging.getLogger().exception("%s: exception running sql statement :-(" % sys.argv[0])
-            logging.getLogger().exception(querystr + " " + str(params))
+            logging.getLogger().exception("%s: exception running sql statement :-(", sys.argv[0])
+            logging.getLogger().exception("%s %s", querystr, params)
             raise
         else:
             if log_query:
-                logging.getLogger().debug("%s: query took %f seconds" %  (sys.argv[0], (time.time()-start_time)))
+                logging.getLogger().debug("%s: query took %f seconds", sys.argv[0], time.time()-start_time)
 
         if return_fetch:
             start_time=time.time()
             try:
                 ret=cursor.fetchall()
             except:
-                logging.getLogger().exception("%s: exception fetching cursor :-(" % sys.argv[0])
+                logging.getLogger().exception("%s: exception fetching cursor :-(", sys.argv[0])
                 raise
             if log_query:
-                logging.getLogger().debug("%s: fetch took %f seconds" %  (sys.argv[0], (time.time()-start_time)))
+                logging.getLogger().debug("%s: fetch took %f seconds", sys.argv[0], time.time()-start_time)
         elif return_id:
             start_time=time.time()
 
@@ -120,25 +248,172 @@ class ISPyBConnector(DBSource, DBTarget):
 
             ret = cursor.lastrowid
             if log_query:
-                logging.getLogger().debug("%s: id took %f seconds" % (sys.argv[0], (time.time()-start_time)))
+                logging.getLogger().debug("%s: id took %f seconds", sys.argv[0], time.time()-start_time)
+        if self.instrument is not None:
+            self.instrument.record(querystr, time.time() - query_start, rows=len(ret) if return_fetch else 0,
+                                   affected=0 if return_fetch else cursor.rowcount)
+        if not return_fetch:
+            self.wrote()
         return ret
 
+  def do_many(self, querystr, seq_params, log_query=True):
+        if self.pending:
+            self.flush()
+        cursor = self.create_cursor(dictionary=False)
+
+        if log_query:
+            logging.getLogger().debug("%s [%d rows]", querystr, len(seq_params))
+        start_time=time.time()
+        try:
+            cursor.executemany(querystr, seq_params)
+        except:
+            logging.getLogger().exception("%s: exception running sql statement :-(", sys.argv[0])
+            logging.getLogger().exception("%s [%d rows]", querystr, len(seq_params))
+            raise
+        else:
+            if log_query:
+                logging.getLogger().debug("%s: query took %f seconds", sys.argv[0], time.time()-start_time)
+            if self.instrument is not None:
+                self.instrument.record(querystr, time.time() - start_time, affected=cursor.rowcount,
+                                       executions=len(seq_params))
+        finally:
+            cursor.close()
+        self.wrote()
+
+  def do_write(self, querystr, params, log_query=True):
+        '''Run a statement and return the number of rows it affected.'''
+        if self.pending:
+            self.flush()
+        cursor = self.create_cursor(dictionary=False)
+        try:
+            self.run_query(cursor, querystr, params, False, False, log_query)
+            return cursor.rowcount
+        finally:
+            cursor.close()
+
+  def queue_write(self, querystr, params, values=None, suffix=''):
+    '''Buffer a write whose result isn't needed, to be sent with others of the same kind.
+
+    With values (the "(%s, ...)" row of an INSERT ... VALUES statement) the buffered rows
+    are sent as one multi-row statement, querystr + values + ', ' + values ... + suffix.
+    Without, they are sent with executemany(querystr, ...). Buffered writes are flushed
+    when batch_size rows of one kind are waiting, before any other statement is run, and
+    by flush(). A batch_size of 1 runs every write straight away.'''
+    if self.batch_size <= 1:
+        self.do_query(querystr + (values or '') + suffix, params, False, False)
+        return
+    key = (querystr, values, suffix)
+    rows = self.pending.get(key)
+    if rows is None:
+        rows = self.pending[key] = []
+    rows.append(params)
+    if len(rows) >= self.batch_size:
+        self.flush()
+
+  def flush(self):
+    '''Send all buffered writes, in the order their kinds were first queued.'''
+    pending = self.pending
+    self.pending = OrderedDict()
+    for (querystr, values, suffix), rows in pending.items():
+        for i in range(0, len(rows), self.batch_size):
+            chunk = rows[i:i+self.batch_size]
+            if values is None:
+                self.do_many(querystr, chunk)
+            else:
+                params = [p for row in chunk for p in row]
+                self.do_query(querystr + ', '.join([values] * len(chunk)) + suffix, params, False, False, log_query=False)
+
+  def wrote(self):
+    '''Count a write statement, committing once commit_interval of them are uncommitted.'''
+    if self.commit_interval is None:
+        return
+    self.uncommitted += 1
+    if self.commit_interval > 0 and self.uncommitted >= self.commit_interval:
+        self.commit()
+
+  def commit(self):
+    '''Send all buffered writes and, unless autocommitting, commit the transaction.'''
+    self.flush()
+    if self.commit_interval is not None and self.conn is not None:
+        start_time = time.time()
+        self.conn.commit()
+        if self.instrument is not None:
+            self.instrument.record('COMMIT', time.time() - start_time)
+    self.uncommitted = 0
+
+  def begin_stage(self):
+    # the rows other workers have inserted by now are in the maps when they are reloaded
+    self.clear_id_cache()
+
+  def rollback(self):
+    '''Discard all buffered writes and roll back those not committed yet.'''
+    self.pending = OrderedDict()
+    # ids cached by the rolled back inserts don't exist any more
+    self.clear_id_cache()
+    if self.commit_interval is not None and self.conn is not None:
+        logging.getLogger().warning("Rolling back %d uncommitted statements", self.uncommitted)
+        self.conn.rollback()
+    self.uncommitted = 0
+
+  def preload_ids(self, table):
+    '''Load the complete key -> primary key map for one of the tables in _ID_QUERIES in a single query.'''
+    rs = self.do_query(_ID_QUERIES[table], [], log_query=False)
+    ids = IdMap((row[0] if len(row) == 2 else tuple(row[:-1]), row[-1]) for row in rs)
+    logging.getLogger().debug("%s ids: ISPyB database returns %d rows.", table, len(ids))
+    self.id_cache[table] = ids
+    return ids
+
+  def resolve_id(self, table, key):
+    '''Return the primary key for key (usually a hex externalId), or None. The map is
+    preloaded on first use and kept up to date by this connector's own writes; keys
+    missing from it, e.g. of rows other connections have inserted since, are looked up
+    with a point query and added.'''
+    if key is None:
+        return None
+    ids = self.id_cache.get(table)
+    if ids is None:
+        ids = self.preload_ids(table)
+    id = ids.get(key)
+    if id is None:
+        params = list(key) if isinstance(key, tuple) else [key]
+        rs = self.do_query(_ID_LOOKUPS[table], params)
+        if rs and rs[0][0] is not None:
+            id = int(rs[0][0])
+            ids[key] = id
+    return id
+
+  def cache_id(self, table, key, id):
+    ids = self.id_cache.get(table)
+    if ids is not None and key is not None and id:
+        ids[key] = int(id)
+
+  def clear_id_cache(self, table=None):
+    if table is None:
+        self.id_cache = {}
+    else:
+        self.id_cache.pop(table, None)
+
   def insert_proposal(self, proposal, title, src_id):
     code = str(proposal[0]) + str(proposal[1])
     num = int(proposal[2:])
     query = 'INSERT IGNORE INTO Proposal (proposalCode, proposalNumber, title, externalId, personId, blTimeStamp) VALUES (%s, %s, %s, unhex(%s), 1, NOW())'
     params = [code, str(num), title, src_id]
-    return self.do_query(query, params, False, True)
+    proposal_id = self.do_query(query, params, False, True)
+    self.cache_id('Proposal', src_id, proposal_id)
+    self.cache_id('ProposalCodeNumber', (code.lower(), str(num)), proposal_id)
+    return proposal_id
 
   def update_proposal(self, title, src_id, id):
     query = 'UPDATE Proposal SET title=%s, blTimeStamp = NOW(), externalId=unhex(%s) WHERE proposalId=%s'
     params = [title, src_id, str(id)]
-    self.do_query(query, params, False, False)
+    self.queue_write(query, params)
+    self.cache_id('Proposal', src_id, id)
 
   def update_proposal_code(self, proposal_code, proposal_id):
     query = 'UPDATE Proposal SET proposalCode=%s WHERE proposalId=%s'
     params = [proposal_code, proposal_id]
     self.do_query(query, params, False, False)
+    self.clear_id_cache('ProposalCodeNumber')
 
   def delete_proposal(self, id):
     query = 'DELETE FROM ProposalHasPerson WHERE proposalId=%s'
@@ -148,38 +423,18 @@ class ISPyBConnector(DBSource, DBTarget):
     query = 'DELETE FROM Proposal WHERE proposalId=%s'
     params = [str(id)]
     self.do_query(query, params, False, False)
+    self.clear_id_cache('Proposal')
+    self.clear_id_cache('ProposalCodeNumber')
 
   def retrieve_proposal_id(self, proposal_code, proposal_number):
-    query = 'SELECT max(proposalId) FROM Proposal WHERE proposalCode=%s AND proposalNumber=%s'
-    params = [proposal_code, proposal_number]
-    rs = self.do_query(query, params, return_fetch=True, return_id=False, log_query=False)
-    if rs != None and rs[0] != None and rs[0][0] != None:
-        return int(rs[0][0])
-    return None
+    return self.resolve_id('ProposalCodeNumber', (proposal_code.lower(), str(proposal_number)))
 
   def retrieve_proposal_id_for_src_id(self, src_id):
-    query = 'SELECT max(proposalId) FROM Proposal WHERE externalId=unhex(%s)'
-    params = [src_id]
-    rs = self.do_query(query, params, return_fetch=True, return_id=False, log_query=False)
-    if rs != None and rs[0] != None and rs[0][0] != None:
-        return int(rs[0][0])
-    return None
+    return self.resolve_id('Proposal', src_id)
 
   def insert_session(self, src_id, beamline, comments, start_date, end_date, session_name, beamline_operators, scheduled, persons_rs=None):
-    code = str(session_name[0]) + str(session_name[1])
-    i = session_name.find('-', 2)
-    if i == -1:
-        logging.getLogger().warning("Problem session_name: %s" % session_name)
-        return
-    try:
-        num = int(session_name[2:i])
-    except ValueError:
-        logging.getLogger().warning("Problem session_name: %s" % session_name)
-        return
-    try:
-        visit_number = int(session_name[i+1:])
-    except ValueError:
-        logging.getLogger().warning("Problem session_name: %s" % session_name)
+    code, num, visit_number = _visit_parts(session_name)
+    if code is None:
         return
 
     proposal_id = self.retrieve_proposal_id(code, num)
@@ -190,6 +445,7 @@ class ISPyBConnector(DBSource, DBTarget):
 VALUES (%s, unhex(%s), %s, %s, %s, %s, %s, %s, %s)'''
     params = [proposal_id, src_id, beamline, comments, start_date, end_date, visit_number, beamline_operators, scheduled]
     ispyb_session_id = self.do_query(query, params, False, True)
+    self.cache_id('BLSession', src_id, ispyb_session_id)
 
     if ispyb_session_id is None:
         logging.getLogger().debug("ispyb_session_id is None!")
@@ -198,92 +454,78 @@ VALUES (%s, unhex(%s), %s, %s, %s, %s, %s, %s, %s)'''
         self.insert_persons_for_session(ispyb_session_id, persons_rs)
     else:
         logging.getLogger().debug("persons_rs is None!")
+    return ispyb_session_id
 
   def update_session(self, src_id, beamline, start_date, end_date, local_contacts, scheduled, id):
     query = '''UPDATE BLSession SET externalId=unhex(%s), beamlinename=%s, startDate=%s, endDate=%s, beamLineOperator=%s, scheduled=%s
     WHERE sessionId=%s'''
     params = [src_id, beamline, start_date, end_date, local_contacts, scheduled, str(id)]
-    self.do_query(query, params, False, False)
+    self.queue_write(query, params)
+    self.cache_id('BLSession', src_id, id)
+
+  def sessions_with_data(self, ids):
+    '''Return the set of the sessionIds in ids that rows of the _SESSION_DATA tables refer to,
+    with one EXISTS semi-join per table in a single statement per _ID_CHUNK_SIZE ids.'''
+    ids = sorted(set([int(id) for id in ids]))
+    with_data = set()
+    for i in range(0, len(ids), _ID_CHUNK_SIZE):
+        chunk = ids[i:i+_ID_CHUNK_SIZE]
+        query = 'SELECT b.sessionId FROM BLSession b WHERE b.sessionId IN (%s) AND (%s)' % (', '.join(['%s'] * len(chunk)), _has_data('b.sessionId'))
+        with_data.update([int(row[0]) for row in self.do_query(query, chunk, log_query=False)])
+    logging.getLogger().debug("sessions_with_data: %d of %d sessions have data", len(with_data), len(ids))
+    return with_data
 
   def session_has_data(self, id):
-    query = """SELECT SUM(num) from (
-SELECT COUNT(*) as num FROM DataCollectionGroup WHERE sessionid = %s
-UNION ALL
-SELECT COUNT(*) as num FROM DataCollection WHERE sessionid = %s
-UNION ALL
-SELECT COUNT(*) as num FROM EnergyScan WHERE sessionid = %s
-UNION ALL
-SELECT COUNT(*) as num FROM XFEFluorescenceSpectrum WHERE sessionid = %s
-UNION ALL
-SELECT COUNT(*) as num FROM ShippingHasSession WHERE sessionid = %s
-UNION ALL
-SELECT COUNT(*) as num FROM SaxsDataCollection WHERE blsessionid = %s
-UNION ALL
-SELECT COUNT(*) as num FROM SamplePlate WHERE blsessionid = %s
-UNION ALL
-SELECT COUNT(*) as num FROM Specimen WHERE blsessionid = %s
-UNION ALL
-SELECT COUNT(*) as num FROM BF_fault WHERE sessionid = %s
-UNION ALL
-SELECT COUNT(*) as num FROM RobotAction WHERE blsessionId = %s
-UNION ALL
-SELECT COUNT(*) as num FROM BeamlineAction WHERE sessionId = %s
-UNION ALL
-SELECT COUNT(*) as num FROM Dewar WHERE firstExperimentId = %s
-) a"""
-    params = [id] * 12
-
-    rs = self.do_query(query, params, return_fetch=True, return_id=False, log_query=False)
-    if rs != None and rs[0] != None:
-        rows = int(rs[0][0])
-        logging.getLogger().debug("session_has_data rows: %d" % rows)
-        if rows > 0:
-            return True
-    return False
+    return int(id) in self.sessions_with_data([id])
+
+  def delete_sessions(self, ids):
+    '''Delete the sessions in ids, except those that have data.'''
+    ids = sorted(set([int(id) for id in ids]) - self.sessions_with_data(ids))
+    for i in range(0, len(ids), _ID_CHUNK_SIZE):
+        chunk = ids[i:i+_ID_CHUNK_SIZE]
+        query = 'DELETE FROM BLSession WHERE sessionId IN (%s)' % ', '.join(['%s'] * len(chunk))
+        self.do_query(query, chunk, False, False)
+    if ids:
+        self.clear_id_cache('BLSession')
 
   def delete_session(self, id):
-    if not session_has_data(id):
-        query = 'DELETE FROM BLSession WHERE sessionId=%s'
-        params = [str(id)]
-        self.do_query(query, params, False, False)
+    self.delete_sessions([id])
 
   def retrieve_session_id(self, uas_session_id):
-    query = 'SELECT max(sessionId) FROM BLSession WHERE externalId=unhex(%s)'
-    params = [uas_session_id]
-    rs = self.do_query(query, params, return_fetch=True, return_id=False, log_query=False)
-    if rs != None and rs[0] != None and rs[0][0] != None:
-        return int(rs[0][0])
-    return None
+    return self.resolve_id('BLSession', uas_session_id)
 
   def insert_session_has_person(self, role, session_id, person_id, is_remote):
-    if session_id != None and person_id != None:
+    # ids of 0 are those of inserts INSERT IGNORE dropped
+    if session_id and person_id:
         query = '''INSERT IGNORE INTO Session_has_Person (sessionId, personId, role, remote)
-VALUES (%s, %s, %s, %s)'''
+VALUES '''
         params = [session_id, person_id, role, is_remote]
-        self.do_query(query, params, False, False)
+        self.queue_write(query, params, values='(%s, %s, %s, %s)')
     else:
-        if session_id is None:
+        if not session_id:
             logging.getLogger().debug("session_id is None!")
-        if person_id is None:
+        if not person_id:
             logging.getLogger().debug("person_id is None!")
 
   def update_session_has_person(self, uas_role, is_remote, ispyb_session_id, ispyb_person_id):
-    query = 'UPDATE Session_has_Person SET role=%s, remote=%s WHERE sessionId=%s AND personId=%s'
-    params = [self.uas_role_2_ispyb_role(uas_role), is_remote, ispyb_session_id, ispyb_person_id]
-    self.do_query(query, params, False, False)
+    # Session_has_Person is keyed on (sessionId, personId), so updates can be batched as upserts
+    query = 'INSERT INTO Session_has_Person (sessionId, personId, role, remote) VALUES '
+    params = [ispyb_session_id, ispyb_person_id, self.uas_role_2_ispyb_role(uas_role), is_remote]
+    self.queue_write(query, params, values='(%s, %s, %s, %s)', suffix=' ON DUPLICATE KEY UPDATE role=VALUES(role), remote=VALUES(remote)')
 
   def insert_session_type(self, src_id, tag, session_name):
     session_id = self.retrieve_session_id(src_id)
     if session_id != None:
-        query = '''INSERT IGNORE INTO SessionType (sessionId, typeName) VALUES (%s, %s)'''
+        query = '''INSERT IGNORE INTO SessionType (sessionId, typeName) VALUES '''
         params = [session_id, tag]
-        ispyb_session_id = self.do_query(query, params, False, False)
+        self.queue_write(query, params, values='(%s, %s)')
 
   def insert_person(self, src_id, login, title, given_name, family_name, sessions_rs=None):
     query = '''INSERT IGNORE INTO Person (externalId, login, title, givenName, familyName)
 VALUES (unhex(%s), %s, %s, %s, %s)'''
     params = [src_id, login, title, given_name, family_name]
     ispyb_person_id = self.do_query(query, params, False, True)
+    self.cache_id('Person', src_id, ispyb_person_id)
 
     if ispyb_person_id is None:
         logging.getLogger().debug("ispyb_person_id is None!")
@@ -293,19 +535,20 @@ VALUES (unhex(%s), %s, %s, %s, %s)'''
             self.insert_sessions_for_person(ispyb_person_id, sessions_rs)
         else:
             logging.getLogger().debug("uas_sessions_rs is None!")
+    return ispyb_person_id
 
   def update_person(self, src_id, login, title, given_name, family_name, id):
     query = 'UPDATE Person SET externalId=unhex(%s), login=%s, title=%s, givenName=%s, familyName=%s WHERE personId=%s'
     params = [src_id, login, title, given_name, family_name, str(id)]
-    self.do_query(query, params, False, False)
+    self.queue_write(query, params)
+    self.cache_id('Person', src_id, id)
 
   def retrieve_person_id(self, uas_person_id):
-    query = 'SELECT max(personId) FROM Person WHERE externalId=unhex(%s)'
-    params = [uas_person_id]
-    rs = self.do_query(query, params, return_fetch=True, return_id=False, log_query=False)
-    if rs != None and rs[0] != None and rs[0][0] != None:
-        return int(rs[0][0])
-    return None
+    return self.resolve_id('Person', uas_person_id)
+
+  def retrieve_person_id_for_login(self, login):
+    rs = self.do_query('SELECT max(personId) FROM Person WHERE login = %s', [login])
+    return rs[0][0] if rs else None
 
   def insert_protein(self, src_id, proposal_id, name, acronym, origin_txt):
     query = """INSERT IGNORE INTO Protein (externalId, proposalId, name, acronym, proteinType)
@@ -368,6 +611,9 @@ VALUES (
                 family_name = row[6]
 
                 ispyb_person_id = self.insert_person(id, login, title, given_name, family_name)
+                if not ispyb_person_id:
+                    # INSERT IGNORE kept the Person another connection inserted with the same login
+                    ispyb_person_id = self.retrieve_person_id_for_login(login)
 
             self.insert_session_has_person(role, ispyb_session_id, ispyb_person_id, is_remote)
         prev_id = id
@@ -409,14 +655,14 @@ VALUES (
   def update_proposal_has_person(self, uas_role, ispyb_proposal_id, ispyb_person_id):
     query = 'UPDATE ProposalHasPerson SET role=%s WHERE proposalId=%s AND personId=%s'
     params = [self.uas_role_2_ispyb_role(uas_role), ispyb_proposal_id, ispyb_person_id]
-    self.do_query(query, params, False, False)
+    self.queue_write(query, params)
 
   def insert_proposal_has_person(self, role, proposal_id, person_id):
     if proposal_id != None and person_id != None:
         query = '''INSERT IGNORE INTO ProposalHasPerson (proposalId, personId, role)
-VALUES (%s, %s, %s)'''
+VALUES '''
         params = [proposal_id, person_id, role]
-        self.do_query(query, params, False, False)
+        self.queue_write(query, params, values='(%s, %s, %s)')
     else:
         if proposal_id is None:
             logging.getLogger().debug("proposal_id is None!")
@@ -430,7 +676,7 @@ FROM ProposalHasPerson php
   INNER JOIN Person pe on pe.personId = php.personId
 WHERE pe.login is not NULL"""
     rs = list(self.do_query(select, []))
-    logging.getLogger().debug("Proposal - Persons: ISPyB database returns " + str(len(rs)) + " rows.")
+    logging.getLogger().debug("Proposal - Persons: ISPyB database returns %d rows.", len(rs))
     return rs
 
   def extract_sessions_have_persons(self, greater_than = 100):
@@ -440,55 +686,406 @@ FROM Session_has_Person shs
   INNER JOIN Person p on p.personId = shs.personId
 WHERE bs.endDate > subdate(now(), INTERVAL %d DAY) AND p.login is not NULL""" % (int(greater_than)+1)
     rs = list(self.do_query(select, []))
-    logging.getLogger().debug("Session - Persons: ISPyB database returns " + str(len(rs)) + " rows.")
+    logging.getLogger().debug("Session - Persons: ISPyB database returns %d rows.", len(rs))
     return rs
 
   def extract_proposals(self):
     select = """SELECT concat(proposalcode, proposalnumber), hex(externalId), title, proposalId
 FROM Proposal
-ORDER BY concat(proposalcode, proposalnumber)"""
+ORDER BY proposalId"""
     rs = list(self.do_query(select, []))
-    logging.getLogger().debug("Proposals: ISPyB database returns " + str(len(rs)) + " rows.")
+    logging.getLogger().debug("Proposals: ISPyB database returns %d rows.", len(rs))
     return rs
 
-  def extract_sessions(self):
-    select = """SELECT
-hex(s.externalId),
-CONCAT(p.proposalcode, p.proposalnumber, '-', s.visit_number) as visit_id,
-s.beamlinename,
-s.comments,
-s.startdate,
-s.enddate,
-s.sessionid,
-s.beamLineOperator,
-s.scheduled
-FROM Proposal p INNER JOIN BLSession s ON p.proposalid = s.proposalid
-ORDER BY p.proposalnumber, p.proposalcode, s.visit_number"""
-    rs = list(self.do_query(select, []))
-    logging.getLogger().debug("Sessions: ISPyB database returns " + str(len(rs)) + " rows.")
+  def extract_sessions(self, prefixes=None, visits=None):
+    select = _SELECT_SESSIONS
+    params = []
+    if prefixes is not None:
+        select += """
+WHERE s.externalId is NULL OR substr(hex(s.externalId), 1, %d) IN (%s)""" % (_prefix_length(prefixes), ', '.join(['%s'] * len(prefixes)))
+        params = list(prefixes)
+        # rows with another externalId can still match a source row on its visit
+        visits = sorted(set([visit for visit in visits or [] if visit is not None]))
+        if visits:
+            select += """
+  OR CONCAT(p.proposalcode, p.proposalnumber, '-', s.visit_number) IN (%s)""" % ', '.join(['%s'] * len(visits))
+            params += visits
+    select += """
+ORDER BY s.sessionId"""
+    rs = list(self.do_query(select, params))
+    logging.getLogger().debug("Sessions: ISPyB database returns %d rows.", len(rs))
     return rs
 
+  def iterate_sessions(self):
+    select = _SELECT_SESSIONS + """
+ORDER BY s.externalId"""
+    return self.iterate_query(select, [])
+
   def extract_session_types(self):
     select = """SELECT hex(bs.externalId), st.typeName
 FROM SessionType st
   INNER JOIN BLSession bs on st.sessionId = bs.sessionId"""
     rs = list(self.do_query(select, []))
-    logging.getLogger().debug("Session types: ISPyB database returns " + str(len(rs)) + " rows.")
+    logging.getLogger().debug("Session types: ISPyB database returns %d rows.", len(rs))
     return rs
 
-  def extract_persons(self):
-    select = """SELECT hex(externalId), lower(login), title, givenName, familyName, personId
-FROM Person
-WHERE login is not NULL"""
-    rs = list(self.do_query(select, []))
-    logging.getLogger().debug("Persons: ISPyB database returns " + str(len(rs)) + " rows.")
+  def extract_persons(self, prefixes=None, logins=None):
+    select = _SELECT_PERSONS
+    params = []
+    if prefixes is not None:
+        # rows with another externalId can still match a source row on its login
+        logins = sorted(set([login.lower() for login in logins or [] if login is not None]))
+        by_login = ''
+        if logins:
+            by_login = ' OR lower(login) IN (%s)' % ', '.join(['%s'] * len(logins))
+        select += """ AND (externalId is NULL OR substr(hex(externalId), 1, %d) IN (%s)%s)""" % (_prefix_length(prefixes), ', '.join(['%s'] * len(prefixes)), by_login)
+        params = list(prefixes) + logins
+    select += """
+ORDER BY personId"""
+    rs = list(self.do_query(select, params))
+    logging.getLogger().debug("Persons: ISPyB database returns %d rows.", len(rs))
     return rs
 
+  def iterate_persons(self):
+    select = _SELECT_PERSONS + """
+ORDER BY externalId"""
+    return self.iterate_query(select, [])
+
   def extract_components(self):
     select = """SELECT hex(prot.externalId), hex(p.externalId), prot.name, prot.acronym, prot.proteinId
 FROM Proposal p
 INNER JOIN Protein prot on p.proposalId = prot.proposalId
 ORDER BY concat(p.proposalcode, p.proposalnumber), prot.name, prot.acronym"""
     rs = list(self.do_query(select, []))
-    logging.getLogger().debug("Components: ISPyB database returns " + str(len(rs)) + " rows.")
+    logging.getLogger().debug("Components: ISPyB database returns %d rows.", len(rs))
     return rs
+
+  def checksum_sessions(self, prefix_length):
+    select = """SELECT substr(hex(s.externalId), 1, %d) prefix, count(*),
+  sum(conv(substr(md5(concat_ws(char(31),
+    hex(s.externalId),
+    CONCAT(p.proposalcode, p.proposalnumber, '-', s.visit_number),
+    coalesce(s.beamlinename, ''),
+    coalesce(cast(s.startdate as char), ''),
+    coalesce(cast(s.enddate as char), ''),
+    coalesce(s.beamLineOperator, ''),
+    coalesce(s.scheduled, ''))), 1, 8), 16, 10))
+FROM Proposal p INNER JOIN BLSession s ON p.proposalid = s.proposalid
+WHERE s.externalId is not NULL
+GROUP BY prefix""" % int(prefix_length)
+    return self.do_query(select, [])
+
+  def checksum_persons(self, prefix_length):
+    select = """SELECT substr(hex(externalId), 1, %d) prefix, count(*),
+  sum(conv(substr(md5(concat_ws(char(31),
+    hex(externalId), lower(login), coalesce(title, ''), coalesce(givenName, ''), coalesce(familyName, ''))), 1, 8), 16, 10))
+FROM Person
+WHERE login is not NULL AND externalId is not NULL
+GROUP BY prefix""" % int(prefix_length)
+    return self.do_query(select, [])
+
+  # Staged merges: the source rows of an entity are loaded into a temporary table, then
+  # reconciled with the ISPyB table in a few set-based statements, see _MERGES.
+
+  def _merge(self, stage, rows, then=None):
+    '''Load rows into the temporary table stage and run the statements of _MERGES[stage]
+    against it, then call then(), if given, while the table still exists. Returns the
+    numbers of rows (inserted, updated, deleted), and the list of the externalIds of the
+    staged rows that were neither matched nor inserted.'''
+    create, insert, values, statements = _MERGES[stage]
+    counts = {'insert': 0, 'update': 0, 'delete': 0}
+    self.do_query('DROP TEMPORARY TABLE IF EXISTS %s' % stage, [], False, False)
+    self.do_query(create, [], False, False)
+    try:
+        for row in rows:
+            self.queue_write(insert, list(row), values=values)
+        self.flush()
+        for (kind, statement) in statements:
+            affected = self.do_write(statement, [])
+            if kind is not None:
+                counts[kind] += affected
+        unapplied = []
+        if stage in _UNAPPLIED:
+            unapplied = [row[0] for row in self.do_query(_UNAPPLIED[stage], [])]
+        if then is not None:
+            then()
+    finally:
+        self.do_query('DROP TEMPORARY TABLE IF EXISTS %s' % stage, [], False, False)
+        self.clear_id_cache()
+    logging.getLogger().debug("%s: inserted %d, updated %d, deleted %d", stage, counts['insert'], counts['update'], counts['delete'])
+    return (counts['insert'], counts['update'], counts['delete'], unapplied)
+
+  def merge_proposals(self, uas_rs):
+    rows = []
+    for row in uas_rs:
+        if row[1] is None:
+            continue
+        try:
+            number = str(int(row[0][2:]))
+        except ValueError:
+            logging.getLogger().warning("Problem proposal name: %s", row[0])
+            number = None
+        rows.append((row[1], row[0][0:2], number, row[2], 1 if row[3] == 'Cancelled' else 0))
+    return self._merge('stage_Proposal', rows)
+
+  def merge_sessions(self, uas_rs, persons_for_session=None):
+    rows = []
+    for row in uas_rs:
+        if row[0] is None:
+            continue
+        code, num, visit_number = _visit_parts(row[1])
+        rows.append((row[0], code, None if num is None else str(num), visit_number, row[2], row[3], row[4], row[5], row[7],
+                     0 if row[6] == 'Queued' else 1, 1 if row[6] == 'Cancelled' else 0))
+    then = None
+    if persons_for_session is not None:
+        then = lambda: self._merge_new_session_persons(persons_for_session)
+    return self._merge('stage_BLSession', rows, then)
+
+  def _merge_new_session_persons(self, persons_for_session):
+    '''Add the persons of the sessions stage_BLSession has just inserted, and the Person
+    rows missing for them, as insert_session does with insert_persons_for_session.'''
+    rows = []
+    for (session_id,) in self.do_query(_NEW_SESSIONS, []):
+        for row in persons_for_session(session_id):
+            rows.append((session_id, row[0], self.uas_role_2_ispyb_role(row[1]), 1 if row[2] == 0 else 0 if row[2] == 1 else None)
+                        + tuple(row[3:7]))
+    if rows:
+        self._merge('stage_SessionPerson', rows)
+
+  def merge_session_types(self, uas_rs):
+    return self._merge('stage_SessionType', [row[0:2] for row in uas_rs if row[0] is not None and row[1] is not None])
+
+  def merge_persons(self, uas_rs):
+    return self._merge('stage_Person', [row[0:5] for row in uas_rs if row[0] is not None])
+
+  def merge_proposals_have_persons(self, uas_rs):
+    rows = [(row[0], row[1], self.uas_role_2_ispyb_role(row[2])) for row in uas_rs if row[0] is not None and row[1] is not None]
+    return self._merge('stage_ProposalHasPerson', rows)
+
+  def merge_sessions_have_persons(self, uas_rs):
+    rows = [(row[0], row[1], self.uas_role_2_ispyb_role(row[2]), 1 if row[3] == 0 else 0 if row[3] == 1 else None)
+            for row in uas_rs if row[0] is not None and row[1] is not None]
+    return self._merge('stage_Session_has_Person', rows)
+
+def _visit_parts(session_name):
+  '''Split a visit name such as cm12345-6 into (proposal code, number, visit number),
+  or return (None, None, None) if it isn't one.'''
+  code = str(session_name[0]) + str(session_name[1])
+  i = session_name.find('-', 2)
+  if i == -1:
+    logging.getLogger().warning("Problem session_name: %s", session_name)
+    return (None, None, None)
+  try:
+    return (code, int(session_name[2:i]), int(session_name[i+1:]))
+  except ValueError:
+    logging.getLogger().warning("Problem session_name: %s", session_name)
+    return (None, None, None)
+
+def _prefix_length(prefixes):
+  lengths = set([len(prefix) for prefix in prefixes])
+  if len(lengths) > 1:
+    raise ValueError('Prefixes of different lengths: %s' % ', '.join(prefixes))
+  return lengths.pop() if lengths else 1
+
+_SELECT_SESSIONS = """SELECT
+hex(s.externalId),
+CONCAT(p.proposalcode, p.proposalnumber, '-', s.visit_number) as visit_id,
+s.beamlinename,
+s.comments,
+s.startdate,
+s.enddate,
+s.sessionid,
+s.beamLineOperator,
+s.scheduled
+FROM Proposal p INNER JOIN BLSession s ON p.proposalid = s.proposalid"""
+
+_SELECT_PERSONS = """SELECT hex(externalId), lower(login), title, givenName, familyName, personId
+FROM Person
+WHERE login is not NULL"""
+
+# One query per table mapping its lookup key to the primary key, see ISPyBConnector.preload_ids.
+# max() keeps the semantics of the point queries these replaced when a key is not unique.
+_ID_QUERIES = {
+  'Proposal': 'SELECT hex(externalId), max(proposalId) FROM Proposal WHERE externalId is not NULL GROUP BY externalId',
+  'ProposalCodeNumber': 'SELECT lower(proposalCode), proposalNumber, max(proposalId) FROM Proposal GROUP BY lower(proposalCode), proposalNumber',
+  'BLSession': 'SELECT hex(externalId), max(sessionId) FROM BLSession WHERE externalId is not NULL GROUP BY externalId',
+  'Person': 'SELECT hex(externalId), max(personId) FROM Person WHERE externalId is not NULL GROUP BY externalId',
+}
+
+# The point queries resolve_id falls back on for the keys missing from the _ID_QUERIES maps
+_ID_LOOKUPS = {
+  'Proposal': 'SELECT max(proposalId) FROM Proposal WHERE externalId = unhex(%s)',
+  'ProposalCodeNumber': 'SELECT max(proposalId) FROM Proposal WHERE proposalCode = %s AND proposalNumber = %s',
+  'BLSession': 'SELECT max(sessionId) FROM BLSession WHERE externalId = unhex(%s)',
+  'Person': 'SELECT max(personId) FROM Person WHERE externalId = unhex(%s)',
+}
+
+def _resolve(stage, column, table, key, id, stage_key=None, where='externalId is not NULL', aggregate='min'):
+  '''Statement setting stage.column to the least (or greatest) table.id of the rows with the same key.'''
+  return """UPDATE %s s INNER JOIN (SELECT %s k, %s(%s) id FROM %s WHERE %s GROUP BY k) t ON t.k = s.%s
+SET s.%s = t.id""" % (stage, key, aggregate, id, table, where, stage_key or key, column)
+
+# Maximum number of ids in the IN lists of sessions_with_data and delete_sessions
+_ID_CHUNK_SIZE = 1000
+
+# The tables that refer to a session, a session with rows in any of them can't be deleted
+_SESSION_DATA = [('DataCollectionGroup', 'sessionId'), ('DataCollection', 'sessionId'), ('EnergyScan', 'sessionId'),
+                 ('XFEFluorescenceSpectrum', 'sessionId'), ('ShippingHasSession', 'sessionId'),
+                 ('SaxsDataCollection', 'blsessionId'), ('SamplePlate', 'blsessionId'), ('Specimen', 'blsessionId'),
+                 ('BF_fault', 'sessionId'), ('RobotAction', 'blsessionId'), ('BeamlineAction', 'sessionId'),
+                 ('Dewar', 'firstExperimentId')]
+
+def _has_data(session_id):
+  return ' OR '.join(['EXISTS (SELECT 1 FROM %s d WHERE d.%s = %s)' % (table, column, session_id) for (table, column) in _SESSION_DATA])
+
+# The externalIds of the staged rows neither matched with an ISPyB row nor inserted,
+# e.g. sessions of proposals not in ISPyB yet
+_UNAPPLIED = {
+  'stage_Proposal': """SELECT hex(s.externalId) FROM stage_Proposal s
+WHERE s.proposalId is NULL AND s.deleted = 0 AND NOT EXISTS (SELECT 1 FROM Proposal p WHERE p.externalId = s.externalId)""",
+  'stage_BLSession': """SELECT hex(s.externalId) FROM stage_BLSession s
+WHERE s.sessionId is NULL AND s.deleted = 0 AND NOT EXISTS (SELECT 1 FROM BLSession b WHERE b.externalId = s.externalId)""",
+  'stage_Person': """SELECT hex(s.externalId) FROM stage_Person s
+WHERE s.personId is NULL AND NOT EXISTS (SELECT 1 FROM Person p WHERE p.externalId = s.externalId)""",
+}
+
+# The externalIds of the sessions stage_BLSession has inserted
+_NEW_SESSIONS = """SELECT hex(s.externalId) FROM stage_BLSession s
+WHERE s.sessionId is NULL AND s.deleted = 0 AND EXISTS (SELECT 1 FROM BLSession b WHERE b.externalId = s.externalId)"""
+
+# For each staging table: its CREATE statement, the INSERT and VALUES used to load the
+# source rows into it, and the (kind of action counted, statement) pairs that apply them.
+# The staging primary key keeps the first source row of each key, and a source row is
+# matched with the least id of the ISPyB rows sharing either of its keys. reconcile takes
+# the first ISPyB row in extract order, and extract_proposals, extract_sessions and
+# extract_persons are ordered by id so that both pick the same row.
+_MERGES = {
+  'stage_Proposal': ("""CREATE TEMPORARY TABLE stage_Proposal (
+  externalId binary(16) NOT NULL PRIMARY KEY, proposalCode varchar(45), proposalNumber varchar(45), title varchar(200),
+  deleted tinyint(1) NOT NULL, byId int unsigned, byName int unsigned, proposalId int unsigned,
+  codeChanged tinyint(1) NOT NULL DEFAULT 0, titleChanged tinyint(1) NOT NULL DEFAULT 0)""",
+    'INSERT IGNORE INTO stage_Proposal (externalId, proposalCode, proposalNumber, title, deleted) VALUES ',
+    '(unhex(%s), %s, %s, %s, %s)',
+    [(None, _resolve('stage_Proposal', 'byId', 'Proposal', 'externalId', 'proposalId')),
+     (None, """UPDATE stage_Proposal s INNER JOIN (SELECT proposalCode, proposalNumber, min(proposalId) id FROM Proposal
+  GROUP BY proposalCode, proposalNumber) t ON t.proposalCode = s.proposalCode AND t.proposalNumber = s.proposalNumber
+SET s.byName = t.id"""),
+     (None, 'UPDATE stage_Proposal SET proposalId = least(coalesce(byId, byName), coalesce(byName, byId))'),
+     # Flag the changes first: the order of the assignments of a multi-table UPDATE isn't defined
+     (None, """UPDATE stage_Proposal s INNER JOIN Proposal p ON p.proposalId = s.proposalId
+SET s.codeChanged = NOT (BINARY left(p.proposalCode, 2) <=> BINARY s.proposalCode),
+  s.titleChanged = NOT (BINARY p.title <=> BINARY s.title AND p.externalId <=> s.externalId)
+WHERE s.deleted = 0"""),
+     ('update', """UPDATE Proposal p INNER JOIN stage_Proposal s ON s.proposalId = p.proposalId
+SET p.proposalCode = IF(s.codeChanged, s.proposalCode, p.proposalCode),
+  p.title = IF(s.titleChanged, s.title, p.title),
+  p.externalId = IF(s.titleChanged, s.externalId, p.externalId),
+  p.blTimeStamp = IF(s.titleChanged, NOW(), p.blTimeStamp)
+WHERE s.codeChanged OR s.titleChanged"""),
+     (None, 'DELETE php FROM ProposalHasPerson php INNER JOIN stage_Proposal s ON s.proposalId = php.proposalId WHERE s.deleted = 1'),
+     ('delete', 'DELETE p FROM Proposal p INNER JOIN stage_Proposal s ON s.proposalId = p.proposalId WHERE s.deleted = 1'),
+     ('insert', """INSERT IGNORE INTO Proposal (proposalCode, proposalNumber, title, externalId, personId, blTimeStamp)
+SELECT proposalCode, proposalNumber, title, externalId, 1, NOW() FROM stage_Proposal
+WHERE proposalId is NULL AND deleted = 0 AND proposalNumber is not NULL""")]),
+
+  'stage_BLSession': ("""CREATE TEMPORARY TABLE stage_BLSession (
+  externalId binary(16) NOT NULL PRIMARY KEY, proposalCode varchar(45), proposalNumber varchar(45), visit_number int unsigned,
+  beamLineName varchar(45), comments varchar(2000), startDate datetime, endDate datetime, beamLineOperator varchar(45),
+  scheduled tinyint(1), deleted tinyint(1) NOT NULL, byId int unsigned, byVisit int unsigned, sessionId int unsigned)""",
+    'INSERT IGNORE INTO stage_BLSession (externalId, proposalCode, proposalNumber, visit_number, beamLineName, comments, startDate, endDate, beamLineOperator, scheduled, deleted) VALUES ',
+    '(unhex(%s), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)',
+    [(None, _resolve('stage_BLSession', 'byId', 'BLSession', 'externalId', 'sessionId')),
+     (None, """UPDATE stage_BLSession s INNER JOIN (SELECT p.proposalCode, p.proposalNumber, b.visit_number, min(b.sessionId) id
+  FROM Proposal p INNER JOIN BLSession b ON b.proposalId = p.proposalId
+  GROUP BY p.proposalCode, p.proposalNumber, b.visit_number) t
+  ON t.proposalCode = s.proposalCode AND t.proposalNumber = s.proposalNumber AND t.visit_number = s.visit_number
+SET s.byVisit = t.id"""),
+     (None, 'UPDATE stage_BLSession SET sessionId = least(coalesce(byId, byVisit), coalesce(byVisit, byId))'),
+     # Comments aren't compared nor updated, they may have been changed in ISPyB
+     ('update', """UPDATE BLSession b INNER JOIN stage_BLSession s ON s.sessionId = b.sessionId
+SET b.externalId = s.externalId, b.beamLineName = s.beamLineName, b.startDate = s.startDate, b.endDate = s.endDate,
+  b.beamLineOperator = s.beamLineOperator, b.scheduled = s.scheduled
+WHERE s.deleted = 0 AND NOT (b.externalId <=> s.externalId AND BINARY b.beamLineName <=> BINARY s.beamLineName
+  AND b.startDate <=> s.startDate AND b.endDate <=> s.endDate
+  AND BINARY b.beamLineOperator <=> BINARY s.beamLineOperator AND b.scheduled <=> s.scheduled)"""),
+     ('delete', """DELETE b FROM BLSession b INNER JOIN stage_BLSession s ON s.sessionId = b.sessionId
+WHERE s.deleted = 1 AND NOT (%s)""" % _has_data('b.sessionId')),
+     ('insert', """INSERT IGNORE INTO BLSession (proposalId, externalId, beamLineName, comments, startDate, endDate, visit_number, beamLineOperator, scheduled)
+SELECT p.id, s.externalId, s.beamLineName, s.comments, s.startDate, s.endDate, s.visit_number, s.beamLineOperator, s.scheduled
+FROM stage_BLSession s INNER JOIN (SELECT proposalCode, proposalNumber, max(proposalId) id FROM Proposal
+  GROUP BY proposalCode, proposalNumber) p ON p.proposalCode = s.proposalCode AND p.proposalNumber = s.proposalNumber
+WHERE s.sessionId is NULL AND s.deleted = 0""")]),
+
+  'stage_SessionType': ("""CREATE TEMPORARY TABLE stage_SessionType (
+  externalId binary(16) NOT NULL, typeName varchar(31) NOT NULL, sessionId int unsigned,
+  PRIMARY KEY (externalId, typeName))""",
+    'INSERT IGNORE INTO stage_SessionType (externalId, typeName) VALUES ',
+    '(unhex(%s), %s)',
+    [(None, _resolve('stage_SessionType', 'sessionId', 'BLSession', 'externalId', 'sessionId', aggregate='max')),
+     ('insert', """INSERT IGNORE INTO SessionType (sessionId, typeName)
+SELECT s.sessionId, s.typeName FROM stage_SessionType s
+WHERE s.sessionId is not NULL AND NOT EXISTS (SELECT 1 FROM SessionType st INNER JOIN BLSession b ON b.sessionId = st.sessionId
+  WHERE b.externalId = s.externalId AND st.typeName = s.typeName)""")]),
+
+  'stage_Person': ("""CREATE TEMPORARY TABLE stage_Person (
+  externalId binary(16) NOT NULL PRIMARY KEY, login varchar(45), title varchar(45), givenName varchar(45), familyName varchar(100),
+  byId int unsigned, byLogin int unsigned, personId int unsigned)""",
+    'INSERT IGNORE INTO stage_Person (externalId, login, title, givenName, familyName) VALUES ',
+    '(unhex(%s), %s, %s, %s, %s)',
+    [(None, _resolve('stage_Person', 'byId', 'Person', 'externalId', 'personId', where='login is not NULL AND externalId is not NULL')),
+     (None, _resolve('stage_Person', 'byLogin', 'Person', 'lower(login)', 'personId', stage_key='login', where='login is not NULL')),
+     (None, 'UPDATE stage_Person SET personId = least(coalesce(byId, byLogin), coalesce(byLogin, byId))'),
+     ('update', """UPDATE Person p INNER JOIN stage_Person s ON s.personId = p.personId
+SET p.externalId = s.externalId, p.login = s.login, p.title = s.title, p.givenName = s.givenName, p.familyName = s.familyName
+WHERE NOT (p.externalId <=> s.externalId AND BINARY lower(p.login) <=> BINARY s.login AND BINARY p.title <=> BINARY s.title
+  AND BINARY p.givenName <=> BINARY s.givenName AND BINARY p.familyName <=> BINARY s.familyName)"""),
+     ('insert', """INSERT IGNORE INTO Person (externalId, login, title, givenName, familyName)
+SELECT externalId, login, title, givenName, familyName FROM stage_Person WHERE personId is NULL""")]),
+
+  # The persons of new sessions: a Person row is added for those without one that have a
+  # login, then the first role of each person in each session
+  'stage_SessionPerson': ("""CREATE TEMPORARY TABLE stage_SessionPerson (
+  sessionExternalId binary(16) NOT NULL, personExternalId binary(16) NOT NULL, role varchar(255), remote tinyint(1),
+  login varchar(45), title varchar(45), givenName varchar(45), familyName varchar(100),
+  sessionId int unsigned, personId int unsigned, PRIMARY KEY (sessionExternalId, personExternalId))""",
+    'INSERT IGNORE INTO stage_SessionPerson (sessionExternalId, personExternalId, role, remote, login, title, givenName, familyName) VALUES ',
+    '(unhex(%s), unhex(%s), %s, %s, %s, %s, %s, %s)',
+    [(None, """INSERT IGNORE INTO Person (externalId, login, title, givenName, familyName)
+SELECT s.personExternalId, min(s.login), min(s.title), min(s.givenName), min(s.familyName) FROM stage_SessionPerson s
+WHERE s.login is not NULL AND NOT EXISTS (SELECT 1 FROM Person p WHERE p.externalId = s.personExternalId)
+GROUP BY s.personExternalId"""),
+     (None, _resolve('stage_SessionPerson', 'sessionId', 'BLSession', 'externalId', 'sessionId', stage_key='sessionExternalId', aggregate='max')),
+     (None, _resolve('stage_SessionPerson', 'personId', 'Person', 'externalId', 'personId', stage_key='personExternalId', aggregate='max')),
+     ('insert', """INSERT IGNORE INTO Session_has_Person (sessionId, personId, role, remote)
+SELECT sessionId, personId, role, remote FROM stage_SessionPerson
+WHERE sessionId is not NULL AND personId is not NULL""")]),
+
+  'stage_ProposalHasPerson': ("""CREATE TEMPORARY TABLE stage_ProposalHasPerson (
+  proposalExternalId binary(16) NOT NULL, personExternalId binary(16) NOT NULL, role varchar(255),
+  proposalId int unsigned, personId int unsigned, PRIMARY KEY (proposalExternalId, personExternalId))""",
+    'INSERT IGNORE INTO stage_ProposalHasPerson (proposalExternalId, personExternalId, role) VALUES ',
+    '(unhex(%s), unhex(%s), %s)',
+    [(None, _resolve('stage_ProposalHasPerson', 'proposalId', 'Proposal', 'externalId', 'proposalId', stage_key='proposalExternalId', aggregate='max')),
+     (None, _resolve('stage_ProposalHasPerson', 'personId', 'Person', 'externalId', 'personId', stage_key='personExternalId', aggregate='max')),
+     ('update', """UPDATE ProposalHasPerson php INNER JOIN stage_ProposalHasPerson s ON s.proposalId = php.proposalId AND s.personId = php.personId
+SET php.role = s.role
+WHERE NOT (BINARY php.role <=> BINARY s.role)"""),
+     ('insert', """INSERT IGNORE INTO ProposalHasPerson (proposalId, personId, role)
+SELECT s.proposalId, s.personId, s.role FROM stage_ProposalHasPerson s
+WHERE s.proposalId is not NULL AND s.personId is not NULL
+  AND NOT EXISTS (SELECT 1 FROM ProposalHasPerson php WHERE php.proposalId = s.proposalId AND php.personId = s.personId)""")]),
+
+  'stage_Session_has_Person': ("""CREATE TEMPORARY TABLE stage_Session_has_Person (
+  sessionExternalId binary(16) NOT NULL, personExternalId binary(16) NOT NULL, role varchar(255), remote tinyint(1),
+  sessionId int unsigned, personId int unsigned, PRIMARY KEY (sessionExternalId, personExternalId))""",
+    'INSERT IGNORE INTO stage_Session_has_Person (sessionExternalId, personExternalId, role, remote) VALUES ',
+    '(unhex(%s), unhex(%s), %s, %s)',
+    [(None, _resolve('stage_Session_has_Person', 'sessionId', 'BLSession', 'externalId', 'sessionId', stage_key='sessionExternalId', aggregate='max')),
+     (None, _resolve('stage_Session_has_Person', 'personId', 'Person', 'externalId', 'personId', stage_key='personExternalId', aggregate='max')),
+     ('update', """UPDATE Session_has_Person shp INNER JOIN stage_Session_has_Person s ON s.sessionId = shp.sessionId AND s.personId = shp.personId
+SET shp.role = s.role, shp.remote = s.remote
+WHERE NOT (BINARY shp.role <=> BINARY s.role AND shp.remote <=> s.remote)"""),
+     ('insert', """INSERT IGNORE INTO Session_has_Person (sessionId, personId, role, remote)
+SELECT sessionId, personId, role, remote FROM stage_Session_has_Person
+WHERE sessionId is not NULL AND personId is not NULL""")]),
+}
@@ -0,0 +1,113 @@
+try:
+  import configparser
+except ImportError:
+  import ConfigParser as configparser
+import logging
+from dbsource import DBSource
+from datasync.checksum import range_checksums, person_text, session_text
+from datasync import snapshot
+
+def open(configuration_file=None):
+  '''Create a user admin DB connection replaying the snapshot in the directory given
+  in the [snapshotuas] section of the configuration file.'''
+  config = configparser.RawConfigParser(allow_no_value=True)
+  if not config.read(configuration_file):
+    raise AttributeError('No configuration found at %s' % configuration_file)
+
+  if not config.has_section('snapshotuas'):
+    raise AttributeError('No supported connection type found in %s' % configuration_file)
+  logging.getLogger().debug('Creating snapshot connection from %s', configuration_file)
+  return SnapshotUASConnector(**dict(config.items('snapshotuas')))
+
+class SnapshotUASConnector(DBSource):
+  '''A user admin source reading the extracts saved by datasync.snapshot instead of
+  querying the database, so that a sync can be rerun or benchmarked offline, or
+  several targets synced from one extract.
+
+  Snapshots are full extracts: since is ignored, and retrieve_watermark returns
+  None so that watermarks don't advance. retrieve_persons_for_session and
+  retrieve_sessions_for_person are answered from the sessions_have_persons and
+  persons extracts.'''
+
+  def __init__(self, directory=None):
+    self.directory = directory
+    self.manifest = snapshot.read_manifest(directory)
+    self.persons_by_session = None
+    self.sessions_by_person = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    pass
+
+  def disconnect(self):
+    pass
+
+  def rows(self, entity):
+    rs = list(snapshot.iterate_rows(self.directory, entity, self.manifest))
+    logging.getLogger().debug("%s: snapshot returns %d rows.", entity, len(rs))
+    return rs
+
+  def retrieve_watermark(self):
+    return None
+
+  def extract_proposals_have_persons(self):
+    return self.rows('proposals_have_persons')
+
+  def extract_sessions_have_persons(self, greater_than = 100):
+    return self.rows('sessions_have_persons')
+
+  def extract_proposals(self, since=None):
+    return self.rows('proposals')
+
+  def extract_sessions(self, since=None, prefixes=None):
+    return _with_prefixes(self.rows('sessions'), prefixes)
+
+  def extract_session_types(self):
+    return self.rows('session_types')
+
+  def extract_persons(self, since=None, prefixes=None):
+    return _with_prefixes(self.rows('persons'), prefixes)
+
+  def extract_components(self):
+    return self.rows('components')
+
+  def iterate_sessions(self):
+    return iter(sorted(self.rows('sessions'), key=lambda r: r[0]))
+
+  def iterate_persons(self):
+    return iter(sorted(self.rows('persons'), key=lambda r: r[0]))
+
+  def checksum_sessions(self, prefix_length):
+    return range_checksums(self.rows('sessions'), lambda r: r[0], session_text, prefix_length)
+
+  def checksum_persons(self, prefix_length):
+    return range_checksums(self.rows('persons'), lambda r: r[0], person_text, prefix_length)
+
+  def _index_session_persons(self):
+    persons = dict((row[0], row) for row in self.rows('persons'))
+    self.persons_by_session = {}
+    self.sessions_by_person = {}
+    for (session_id, person_id, role, on_site) in self.rows('sessions_have_persons'):
+        person = persons.get(person_id)
+        if person is not None:
+            self.persons_by_session.setdefault(session_id, []).append((person_id, role, on_site) + tuple(person[1:5]))
+        self.sessions_by_person.setdefault(person_id, []).append((session_id, role, on_site))
+
+  def retrieve_persons_for_session(self, uas_id):
+    if self.persons_by_session is None:
+        self._index_session_persons()
+    rs = self.persons_by_session.get(uas_id)
+    return sorted(rs, key=lambda r: r[0]) if rs else None
+
+  def retrieve_sessions_for_person(self, uas_id):
+    if self.sessions_by_person is None:
+        self._index_session_persons()
+    rs = self.sessions_by_person.get(uas_id)
+    return sorted(rs, key=lambda r: r[0]) if rs else None
+
+def _with_prefixes(rs, prefixes):
+  if prefixes is None:
+    return rs
+  return [r for r in rs if r[0][:len(prefixes[0])] in prefixes] if prefixes else []
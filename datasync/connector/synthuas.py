@@ -0,0 +1,295 @@
+try:
+  import configparser
+except ImportError:
+  import ConfigParser as configparser
+import datetime
+import logging
+from dbsource import DBSource
+from datasync.checksum import range_checksums, person_text, session_text
+
+def open(configuration_file=None):
+  '''Create a synthetic user admin DB connection using the sizes and seed in the
+  [synthuas] section of the configuration file.'''
+  config = configparser.RawConfigParser(allow_no_value=True)
+  if not config.read(configuration_file):
+    raise AttributeError('No configuration found at %s' % configuration_file)
+
+  settings = {}
+  if config.has_section('synthuas'):
+    settings = dict((k, v) for (k, v) in config.items('synthuas') if v is not None and v != '')
+  logging.getLogger().debug('Creating synthetic Oracle connection')
+  return SynthUASConnector(**settings)
+
+_MASK = (1 << 64) - 1
+
+def _mix(*parts):
+  '''Deterministic pseudo-random 64-bit integer for a tuple of integers (splitmix64).
+  Much cheaper than seeding a random.Random per row.'''
+  h = 0
+  for p in parts:
+    h = (h + p + 0x9E3779B97F4A7C15) & _MASK
+    h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & _MASK
+    h = h ^ (h >> 31)
+  return h
+
+def _uniform(*parts):
+  return _mix(*parts) / float(1 << 64)
+
+# Entity tags, used both in the ids and to decorrelate the random streams
+_PROPOSAL, _SESSION, _PERSON, _COMPONENT, _SESSION_TYPE, _PROPOSAL_PERSON, _SESSION_PERSON = range(1, 8)
+
+_TITLES = ['Dr', 'Mr', 'Ms', 'Mrs', 'Prof']
+_GIVEN_NAMES = ['Alice', 'Bob', 'Carlos', 'Dana', 'Erik', 'Fatima', 'Grace', 'Hiro', 'Ines', 'Jon', 'Karl', 'Lena',
+                'Maria', 'Nils', 'Olga', 'Pavel', 'Qing', 'Rosa', 'Sven', 'Tariq', 'Uma', 'Victor', 'Wei', 'Yusuf']
+_FAMILY_NAMES = ['Garcia', 'Smith', 'Levik', 'Santos', 'Nguyen', 'Okafor', 'Kowalski', 'Tanaka', 'Berg', 'Rossi',
+                 'Dubois', 'Muller', 'Novak', 'Silva', 'Khan', 'Ivanova', 'Chen', 'Murphy', 'Larsen', 'Haddad']
+_PROPOSAL_CODES = ['mx', 'cm', 'nt', 'sw', 'in', 'bi', 'em', 'lb']
+_INSTRUMENTS = ['i02', 'i03', 'i04', 'i04-1', 'i19', 'i23', 'i24', 'b21', 'b23', 'm01', 'm02', 'm03']
+_SESSION_TYPES = ['Remote', 'Compulsarily remote', 'In situ', 'Humidity Control (HC1b)', 'Industry']
+_PROPOSAL_ROLES = ['CO_INVESTIGATOR', 'CO_INVESTIGATOR', 'CO_INVESTIGATOR', 'ALTERNATE_CONTACT']
+_SESSION_ROLES = ['TEAM_MEMBER', 'TEAM_MEMBER', 'TEAM_MEMBER', 'DATA_ACCESS']
+_FIRST_SESSION = datetime.datetime(2015, 1, 5, 9, 0, 0)
+
+class SynthUASConnector(DBSource):
+  '''A user admin source generating a large, consistent data set instead of
+  reading one from a database, for load testing the sync offline.
+
+  The data only depends on seed and the sizes, so two connectors with the same
+  settings return the same rows. Each generation after the first changes about
+  change_fraction of the rows of each entity - names, titles, comments, dates
+  and states, including cancelling sessions and proposals - so that syncing
+  generation n+1 after generation n exercises the update and delete paths.
+  retrieve_watermark returns the generation, and extract_* with since only
+  return the rows changed after that generation.
+
+  Ids are 32 hex digit strings like the RAW ids of the real database, and are
+  generated in ascending order so the iterate_* methods don't need to sort.'''
+
+  def __init__(self, seed=1, persons=200000, proposals=50000, sessions=500000, persons_per_proposal=8,
+               persons_per_session=5, components_per_proposal=3, change_fraction=0.01, generation=0):
+    self.seed = int(seed)
+    self.n_persons = int(persons)
+    self.n_proposals = int(proposals)
+    self.n_sessions = int(sessions)
+    self.persons_per_proposal = int(persons_per_proposal)
+    self.persons_per_session = int(persons_per_session)
+    self.components_per_proposal = int(components_per_proposal)
+    self.change_fraction = float(change_fraction)
+    self.generation = int(generation)
+    self._person_sessions = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.disconnect()
+
+  def disconnect(self):
+    pass
+
+  def advance(self, generations=1):
+    '''Move on to a later generation of the data set.'''
+    self.generation += generations
+    self._person_sessions = None
+
+  # -- row generation
+
+  def _id(self, tag, i):
+    # The leading digits spread the rows evenly over the id space, like GUIDs do
+    count = {_PROPOSAL: self.n_proposals, _SESSION: self.n_sessions, _PERSON: self.n_persons,
+             _COMPONENT: self.n_proposals * self.components_per_proposal}[tag]
+    return '%04X%012X%08X%08X' % (i * 0x10000 // max(count, 1), i, self.seed & 0xFFFFFFFF, tag)
+
+  def _index(self, id):
+    return int(id[4:16], 16)
+
+  def _version(self, tag, i, since=-1):
+    '''The last generation up to the current one that changed row i, or 0 if none
+    did; -1 if it didn't change after generation since (and since >= 0).'''
+    for g in range(self.generation, max(since, 0), -1):
+        if _uniform(self.seed, tag, i, g) < self.change_fraction:
+            return g
+    return 0 if since < 0 else -1
+
+  def _pick(self, choices, *parts):
+    return choices[_mix(self.seed, *parts) % len(choices)]
+
+  def _proposal_name(self, p):
+    return '%s%d' % (self._pick(_PROPOSAL_CODES, _PROPOSAL, p), 10000 + p)
+
+  def _proposal_state(self, p, v):
+    if v > 0 and _uniform(self.seed, _PROPOSAL, p, v, 1) < 0.1:
+        return 'Cancelled'
+    return 'Closed' if _uniform(self.seed, _PROPOSAL, p, v, 2) < 0.3 else 'Open'
+
+  def _proposal(self, p, v):
+    title = 'Structural studies of target %d' % (_mix(self.seed, _PROPOSAL, p) % 100000)
+    if v > 0:
+        title += ' (revision %d)' % v
+    return (self._proposal_name(p), self._id(_PROPOSAL, p), title, self._proposal_state(p, v))
+
+  def _session_proposal(self, s):
+    return s * self.n_proposals // self.n_sessions
+
+  def _first_session(self, p):
+    return -(-p * self.n_sessions // self.n_proposals)
+
+  def _person(self, n, v):
+    family = self._pick(_FAMILY_NAMES, _PERSON, n, 1)
+    if v > 0:
+        family = self._pick(_FAMILY_NAMES, _PERSON, n, v) + '-' + family
+    return (self._id(_PERSON, n), 'fed%06d' % n, self._pick(_TITLES, _PERSON, n, 2),
+            self._pick(_GIVEN_NAMES, _PERSON, n, 3), family)
+
+  def _session_persons(self, s):
+    '''Indexes of the persons on session s, the first one being the team leader.'''
+    persons = []
+    for k in range(self.persons_per_session):
+        n = _mix(self.seed, _SESSION_PERSON, s, k) % self.n_persons
+        if n not in persons:
+            persons.append(n)
+    return persons
+
+  def _local_contact(self, s):
+    return _mix(self.seed, _SESSION, s, 4) % self.n_persons
+
+  def _session(self, s, v):
+    p = self._session_proposal(s)
+    start = _FIRST_SESSION + datetime.timedelta(hours=8 * (s * 3 * 365 // max(self.n_sessions, 1)))
+    hours = 24 * (1 + _mix(self.seed, _SESSION, s, 1) % 3)
+    comment = None
+    state = None
+    if v > 0:
+        start += datetime.timedelta(days=7 * v)
+        comment = 'Rescheduled (revision %d)' % v
+        if _uniform(self.seed, _SESSION, s, v, 2) < 0.1:
+            state = 'Cancelled'
+    contact = self._person(self._local_contact(s), 0)
+    operator = '%s %s %s' % (contact[2], contact[3], contact[4])
+    return (self._id(_SESSION, s), '%s-%d' % (self._proposal_name(p), s - self._first_session(p) + 1),
+            self._pick(_INSTRUMENTS, _SESSION, s, 3), comment, start, start + datetime.timedelta(hours=hours),
+            state, operator)
+
+  def _component(self, c, v):
+    p = c // self.components_per_proposal
+    name = 'Protein %d' % (_mix(self.seed, _COMPONENT, c) % 100000)
+    if v > 0:
+        name += ' mutant %d' % v
+    return (self._id(_COMPONENT, c), self._id(_PROPOSAL, p), name, 'P%d' % c, 'Accepted')
+
+  def _rows(self, tag, count, make, since=None, prefixes=None):
+    '''Generator of the rows of an entity, only those changed after generation since
+    and whose id starts with one of prefixes if given.'''
+    since = -1 if since is None else int(since)
+    if prefixes is not None:
+        prefixes = set(prefixes)
+        length = len(next(iter(prefixes))) if prefixes else 0
+    for i in range(count):
+        if prefixes is not None and self._id(tag, i)[:length] not in prefixes:
+            continue
+        v = self._version(tag, i, since)
+        if v >= 0:
+            yield make(i, v)
+
+  # -- DBSource
+
+  def retrieve_watermark(self):
+    return self.generation
+
+  def extract_proposals(self, since=None):
+    rs = list(self._rows(_PROPOSAL, self.n_proposals, self._proposal, since))
+    logging.getLogger().debug("Proposals: Synthetic UAS database returns %d rows.", len(rs))
+    return rs
+
+  def extract_sessions(self, since=None, prefixes=None):
+    rs = list(self._rows(_SESSION, self.n_sessions, self._session, since, prefixes))
+    logging.getLogger().debug("Sessions: Synthetic UAS database returns %d rows.", len(rs))
+    return rs
+
+  def iterate_sessions(self):
+    return self._rows(_SESSION, self.n_sessions, self._session)
+
+  def extract_session_types(self):
+    rs = []
+    for s in range(self.n_sessions):
+        if _uniform(self.seed, _SESSION_TYPE, s) < 0.2:
+            visit = self._session(s, 0)[1]
+            rs.append((self._id(_SESSION, s), self._pick(_SESSION_TYPES, _SESSION_TYPE, s, 1), visit))
+    logging.getLogger().debug("Session types: Synthetic UAS database returns %d rows.", len(rs))
+    return rs
+
+  def extract_persons(self, since=None, prefixes=None):
+    rs = list(self._rows(_PERSON, self.n_persons, self._person, since, prefixes))
+    logging.getLogger().debug("Persons: Synthetic UAS database returns %d rows.", len(rs))
+    return rs
+
+  def iterate_persons(self):
+    return self._rows(_PERSON, self.n_persons, self._person)
+
+  def checksum_sessions(self, prefix_length):
+    return range_checksums(self.iterate_sessions(), lambda r: r[0], session_text, prefix_length)
+
+  def checksum_persons(self, prefix_length):
+    return range_checksums(self.iterate_persons(), lambda r: r[0], person_text, prefix_length)
+
+  def extract_components(self):
+    rs = list(self._rows(_COMPONENT, self.n_proposals * self.components_per_proposal, self._component))
+    logging.getLogger().debug("UAS Components: Synthetic UAS database returns %d rows.", len(rs))
+    return rs
+
+  def extract_proposals_have_persons(self):
+    rs = []
+    for p in range(self.n_proposals):
+        if self._proposal_state(p, self._version(_PROPOSAL, p)) == 'Cancelled':
+            continue
+        proposal_id = self._id(_PROPOSAL, p)
+        seen = set()
+        for k in range(self.persons_per_proposal):
+            n = _mix(self.seed, _PROPOSAL_PERSON, p, k) % self.n_persons
+            if n in seen:
+                continue
+            seen.add(n)
+            role = 'PRINCIPAL_INVESTIGATOR' if k == 0 else self._pick(_PROPOSAL_ROLES, _PROPOSAL_PERSON, p, k, 1)
+            rs.append((proposal_id, self._id(_PERSON, n), role))
+    logging.getLogger().debug("Proposal - Persons: Synthetic UAS database returns %d rows.", len(rs))
+    return rs
+
+  def _session_roles(self, s):
+    '''(person index, role, on_site, rank) of the people on session s, local contact first.'''
+    roles = [(self._local_contact(s), 'LOCAL_CONTACT_1ST', 1, 1)]
+    for (k, n) in enumerate(self._session_persons(s)):
+        role = 'TEAM_LEADER' if k == 0 else self._pick(_SESSION_ROLES, _SESSION_PERSON, s, k, 1)
+        roles.append((n, role, 1 if _uniform(self.seed, _SESSION_PERSON, s, k, 2) < 0.3 else 0, 2))
+    return roles
+
+  def extract_sessions_have_persons(self, greater_than = 100):
+    rs = []
+    for s in range(self.n_sessions):
+        if self._session(s, self._version(_SESSION, s))[6] == 'Cancelled':
+            continue
+        session_id = self._id(_SESSION, s)
+        for (n, role, on_site, rank) in sorted(self._session_roles(s), key=lambda r: (r[0], r[3], r[1])):
+            rs.append((session_id, self._id(_PERSON, n), role, on_site))
+    logging.getLogger().debug("Session - Persons: Synthetic UAS database returns %d rows.", len(rs))
+    return rs
+
+  def retrieve_persons_for_session(self, id):
+    s = self._index(id)
+    rs = []
+    for (n, role, on_site, rank) in sorted(self._session_roles(s), key=lambda r: r[0]):
+        person = self._person(n, self._version(_PERSON, n))
+        rs.append((person[0], role, on_site) + person[1:])
+    return rs
+
+  def retrieve_sessions_for_person(self, id):
+    if self._person_sessions is None:
+        # reverse index of _session_roles, built on first use
+        self._person_sessions = {}
+        for s in range(self.n_sessions):
+            if self._session(s, self._version(_SESSION, s))[6] == 'Cancelled':
+                continue
+            for (n, role, on_site, rank) in self._session_roles(s):
+                if rank == 2:
+                    self._person_sessions.setdefault(n, []).append((self._id(_SESSION, s), role, on_site))
+    return list(self._person_sessions.get(self._index(id), []))
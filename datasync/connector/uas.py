@@ -25,9 +25,36 @@ def open(configuration_file):
 
   return conn
 
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(user, pw, tns, pool_size):
+  '''Return the process-wide session pool for these credentials, creating it on
+  first use, so that all connectors to the user database share it.'''
+  key = (user, pw, tns)
+  with _pools_lock:
+    pool = _pools.get(key)
+    if pool is None:
+        logging.getLogger().debug('Creating Oracle session pool of size %d', pool_size)
+        pool = cx_Oracle.SessionPool(user=user, password=pw, dsn=tns, min=1, max=pool_size, increment=1,
+                                     threaded=True, getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT)
+        _pools[key] = pool
+  return pool
+
 class UASConnector(DBSource):
-  def __init__(self, user=None, pw=None, schema=None, tns=None, conn_inactivity=360):
+  def __init__(self, user=None, pw=None, schema=None, tns=None, conn_inactivity=360, pool_size=0,
+               arraysize=1000, prefetchrows=None, snapshot_dir=None):
     self.lock = threading.Lock()
+    self.pool = None
+    self.pool_size = int(pool_size)
+    # rows fetched per round trip, unless a query asks otherwise
+    self.arraysize = int(arraysize)
+    self.prefetchrows = int(prefetchrows) if prefetchrows not in (None, '') else None
+    # directory to save the full extracts to, see datasync.snapshot
+    self.snapshot = None
+    if snapshot_dir not in (None, ''):
+        from datasync.snapshot import SnapshotWriter
+        self.snapshot = SnapshotWriter(snapshot_dir)
     self.connect(user=user, pw=pw, schema=schema, tns=tns, conn_inactivity=conn_inactivity)
 
   def __enter__(self):
@@ -48,20 +75,25 @@ class UASConnector(DBSource):
     self.schema = schema
     self.tns = tns
     self.conn_inactivity = int(conn_inactivity)
+    self.last_activity_ts = time.time()
 
     try:
-        self.conn=cx_Oracle.connect(user=user, password=pw, dsn=tns)
+        if self.pool_size > 0:
+            self.pool = _get_pool(user, pw, tns, self.pool_size)
+            self.conn = self.pool.acquire()
+        else:
+            self.conn=cx_Oracle.connect(user=user, password=pw, dsn=tns)
     except:
-        logging.getLogger().exception("%s: error while connecting to UAS DB :-(" % sys.argv[0])
+        logging.getLogger().exception("%s: error while connecting to UAS DB :-(", sys.argv[0])
     else:
         try:
             #conn.autocommit(True)
-            conn.autocommit=True
+            self.conn.autocommit=True
         except AttributeError:
             pass
-        logging.getLogger().info("%s: Connected to database (Oracle v. %s)" % (sys.argv[0], conn.version))
-        logging.getLogger().info("%s:    Database user: %s" % (sys.argv[0], user))
-        logging.getLogger().info("%s:    TNS name: %s" % (sys.argv[0], tns))
+        logging.getLogger().info("%s: Connected to database (Oracle v. %s)", sys.argv[0], self.conn.version)
+        logging.getLogger().info("%s:    Database user: %s", sys.argv[0], user)
+        logging.getLogger().info("%s:    TNS name: %s", sys.argv[0], tns)
 
     return self.conn #, uas_cursor)
 
@@ -69,56 +101,116 @@ class UASConnector(DBSource):
     self.disconnect()
 
   def disconnect(self):
-    '''Release the connection previously created.'''
+    '''Release the connection previously created, or return it to the pool.'''
     if hasattr(self, 'conn') and self.conn is not None:
-    	self.conn.close()
+        if self.pool is not None:
+            self.pool.release(self.conn)
+        else:
+            self.conn.close()
     self.conn = None
 
-  def create_cursor(self, dictionary=False):
+  def create_cursor(self, dictionary=False, arraysize=None, prefetchrows=None):
+      if self.conn is None:
+          raise Exception
       if time.time() - self.last_activity_ts > self.conn_inactivity:
-          # re-connect:
-          self.connect(self.user, self.pw, self.schema, self.tns, self.conn_inactivity)
-
+          # health check after being idle, re-connecting if the server has dropped us:
+          try:
+              self.conn.ping()
+          except cx_Oracle.Error:
+              logging.getLogger().warning("%s: UAS connection lost, re-connecting", sys.argv[0])
+              if self.pool is not None:
+                  self.pool.drop(self.conn)
+                  self.conn = None
+              self.connect(self.user, self.pw, self.schema, self.tns, self.conn_inactivity)
       self.last_activity_ts = time.time()
-      if self.conn is None:
-          raise ISPyBConnectionException
 
       try:
           cursor = self.conn.cursor()
       except:
-          logging.getLogger().exception("%s: unable to create cursor :-(" % sys.argv[0])
-      else:
-          logging.getLogger().debug("%s: default cursor ok :-)" % sys.argv[0])
-
-      if cursor is None:
-          raise Exception
+          logging.getLogger().exception("%s: unable to create cursor :-(", sys.argv[0])
+          raise
+      cursor.arraysize = arraysize or self.arraysize
+      if prefetchrows is None:
+          prefetchrows = self.prefetchrows
+      if prefetchrows is not None:
+          # only cx_Oracle 8 and later can set this
+          try:
+              cursor.prefetchrows = prefetchrows
+          except AttributeError:
+              pass
       return cursor
 
-  def do_query(self, querystr, params, return_fetch=True, return_id=False, log_query=True):
-    cursor = self.create_cursor(dictionary=True)
+  def iterate_batches(self, querystr, params, arraysize=None, prefetchrows=None, log_query=True):
+    '''Generator yielding the rows of a query in lists of up to arraysize rows, one
+    list per round trip to the database. arraysize and prefetchrows default to
+    those the connector was created with.'''
+    cursor = self.create_cursor(arraysize=arraysize, prefetchrows=prefetchrows)
 
     if log_query:
-        logging.getLogger().debug(querystr + " " + str(params))
+        logging.getLogger().debug("%s %s", querystr, params)
     start_time=time.time()
+    try:
+        cursor.execute(querystr, params)
+    except:
+        logging.getLogger().exception("%s: exception running sql statement :-(", sys.argv[0])
+        logging.getLogger().exception("%s %s", querystr, params)
+        cursor.close()
+        raise
+
+    # only the time spent in the database, not in the consumer, is recorded
+    elapsed = time.time() - start_time
+    count = 0
+    try:
+        while True:
+            start_time=time.time()
+            rows = cursor.fetchmany()
+            elapsed += time.time() - start_time
+            if not rows:
+                break
+            count += len(rows)
+            yield rows
+    finally:
+        cursor.close()
+        if self.instrument is not None:
+            self.instrument.record(querystr, elapsed, rows=count)
+
+  def iterate_query(self, querystr, params, arraysize=None, prefetchrows=None, log_query=True):
+    '''Generator yielding the rows of a query one by one as they are fetched.'''
+    for rows in self.iterate_batches(querystr, params, arraysize, prefetchrows, log_query):
+        for row in rows:
+            yield row
+
+  def do_query(self, querystr, params, return_fetch=True, return_id=False, log_query=True, arraysize=None):
+    cursor = self.create_cursor(dictionary=True, arraysize=arraysize)
+    try:
+        return self.run_query(cursor, querystr, params, return_fetch, return_id, log_query)
+    finally:
+        cursor.close()
+
+  def run_query(self, cursor, querystr, params, return_fetch=True, return_id=False, log_query=True):
+
+    if log_query:
+        logging.getLogger().debug("%s %s", querystr, params)
+    query_start=start_time=time.time()
     try:
         ret=cursor.execute(querystr, params)
     except:
-        logging.getLogger().exception("%s: exception running sql statement :-(" % sys.argv[0])
-        logging.getLogger().exception(querystr + " " + str(params))
+        logging.getLogger().exception("%s: exception running sql statement :-(", sys.argv[0])
+        logging.getLogger().exception("%s %s", querystr, params)
         raise
     else:
         if log_query:
-            logging.getLogger().debug("%s: query took %f seconds" %  (sys.argv[0], (time.time()-start_time)))
+            logging.getLogger().debug("%s: query took %f seconds", sys.argv[0], time.time()-start_time)
 
     if return_fetch:
         start_time=time.time()
         try:
             ret=cursor.fetchall()
         except:
-            logging.getLogger().exception("%s: exception fetching cursor :-(" % sys.argv[0])
+            logging.getLogger().exception("%s: exception fetching cursor :-(", sys.argv[0])
             raise
         if log_query:
-            logging.getLogger().debug("%s: fetch took %f seconds" %  (sys.argv[0], (time.time()-start_time)))
+            logging.getLogger().debug("%s: fetch took %f seconds", sys.argv[0], time.time()-start_time)
     elif return_id:
         start_time=time.time()
 
@@ -130,9 +222,28 @@ class UASConnector(DBSource):
 
         ret = cursor.lastrowid
         if log_query:
-            logging.getLogger().debug("%s: id took %f seconds" % (sys.argv[0], (time.time()-start_time)))
+            logging.getLogger().debug("%s: id took %f seconds", sys.argv[0], time.time()-start_time)
+    if self.instrument is not None:
+        self.instrument.record(querystr, time.time() - query_start, rows=len(ret) if return_fetch else 0,
+                               affected=0 if return_fetch else cursor.rowcount)
     return ret
 
+  def record(self, entity, rs):
+    '''Save a full extract of entity to the snapshot, if there is one.'''
+    if self.snapshot is not None:
+        self.snapshot.write(entity, rs)
+
+  def extract(self, label, entity, querystr, params):
+    '''Run the query of an extract, returning a generator of its rows as they are
+    fetched. When the extract is to be saved to the snapshot as entity (None if it
+    isn't a full one), the rows are fetched in full and returned as a list.'''
+    if entity is not None and self.snapshot is not None:
+        rs = self.do_query(querystr, params)
+        logging.getLogger().debug("%s: UAS database returns %d rows.", label, len(rs))
+        self.record(entity, rs)
+        return rs
+    return _counted(label, self.iterate_query(querystr, params))
+
   def retrieve_persons_for_session(self, id):
     query = """SELECT person_id, role, on_site, federal_id, title, given_name, family_name
 FROM (
@@ -174,9 +285,7 @@ FROM proposal_user pu
   INNER JOIN proposal p on p.id = pu.proposal_id
 WHERE fu.federal_id is not NULL and p.state in ('Open', 'Closed')
 """
-    rs = self.do_query(select, [])
-    logging.getLogger().debug("Proposal - Persons: UAS database returns " + str(len(rs)) + " rows.")
-    return rs
+    return self.extract("Proposal - Persons", 'proposals_have_persons', select, [])
 
 
   def extract_sessions_have_persons(self, greater_than = 100):
@@ -195,52 +304,81 @@ FROM investigation_user iu
 WHERE s.enddate > sysdate - %d AND fu.federal_id is not NULL AND s.state <> 'Cancelled'
 )
 ORDER BY session_id, person_id, rank, "role" """ % (int(greater_than), int(greater_than))
-    rs = self.do_query(select, [])
-    logging.getLogger().debug("Session - Persons: UAS database returns " + str(len(rs)) + " rows.")
-    return rs
+    return self.extract("Session - Persons", 'sessions_have_persons', select, [])
+
+  def retrieve_watermark(self):
+    '''The system change number (SCN) a minute ago. Rows changed since then have a
+    higher ORA_ROWSCN, so the margin errs on the side of re-reading a few rows.'''
+    rs = self.do_query("SELECT timestamp_to_scn(systimestamp - interval '1' minute) FROM dual", [])
+    if rs != None and len(rs) > 0 and rs[0][0] != None:
+        return int(rs[0][0])
+    return None
 
-  def extract_proposals(self):
+  def extract_proposals(self, since=None):
     select = """SELECT lower(p.name), rawtohex(p.id), p.title, p.state
 FROM proposal p
-WHERE p.state in ('Open', 'Closed', 'Cancelled')
+WHERE p.state in ('Open', 'Closed', 'Cancelled')"""
+    params = []
+    if since is not None:
+        select += """ AND p.ora_rowscn > :1"""
+        params = [since]
+    select += """
 ORDER BY p.name""" # p.summary
-    rs = self.do_query(select, [])
-    logging.getLogger().debug("Proposals: UAS database returns " + str(len(rs)) + " rows.")
-    return rs
-
-  def extract_sessions(self):
-    select = """SELECT rawtohex(s.session_id),
-    lower(s.visit_id),
-    lower(s.instrument),
-    s."COMMENT",
-    s.startdate,
-    s.enddate,
-    s.state,
-    substr(rtrim(xmlagg (xmlelement (e, fu.title || ' ' || fu.given_name || ' ' || fu.family_name || ', ')).extract ('//text()'), ', '), 1, 255) beamlineOperator
-FROM shift s
-  LEFT OUTER JOIN local_contact lc on lc.visit_id = s.visit_id
-  LEFT OUTER JOIN facility_user fu on fu.person_id = lc.person_id
-WHERE substr(s.visit_id, 3,1) <> '-'
-GROUP BY rawtohex(s.session_id), lower(s.visit_id), lower(s.instrument), s."COMMENT", s.startdate, s.enddate, s.state"""
-    rs = self.do_query(select, [])
-    logging.getLogger().debug("Sessions: UAS database returns " + str(len(rs)) + " rows.")
-    return rs
+    return self.extract("Proposals", 'proposals' if since is None else None, select, params)
+
+  def extract_sessions(self, since=None, prefixes=None):
+    where, params = _prefix_condition('rawtohex(s.session_id)', prefixes)
+    select = _SELECT_SESSIONS % where
+    if since is not None:
+        # A session changes with its shift, local contacts or their names.
+        # NOTE: removing a local contact doesn't show up here until the next full sync
+        select += """
+HAVING max(greatest(s.ora_rowscn, nvl(lc.ora_rowscn, 0), nvl(fu.ora_rowscn, 0))) > :%d""" % (len(params) + 1)
+        params.append(since)
+    return self.extract("Sessions", 'sessions' if since is None and prefixes is None else None, select, params)
+
+  def iterate_sessions(self):
+    select = _SELECT_SESSIONS % '' + """
+ORDER BY nlssort(rawtohex(s.session_id), 'NLS_SORT=BINARY')"""
+    return self.iterate_query(select, [])
 
   def extract_session_types(self):
     select = """SELECT rawtohex(session_id), tag, visit_id
 FROM investigation_tag it
 ORDER BY session_id"""
-    rs = list(self.do_query(select, []))
-    logging.getLogger().debug("Session types: UAS database returns " + str(len(rs)) + " rows.")
-    return rs
-
-  def extract_persons(self):
-    select = """SELECT rawtohex(person_id), lower(federal_id), title, given_name, family_name
+    return self.extract("Session types", 'session_types', select, [])
+
+  def extract_persons(self, since=None, prefixes=None):
+    where, params = _prefix_condition('rawtohex(person_id)', prefixes)
+    select = _SELECT_PERSONS + where
+    if since is not None:
+        select += """ AND ora_rowscn > :%d""" % (len(params) + 1)
+        params.append(since)
+    return self.extract("Persons", 'persons' if since is None and prefixes is None else None, select, params)
+
+  def iterate_persons(self):
+    select = _SELECT_PERSONS + """
+ORDER BY person_id"""
+    return self.iterate_query(select, [])
+
+  def checksum_sessions(self, prefix_length):
+    select = """SELECT substr(session_id, 1, %d), count(*),
+  sum(to_number(substr(rawtohex(standard_hash(session_id || chr(31) || visit_id || chr(31) || instrument || chr(31) ||
+    to_char(startdate, 'YYYY-MM-DD HH24:MI:SS') || chr(31) || to_char(enddate, 'YYYY-MM-DD HH24:MI:SS') || chr(31) ||
+    beamlineOperator || chr(31) || decode(state, 'Queued', 0, 1), 'MD5')), 1, 8), 'XXXXXXXX'))
+FROM (%s)
+WHERE state is NULL OR state <> 'Cancelled'
+GROUP BY substr(session_id, 1, %d)""" % (int(prefix_length), _SELECT_SESSIONS % '', int(prefix_length))
+    return self.do_query(select, [])
+
+  def checksum_persons(self, prefix_length):
+    select = """SELECT substr(rawtohex(person_id), 1, %d), count(*),
+  sum(to_number(substr(rawtohex(standard_hash(rawtohex(person_id) || chr(31) || lower(federal_id) || chr(31) ||
+    title || chr(31) || given_name || chr(31) || family_name, 'MD5')), 1, 8), 'XXXXXXXX'))
 FROM facility_user
-WHERE federal_id is not NULL"""
-    rs = list(self.do_query(select, []))
-    logging.getLogger().debug("Persons: UAS database returns " + str(len(rs)) + " rows.")
-    return rs
+WHERE federal_id is not NULL
+GROUP BY substr(rawtohex(person_id), 1, %d)""" % (int(prefix_length), int(prefix_length))
+    return self.do_query(select, [])
 
   def extract_components(self):
     # This needs to truncate material to 255 chars
@@ -261,6 +399,43 @@ WHERE
   substr(trim(s.material), 1, 255) is not NULL AND
   substr(LTRIM(REGEXP_REPLACE(s.acronym, '[^[_a-zA-Z0-9-]]*', ''), '-_'), 1, 25) is not NULL"""
 # s.state = 'Accepted' AND
-    rs = list(self.do_query(select, []))
-    logging.getLogger().debug("UAS Components: UAS database returns " + str(len(rs)) + " rows.")
-    return rs
+    return self.extract("UAS Components", 'components', select, [])
+
+def _counted(label, rs):
+  '''Generator passing on the rows of rs, logging how many there were at the end.'''
+  count = 0
+  for row in rs:
+    count += 1
+    yield row
+  logging.getLogger().debug("%s: UAS database returns %d rows.", label, count)
+
+def _prefix_condition(column, prefixes):
+  '''An SQL condition restricting column to the given prefixes, or none, and its parameters.'''
+  if prefixes is None:
+    return ('', [])
+  lengths = set([len(prefix) for prefix in prefixes])
+  if len(lengths) > 1:
+    raise ValueError('Prefixes of different lengths: %s' % ', '.join(prefixes))
+  if not prefixes:
+    return (' AND 1 = 0', [])
+  binds = ', '.join([':%d' % (i + 1) for i in range(len(prefixes))])
+  return (' AND substr(%s, 1, %d) IN (%s)' % (column, lengths.pop(), binds), list(prefixes))
+
+# %s is for extra conditions, see _prefix_condition
+_SELECT_SESSIONS = """SELECT rawtohex(s.session_id) session_id,
+    lower(s.visit_id) visit_id,
+    lower(s.instrument) instrument,
+    s."COMMENT",
+    s.startdate,
+    s.enddate,
+    s.state,
+    substr(rtrim(xmlagg (xmlelement (e, fu.title || ' ' || fu.given_name || ' ' || fu.family_name || ', ')).extract ('//text()'), ', '), 1, 255) beamlineOperator
+FROM shift s
+  LEFT OUTER JOIN local_contact lc on lc.visit_id = s.visit_id
+  LEFT OUTER JOIN facility_user fu on fu.person_id = lc.person_id
+WHERE substr(s.visit_id, 3,1) <> '-'%s
+GROUP BY rawtohex(s.session_id), lower(s.visit_id), lower(s.instrument), s."COMMENT", s.startdate, s.enddate, s.state"""
+
+_SELECT_PERSONS = """SELECT rawtohex(person_id), lower(federal_id), title, given_name, family_name
+FROM facility_user
+WHERE federal_id is not NULL"""
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+
+def _canonical(value):
+  '''Type-tagged bytes for a column value, equal for values that compare equal
+  whichever driver returned them (str or unicode, int or long).'''
+  if value is None:
+    return b'n'
+  if isinstance(value, bytes) and not isinstance(value, str):
+    return b'b' + value
+  if isinstance(value, type(u'')) or isinstance(value, str):
+    if not isinstance(value, type(u'')):
+        value = value.decode('utf-8', 'replace')
+    return b's' + value.encode('utf-8')
+  return b'v' + str(value).encode('utf-8')
+
+def fingerprint(values):
+  '''A 64-bit integer hash of a tuple of column values, stable between processes
+  so that it can be persisted.'''
+  digest = hashlib.md5(b'\x1f'.join([_canonical(v) for v in values])).digest()
+  return struct.unpack('>q', digest[:8])[0]
+
+class FingerprintStore:
+  '''Fingerprints of the source rows as they were when last synced, by entity and
+  source key, kept in one JSON file per entity: path.<entity>. A sync of an entity
+  only reads and writes the file of that entity.
+
+  Source rows whose fingerprint hasn't changed can be left out of the sync. This
+  assumes nothing else changes the synced columns in ISPyB; after full_interval
+  seconds, or when full is set, all fingerprints are ignored once so that such
+  changes get overwritten.'''
+
+  def __init__(self, path, full_interval=86400, full=False):
+    self.path = path
+    self.full_interval = int(full_interval)
+    self.full = full
+    self.lock = threading.Lock()
+    self.entities = {}
+
+  def _file(self, entity):
+    return '%s.%s' % (self.path, entity)
+
+  def _entry(self, entity):
+    '''The fingerprints of entity, read from its file on first use. Called with self.lock held.'''
+    if entity not in self.entities:
+        entry = {'rows': {}}
+        if os.path.exists(self._file(entity)):
+            with open(self._file(entity)) as f:
+                entry = json.load(f)
+        self.entities[entity] = entry
+    return self.entities[entity]
+
+  def known(self, entity, now):
+    '''Return the key -> fingerprint map of entity, or an empty one if it is due a full sync.'''
+    with self.lock:
+        entry = self._entry(entity)
+        if self.full or now - entry.get('full', 0) > self.full_interval:
+            return {}
+        return entry['rows']
+
+  def update(self, entity, rows, full, now):
+    '''Record the fingerprints of rows (a key -> fingerprint map) after a successful
+    sync of entity, replacing them all if the sync was a full one, and write its file.'''
+    with self.lock:
+        entry = self._entry(entity)
+        if full:
+            entry['rows'] = dict(rows)
+            entry['full'] = now
+        else:
+            entry['rows'].update(rows)
+        tmp = self._file(entity) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp, self._file(entity))
@@ -0,0 +1,153 @@
+import contextlib
+import json
+import random
+import re
+import threading
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|%\(\w+\)s|:\w+")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_ROWS = re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+")
+_SPACE = re.compile(r"\s+")
+
+def normalise(querystr):
+  '''Return the SQL text with literals and placeholders replaced by ?, lists of
+  them and multi-row VALUES collapsed, and whitespace squeezed, so that the same
+  statement with different values gives the same text.'''
+  s = _STRING.sub('?', querystr)
+  s = _PLACEHOLDER.sub('?', s)
+  s = _NUMBER.sub('?', s)
+  s = _LIST.sub('(?)', s)
+  s = _ROWS.sub('(?), ...', s)
+  return _SPACE.sub(' ', s).strip()
+
+class _Entry:
+  def __init__(self):
+    self.count = 0
+    self.executions = 0
+    self.total = 0.0
+    self.max = 0.0
+    self.rows = 0
+    self.affected = 0
+    self.samples = []
+
+class QueryStats:
+  '''Instrumentation hook for the connectors, aggregating the statements they run
+  by stage and normalised SQL text.
+
+  Connectors call record() once per round trip; DataSync.run_stage wraps each stage
+  in stage(name). Latency percentiles are computed from a uniform sample of up to
+  max_samples latencies per statement.'''
+
+  def __init__(self, max_samples=2000):
+    self.max_samples = max_samples
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.entries = {}     # (stage, normalised SQL) -> _Entry
+    self.random = random.Random(0)
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    '''Attribute the statements run by this thread to stage name.'''
+    previous = getattr(self.local, 'stage', None)
+    self.local.stage = name
+    try:
+        yield
+    finally:
+        self.local.stage = previous
+
+  def record(self, querystr, seconds, rows=0, affected=0, executions=1):
+    '''Record a statement taking seconds, returning rows and affecting affected rows.
+    executions is the number of parameter sets of an executemany.'''
+    key = (getattr(self.local, 'stage', None) or '', normalise(querystr))
+    with self.lock:
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = _Entry()
+        entry.count += 1
+        entry.executions += executions
+        entry.total += seconds
+        entry.max = max(entry.max, seconds)
+        entry.rows += rows
+        if affected is not None and affected > 0:
+            entry.affected += affected
+        if len(entry.samples) < self.max_samples:
+            entry.samples.append(seconds)
+        else:
+            i = self.random.randint(0, entry.count - 1)
+            if i < self.max_samples:
+                entry.samples[i] = seconds
+
+  def count(self, stage):
+    '''The number of statements recorded for stage.'''
+    with self.lock:
+        return sum(entry.count for ((s, _), entry) in self.entries.items() if s == stage)
+
+  def results(self):
+    '''The statistics as a list of dicts, the statements taking the most time first.'''
+    with self.lock:
+        items = list(self.entries.items())
+    results = []
+    for ((stage, statement), entry) in items:
+        samples = sorted(entry.samples)
+        results.append({'stage': stage,
+                        'statement': statement,
+                        'count': entry.count,
+                        'executions': entry.executions,
+                        'total_s': entry.total,
+                        'mean_s': entry.total / entry.count,
+                        'p50_s': _percentile(samples, 0.5),
+                        'p95_s': _percentile(samples, 0.95),
+                        'p99_s': _percentile(samples, 0.99),
+                        'max_s': entry.max,
+                        'rows': entry.rows,
+                        'affected': entry.affected})
+    results.sort(key=lambda r: r['total_s'], reverse=True)
+    return results
+
+  def summary(self, limit=20, width=80):
+    '''A table of the limit statements taking the most time.'''
+    lines = ['%-22s %8s %9s %9s %9s %9s %9s  %s' % ('stage', 'count', 'total s', 'p50 ms', 'p95 ms', 'rows', 'affected', 'statement')]
+    for r in self.results()[:limit]:
+        statement = r['statement'] if len(r['statement']) <= width else r['statement'][:width - 3] + '...'
+        lines.append('%-22s %8d %9.3f %9.3f %9.3f %9d %9d  %s' % (r['stage'], r['count'], r['total_s'],
+                     r['p50_s'] * 1000, r['p95_s'] * 1000, r['rows'], r['affected'], statement))
+    return '\n'.join(lines)
+
+  def to_json(self):
+    return json.dumps(self.results(), indent=2, sort_keys=True)
+
+  def to_prometheus(self, prefix='datasync_query'):
+    '''The statistics in the Prometheus text exposition format, latencies as a summary.'''
+    lines = ['# HELP %s_seconds Time spent running statements.' % prefix,
+             '# TYPE %s_seconds summary' % prefix]
+    results = self.results()
+    for r in results:
+        labels = 'stage="%s",statement="%s"' % (_escape(r['stage']), _escape(r['statement']))
+        for q in ('0.5', '0.95', '0.99'):
+            lines.append('%s_seconds{%s,quantile="%s"} %r' % (prefix, labels, q, r['p%d_s' % int(float(q) * 100)]))
+        lines.append('%s_seconds_sum{%s} %r' % (prefix, labels, r['total_s']))
+        lines.append('%s_seconds_count{%s} %d' % (prefix, labels, r['count']))
+    for (name, key, help) in (('rows_total', 'rows', 'Rows returned by statements.'),
+                              ('affected_rows_total', 'affected', 'Rows affected by statements.')):
+        lines.append('# HELP %s_%s %s' % (prefix, name, help))
+        lines.append('# TYPE %s_%s counter' % (prefix, name))
+        for r in results:
+            labels = 'stage="%s",statement="%s"' % (_escape(r['stage']), _escape(r['statement']))
+            lines.append('%s_%s{%s} %d' % (prefix, name, labels, r[key]))
+    return '\n'.join(lines) + '\n'
+
+  def save(self, path):
+    '''Write the statistics to path, in Prometheus text format if it ends in .prom,
+    as JSON otherwise.'''
+    with open(path, 'w') as f:
+        f.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+def _percentile(samples, q):
+  if not samples:
+    return 0.0
+  return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+def _escape(value):
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
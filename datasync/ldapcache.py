@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import threading
+import time
+from datasync.ldapdirectory import expand_groups
+
+class LDAPCache:
+  '''LDAP search results kept in a JSON file between runs, by kind ('persons' or
+  'groups') and name, each with the stamp of its entry (see LDAPDirectory) and when
+  it was fetched and last used.
+
+  A result younger than ttl seconds is used as it is. An older one with a stamp is
+  used again if the entry's stamp is still the same, and is otherwise fetched
+  again. Beyond max_entries results of a kind, the least recently used are dropped
+  when the file is written.'''
+
+  def __init__(self, path, ttl=3600, max_entries=10000):
+    self.path = path
+    self.ttl = int(ttl)
+    self.max_entries = int(max_entries)
+    self.lock = threading.Lock()
+    self.kinds = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            self.kinds = json.load(f)
+
+  def lookup(self, kind, name):
+    '''Return the cached entry of name, a dict with 'value', 'stamp', 'time' and 'used', or None.'''
+    with self.lock:
+        return self.kinds.get(kind, {}).get(name)
+
+  def fresh(self, entry, now):
+    return now - entry['time'] < self.ttl
+
+  def used(self, kind, name, now, renew=False):
+    '''Record that the cached result of name was used, and still current if renew is set.'''
+    with self.lock:
+        entry = self.kinds[kind][name]
+        entry['used'] = now
+        if renew:
+            entry['time'] = now
+
+  def put(self, kind, name, value, stamp, now):
+    with self.lock:
+        self.kinds.setdefault(kind, {})[name] = {'value': value, 'stamp': stamp, 'time': now, 'used': now}
+
+  def save(self):
+    '''Drop the least recently used results beyond max_entries and write the file.'''
+    with self.lock:
+        for (kind, entries) in self.kinds.items():
+            if len(entries) > self.max_entries:
+                by_use = sorted(entries.items(), key=lambda item: item[1]['used'], reverse=True)
+                self.kinds[kind] = dict(by_use[:self.max_entries])
+                logging.getLogger().debug("LDAP cache: dropped %d %s", len(entries) - self.max_entries, kind)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.kinds, f)
+        os.rename(tmp, self.path)
+
+class CachedDirectory:
+  '''An LDAPDirectory answering from an LDAPCache where it can: fresh results aren't
+  searched for, stale ones with a stamp only have their stamps fetched and those
+  whose stamp changed are searched for again. The cache is saved on close().'''
+
+  def __init__(self, directory, cache):
+    self.directory = directory
+    self.cache = cache
+    self.group_entries = {}
+
+  def person(self, uid):
+    return self.persons([uid])[uid]
+
+  def persons(self, uids):
+    '''As LDAPDirectory.persons.'''
+    now = time.time()
+    persons, fetch = self._cached('persons', set(uids), self.directory.person_stamps, now, tuple)
+    for (uid, (names, stamp)) in self.directory.stamped_persons(fetch).items():
+        self.cache.put('persons', uid, list(names), stamp, now)
+        persons[uid] = names
+    return persons
+
+  def group_members(self, group_name):
+    '''As LDAPDirectory.group_members.'''
+    return self.expanded_groups([group_name])[group_name]
+
+  def expanded_groups(self, group_names):
+    '''As LDAPDirectory.expanded_groups.'''
+    return expand_groups(self.groups, group_names, self.group_entries)
+
+  def groups(self, group_names):
+    '''As LDAPDirectory.groups.'''
+    now = time.time()
+    groups, fetch = self._cached('groups', set(group_names), self.directory.group_stamps, now,
+                                 lambda value: (set(value[0]), set(value[1])))
+    for (name, ((uids, nested), stamp)) in self.directory.stamped_groups(fetch).items():
+        self.cache.put('groups', name, [sorted(uids), sorted(nested)], stamp, now)
+        groups[name] = (uids, nested)
+    return groups
+
+  def _cached(self, kind, names, fetch_stamps, now, convert):
+    '''Return the results of names answered from the cache, name -> value, and the
+    list of names left to fetch.'''
+    results = {}
+    stale = {}
+    fetch = []
+    for name in names:
+        entry = self.cache.lookup(kind, name)
+        if entry is not None and self.cache.fresh(entry, now):
+            self.cache.used(kind, name, now)
+            results[name] = entry['value']
+        elif entry is not None and entry['stamp'] is not None:
+            stale[name] = entry
+        else:
+            fetch.append(name)
+    if stale:
+        stamps = fetch_stamps(list(stale))
+        for (name, entry) in stale.items():
+            if stamps.get(name) == entry['stamp']:
+                self.cache.used(kind, name, now, renew=True)
+                results[name] = entry['value']
+            else:
+                fetch.append(name)
+    logging.getLogger().debug("LDAP cache: %s: %d cached, %d fetched", kind, len(results), len(fetch))
+    for (name, value) in results.items():
+        results[name] = convert(value)
+    return (results, fetch)
+
+  def close(self):
+    self.cache.save()
+    self.directory.close()
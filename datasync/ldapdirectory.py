@@ -0,0 +1,216 @@
+'''Lookups of staff persons and groups in the LDAP directory, for ldap_groups.py.
+Needs the ldap3 package, the 'ldap' extra of setup.py.'''
+import logging
+import os
+import ldap3
+from ldap3.utils.conv import escape_filter_chars
+from ldap3.utils.dn import parse_dn
+
+# Where ldapsearch finds the server and base DN when they aren't configured
+LDAP_CONF_FILES = ['/etc/openldap/ldap.conf', '/etc/ldap/ldap.conf']
+
+DEFAULT_BASE = 'dc=diamond,dc=ac,dc=uk'
+
+# Number of uids ORed into the filter of one person search
+PERSON_CHUNK_SIZE = 200
+
+# Operational attributes that change whenever an entry does: entryCSN where the
+# directory keeps one (OpenLDAP), otherwise modifyTimestamp
+_STAMPS = ['entryCSN', 'modifyTimestamp']
+
+# Attributes listing the members of a group, by uid or by DN
+_MEMBERS = ['memberUid', 'member', 'uniqueMember']
+
+_PERSON = '(objectClass=person)'
+_GROUP = '(|(objectClass=posixGroup)(objectClass=groupOfNames)(objectClass=groupOfUniqueNames))'
+
+_NO_SUCH_OBJECT = 32
+
+class LDAPDirectory:
+  '''One LDAP connection, bound once and reused for all the searches of a run.
+
+  server is an LDAP URI, e.g. ldaps://ldap.example.com; with neither server nor
+  base given they are read from the URI and BASE settings of ldap.conf, as
+  ldapsearch does. The bind is anonymous unless user is given. Search results come
+  back as dicts of attribute name -> list of values.
+
+  A group's members are its memberUids and, for groups listing members by DN
+  (member or uniqueMember), the uids of those DNs; DNs named by a cn are nested
+  groups, whose members are members too. The direct members of each group are
+  fetched once per directory.'''
+
+  def __init__(self, server=None, base=None, people_base=None, user=None, pw=None, connection=None):
+    if server is None or base is None:
+        conf = _read_ldap_conf()
+        server = server or conf.get('URI', '').split(' ')[0] or None
+        base = base or conf.get('BASE') or DEFAULT_BASE
+    self.server = server
+    self.base = base
+    self.people_base = people_base or 'ou=People,%s' % base
+    self.user = user
+    self.pw = pw
+    self.conn = connection
+    self.group_entries = {}
+
+  @classmethod
+  def stand_in(cls, entries, base=DEFAULT_BASE, people_base=None):
+    '''Return a directory answering from entries, a dict of DN -> attributes, instead
+    of a server - ldap3's mock strategy, for tests.'''
+    conn = ldap3.Connection(ldap3.Server('stand-in'), client_strategy=ldap3.MOCK_SYNC)
+    for (dn, attributes) in entries.items():
+        conn.strategy.add_entry(dn, attributes)
+    conn.bind()
+    return cls(server='stand-in', base=base, people_base=people_base, connection=conn)
+
+  def connect(self):
+    if self.conn is None:
+        if self.server is None:
+            raise AttributeError('No LDAP server configured or found in %s' % ' or '.join(LDAP_CONF_FILES))
+        self.conn = ldap3.Connection(ldap3.Server(self.server), user=self.user, password=self.pw,
+                                     read_only=True, auto_bind=True)
+        logging.getLogger().info("Connected to LDAP server %s", self.server)
+    return self.conn
+
+  def close(self):
+    if self.conn is not None:
+        self.conn.unbind()
+        self.conn = None
+
+  def search(self, base, search_filter, attributes):
+    '''Return the (DN, attributes) of the entries under base matching search_filter.'''
+    conn = self.connect()
+    if not conn.search(base, search_filter, search_scope=ldap3.SUBTREE, attributes=attributes):
+        if conn.result['result'] not in (0, _NO_SUCH_OBJECT):
+            raise RuntimeError('LDAP search %s under %s failed: %s' % (search_filter, base, conn.result['description']))
+        return []
+    return [(r['dn'], _values(r['attributes'])) for r in conn.response if r.get('type') == 'searchResEntry']
+
+  def person(self, uid):
+    '''Return the (surname, given name) of the person with login uid, or (None, None).'''
+    return self.persons([uid])[uid]
+
+  def persons(self, uids, chunk_size=PERSON_CHUNK_SIZE):
+    '''Return a dict of uid -> (surname, given name), or (None, None), for the distinct
+    uids, searching for chunk_size of them at a time.'''
+    return dict((uid, names) for (uid, (names, stamp)) in self.stamped_persons(uids, chunk_size).items())
+
+  def stamped_persons(self, uids, chunk_size=PERSON_CHUNK_SIZE):
+    '''As persons, with the stamp of each person's entry: uid -> ((surname, given name), stamp).'''
+    found = self._find(self.people_base, _PERSON, 'uid', uids, ['sn', 'givenName'] + _STAMPS, chunk_size)
+    persons = {}
+    for uid in set(uids):
+        entries = found.get(uid.lower(), [])
+        if len(entries) == 1:
+            persons[uid] = ((_single(entries[0].get('sn')), _single(entries[0].get('givenName'))), _stamp(entries[0]))
+        else:
+            persons[uid] = ((None, None), None)
+    return persons
+
+  def person_stamps(self, uids, chunk_size=PERSON_CHUNK_SIZE):
+    '''Return a dict of uid -> stamp, only fetching the stamps of the entries. uids
+    without an entry, or with several, are left out.'''
+    found = self._find(self.people_base, _PERSON, 'uid', uids, _STAMPS, chunk_size)
+    return dict((uid, _stamp(found[uid.lower()][0])) for uid in set(uids) if len(found.get(uid.lower(), [])) == 1)
+
+  def group_members(self, group_name):
+    '''Return the set of uids of the members of group group_name, nested groups included.'''
+    return self.expanded_groups([group_name])[group_name]
+
+  def expanded_groups(self, group_names):
+    '''Return a dict of group name -> set of uids of its members, nested groups included.'''
+    return expand_groups(self.groups, group_names, self.group_entries)
+
+  def groups(self, group_names):
+    '''Return a dict of group name -> (set of member uids, set of nested group names).'''
+    return dict((name, members) for (name, (members, stamp)) in self.stamped_groups(group_names).items())
+
+  def stamped_groups(self, group_names):
+    '''As groups, with the stamp of each group's entry (None if there are several).'''
+    found = self._find(self.base, _GROUP, 'cn', group_names, _MEMBERS + _STAMPS)
+    groups = {}
+    for name in set(group_names):
+        entries = found.get(name.lower(), [])
+        uids = set()
+        nested = set()
+        for attributes in entries:
+            uids.update(attributes.get('memberUid', []))
+            for dn in attributes.get('member', []) + attributes.get('uniqueMember', []):
+                (attribute, value, separator) = parse_dn(dn)[0]
+                if attribute.lower() == 'uid':
+                    uids.add(value)
+                elif attribute.lower() == 'cn':
+                    nested.add(value)
+        groups[name] = ((uids, nested), _stamp(entries[0]) if len(entries) == 1 else None)
+    return groups
+
+  def group_stamps(self, group_names):
+    '''Return a dict of group name -> stamp, only fetching the stamps of the entries.'''
+    found = self._find(self.base, _GROUP, 'cn', group_names, _STAMPS)
+    return dict((name, _stamp(found[name.lower()][0])) for name in set(group_names) if len(found.get(name.lower(), [])) == 1)
+
+  def _find(self, base, class_filter, naming_attribute, names, attributes, chunk_size=PERSON_CHUNK_SIZE):
+    '''Return a dict of lower case name -> attributes of the entries matching class_filter
+    whose naming_attribute is one of names, ORing chunk_size names into each filter.'''
+    names = sorted(set(names))
+    found = {}
+    for i in range(0, len(names), chunk_size):
+        chunk = names[i:i + chunk_size]
+        search_filter = '(&%s(|%s))' % (class_filter,
+            ''.join(['(%s=%s)' % (naming_attribute, escape_filter_chars(name)) for name in chunk]))
+        for (dn, entry) in self.search(base, search_filter, [naming_attribute] + attributes):
+            # names match whatever their case
+            for name in set([name.lower() for name in entry.get(naming_attribute, [])]):
+                found.setdefault(name, []).append(entry)
+    return found
+
+def expand_groups(fetch, group_names, entries):
+  '''Return a dict of group name -> set of uids of the members of the groups
+  group_names, nested groups included.
+
+  fetch(names) returns a dict of name -> (member uids, nested group names) and is
+  called once per level of nesting, for the groups not in entries yet. entries
+  holds the groups fetched so far, and is added to.'''
+  pending = set([name for name in group_names if name not in entries])
+  while pending:
+    entries.update(fetch(sorted(pending)))
+    pending = set([nested for name in pending for nested in entries[name][1] if nested not in entries])
+  expanded = {}
+  for name in group_names:
+    # the groups reachable from name, once each however they are nested
+    reached = set([name])
+    stack = [name]
+    while stack:
+        for nested in entries[stack.pop()][1]:
+            if nested not in reached:
+                reached.add(nested)
+                stack.append(nested)
+    expanded[name] = set()
+    for group in reached:
+        expanded[name].update(entries[group][0])
+  return expanded
+
+def _values(attributes):
+  # single-valued attributes of a schema come back as the value itself
+  return dict((name, value if isinstance(value, list) else [value]) for (name, value) in attributes.items())
+
+def _single(values):
+  return values[0] if values and len(values) == 1 else None
+
+def _stamp(attributes):
+  for name in _STAMPS:
+    value = _single(attributes.get(name))
+    if value is not None:
+        return str(value)
+  return None
+
+def _read_ldap_conf():
+  conf = {}
+  for path in LDAP_CONF_FILES:
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                parts = line.strip().split(None, 1)
+                if len(parts) == 2 and not parts[0].startswith('#'):
+                    conf.setdefault(parts[0].upper(), parts[1])
+        break
+  return conf
@@ -4,6 +4,35 @@ from logging.handlers import RotatingFileHandler
 import sys
 import os
 import time
+import copy
+from operator import attrgetter, itemgetter
+from datasync.reconcile import reconcile, merge_reconcile, INSERT, UPDATE, DELETE, UNCHANGED
+from datasync.watermark import WatermarkStore
+from datasync.scheduler import StageScheduler
+from datasync.instrument import QueryStats
+from datasync.sampledlog import SampledLog
+from datasync.fingerprint import fingerprint, FingerprintStore
+from datasync.checksum import differing_ranges
+from datasync import rows
+
+RECONCILE_MODES = ('hash', 'merge', 'range')
+
+TARGET_MODES = ('rows', 'staged')
+
+# Number of leading hex digits of the GUIDs that define a range in 'range' mode
+RANGE_PREFIX_LENGTH = 2
+
+# Sync stages and the stages they depend on, see DataSync.sync_all. sessions inserts the
+# persons of new sessions missing from Person, so it comes after persons rather than racing it.
+SYNC_STAGES = [
+  ('proposals', []),
+  ('persons', []),
+  ('sessions', ['proposals', 'persons']),
+  ('components', ['proposals']),
+  ('session_types', ['sessions']),
+  ('proposals_have_persons', ['proposals', 'persons']),
+  ('sessions_have_persons', ['sessions', 'persons']),
+]
 
 class DataSync:
   def __init__(self, conf_file = None):
@@ -12,14 +41,41 @@ class DataSync:
         Arguments:
              -h|--help : display this help
              -c|--conf <conf file> : use the given configuration file
-             -l|--log <log file>: use the given log file""" % sys.argv[0])
+             -l|--log <log file>: use the given log file
+             -v|--log-level <level>: DEBUG (default) logs every statement, INFO one summary line per stage
+             -m|--mode <hash|merge|range>: how persons and sessions are reconciled
+             -t|--target-mode <rows|staged>: apply the changes row by row (default), or load the source rows into
+                 staging tables and apply them with set-based statements
+             -w|--watermarks <file>: sync persons, proposals and sessions incrementally, keeping high-water marks in the given file
+             -p|--fingerprints <file>: skip the persons, proposals and sessions unchanged since they were last synced, keeping their fingerprints in <file>.persons, <file>.proposals and <file>.sessions
+             -f|--full: with -w or -p, do a full sync now rather than when the last one is too old
+             -j|--workers <n>: number of stages sync_all runs at the same time
+             -P|--pipelined: run sync_all with the reads of each stage overlapped and its writes pipelined
+             -q|--query-stats <file>: aggregate statistics of the statements run, print a summary at
+                 the end and save them to the given file (Prometheus text format if it ends in .prom, JSON otherwise)""" % sys.argv[0])
 
     self.conf_file = conf_file
     self.log_file = None
+    self.log_level = 'DEBUG'
+    self.reconcile_mode = 'hash'
+    self.target_mode = 'rows'
+    self.watermarks = None
+    self.fingerprints = None
+    self.source_factory = None
+    self.target_factory = None
+    self.workers = 4
+    self.engine = 'threads'
+    self.query_stats = None
+    self.query_stats_file = None
+    self.action_counts = {}
+    self.sampled_log = SampledLog()
+    watermark_file = None
+    fingerprint_file = None
+    full = False
 
     # Get command-line arguments
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], "hc:l:", ["help", "conf", "log"])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], "hc:l:v:m:t:w:p:fj:Pq:", ["help", "conf", "log", "log-level=", "mode=", "target-mode=", "watermarks=", "fingerprints=", "full", "workers=", "pipelined", "query-stats="])
     except getopt.GetoptError:
         print_usage(usage)
         sys.exit(2)
@@ -32,6 +88,30 @@ class DataSync:
             self.conf_file = a
         elif o in ("-l", "--log"):
             self.log_file = a
+        elif o in ("-v", "--log-level"):
+            self.log_level = a.upper()
+        elif o in ("-m", "--mode"):
+            self.set_reconcile_mode(a)
+        elif o in ("-t", "--target-mode"):
+            self.set_target_mode(a)
+        elif o in ("-w", "--watermarks"):
+            watermark_file = a
+        elif o in ("-p", "--fingerprints"):
+            fingerprint_file = a
+        elif o in ("-f", "--full"):
+            full = True
+        elif o in ("-j", "--workers"):
+            self.workers = int(a)
+        elif o in ("-P", "--pipelined"):
+            self.engine = 'pipelined'
+        elif o in ("-q", "--query-stats"):
+            self.query_stats_file = a
+            self.set_query_stats(QueryStats())
+
+    if watermark_file is not None:
+        self.set_watermarks(watermark_file, full=full)
+    if fingerprint_file is not None:
+        self.set_fingerprints(fingerprint_file, full=full)
 
     # Read the config file
     if self.conf_file is None:
@@ -47,14 +127,14 @@ class DataSync:
     stem = os.path.splitext(os.path.basename(sys.argv[0]))[0]
     self.pidfile = "/tmp/%s.pid" % stem
     if os.path.isfile(self.pidfile):
-        logging.getLogger().error("%s already exists, exiting" % self.pidfile)
+        logging.getLogger().error("%s already exists, exiting", self.pidfile)
         sys.exit()
     else:
         file(self.pidfile, 'w').write(pid)
 
     if self.conf_file is not None:
         self.logger = logging.getLogger()
-        self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(getattr(logging, self.log_level))
         formatter = logging.Formatter('* %(asctime)s [id=%(thread)d] <%(levelname)s> %(message)s')
         hdlr = RotatingFileHandler(filename=self.log_file, maxBytes=1000000, backupCount=30)
         hdlr.setFormatter(formatter)
@@ -67,9 +147,13 @@ class DataSync:
         raise Exception
 
   def __exit__(self, type, value, traceback):
+    if self.query_stats is not None:
+        print(self.query_stats.summary())
+        if self.query_stats_file is not None:
+            self.query_stats.save(self.query_stats_file)
     os.unlink(self.pidfile)
     self.pidfile = None
-    logging.getLogger().info("%s: exiting class  :-(" % sys.argv[0])
+    logging.getLogger().info("%s: exiting class  :-(", sys.argv[0])
     logging.shutdown()
     self.logger = None
 
@@ -78,9 +162,182 @@ class DataSync:
 
   def set_source(self, source_conn):
       self.source_conn = source_conn
+      if self.query_stats is not None:
+          source_conn.set_instrument(self.query_stats)
 
   def set_target(self, target_conn):
       self.target_conn = target_conn
+      if self.query_stats is not None:
+          target_conn.set_instrument(self.query_stats)
+
+  def set_query_stats(self, query_stats):
+      '''Aggregate the statements the connections run, by stage, in a
+      datasync.instrument.QueryStats.'''
+      self.query_stats = query_stats
+      for conn in (getattr(self, 'source_conn', None), getattr(self, 'target_conn', None)):
+          if conn is not None:
+              conn.set_instrument(query_stats)
+
+  def set_connection_factories(self, source_factory, target_factory):
+      '''Functions returning new source and target connections, for sync_all's workers.'''
+      self.source_factory = source_factory
+      self.target_factory = target_factory
+
+  def set_reconcile_mode(self, mode):
+      ''''hash' indexes the ISPyB rows in memory, 'merge' streams both sides
+      sorted on externalId and merge-joins them, 'range' compares checksums of
+      externalId ranges and only reads the rows of the ranges that differ
+      (merge and range apply to persons and sessions only).'''
+      if mode not in RECONCILE_MODES:
+          raise ValueError('Unknown reconcile mode %s' % mode)
+      self.reconcile_mode = mode
+
+  def set_target_mode(self, mode):
+      ''''rows' reconciles the source rows with the target rows here and applies the
+      changes one by one, 'staged' hands the source rows to the target's merge_<entity>
+      methods, which load them into staging tables and apply them with set-based
+      statements (components are always applied row by row).'''
+      if mode not in TARGET_MODES:
+          raise ValueError('Unknown target mode %s' % mode)
+      self.target_mode = mode
+
+  def _merge(self, entity, uas_rs, *args):
+      '''Apply uas_rs with the target's merge_<entity>, counting what it did for run_stage's summary.
+      Returns the GUIDs of the rows that weren't applied.'''
+      inserted, updated, deleted, unapplied = getattr(self.target_conn, 'merge_' + entity)(uas_rs, *args)
+      counts = self.action_counts
+      for (action, n) in ((INSERT, inserted), (UPDATE, updated), (DELETE, deleted)):
+          counts[action] = counts.get(action, 0) + n
+      return unapplied
+
+  def set_watermarks(self, path, full_interval=86400, full=False):
+      '''Extract only the persons, proposals and sessions changed in the source since the
+      last successful sync, with a full sync at least every full_interval seconds.'''
+      self.watermarks = WatermarkStore(path, full_interval, full)
+
+  def _watermark_since(self, entity):
+      '''Return the mark to extract changes of entity from (None for a full sync), and
+      the source's current mark, to be recorded once the sync has succeeded.'''
+      if self.watermarks is None:
+          return (None, None)
+      mark = self.source_conn.retrieve_watermark()
+      if mark is None:
+          return (None, None)
+      return (self.watermarks.since(entity), mark)
+
+  def _watermark_done(self, entity, since, mark):
+      if mark is not None:
+          self.watermarks.update(entity, mark, since is None)
+
+  def set_fingerprints(self, path, full_interval=86400, full=False):
+      '''Leave out of the sync the persons, proposals and sessions whose fingerprint is
+      the same as when they were last synced, with a full sync at least every
+      full_interval seconds.'''
+      self.fingerprints = FingerprintStore(path, full_interval, full)
+
+  def _skip_unchanged(self, entity, uas_rs, source_key, source_fingerprint):
+      '''Return the source rows whose fingerprint isn't the one recorded for them, and
+      what to record once the sync has succeeded.'''
+      if self.fingerprints is None:
+          return (uas_rs, None)
+      now = time.time()
+      known = self.fingerprints.known(entity, now)
+      rows = {}
+      changed = []
+      for row in uas_rs:
+          key = source_key(row)
+          rows[key] = source_fingerprint(row)
+          if known.get(key) != rows[key]:
+              changed.append(row)
+      return (changed, (rows, not known, now))
+
+  def _changed_ranges(self, entity):
+      '''In 'range' mode, return the GUID prefixes of the ranges of entity whose checksums
+      differ between source and target; otherwise None, meaning all rows.'''
+      if self.reconcile_mode != 'range':
+          return None
+      source_sums = getattr(self.source_conn, 'checksum_' + entity)(RANGE_PREFIX_LENGTH)
+      target_sums = getattr(self.target_conn, 'checksum_' + entity)(RANGE_PREFIX_LENGTH)
+      prefixes = differing_ranges(source_sums, target_sums)
+      logging.getLogger().debug("%s: %d of %d ranges differ", entity, len(prefixes), 16 ** RANGE_PREFIX_LENGTH)
+      return prefixes
+
+  def _fingerprints_done(self, entity, pending, unapplied=()):
+      '''Record the fingerprints of the rows synced, but those of the rows that weren't
+      applied (e.g. sessions of proposals not in ISPyB yet), so that they are tried again.'''
+      if pending is not None:
+          self.fingerprints.update(entity, _without_keys(pending[0], unapplied), *pending[1:])
+
+  def sync_all(self, workers=None):
+    '''Run all the sync stages, each as soon as the stages it depends on are done.
+    Independent stages run at the same time on up to workers threads, each thread
+    with its own source and target connections.'''
+    if workers is None:
+        workers = self.workers
+    if self.engine == 'pipelined':
+        import datasync.pipeline
+        datasync.pipeline.sync_all(self, workers)
+        return
+    if workers <= 1 or self.source_factory is None or self.target_factory is None:
+        for (name, deps) in SYNC_STAGES:
+            self.run_stage(name)
+        return
+    failed = StageScheduler(SYNC_STAGES, self._open_worker, workers).run()
+    if failed:
+        raise RuntimeError('Sync stages failed or were skipped: %s' % ', '.join(failed))
+
+  def _open_worker(self):
+    worker = copy.copy(self)
+    # counters of its own; the watermark and fingerprint stores and query_stats it shares are locked
+    worker.action_counts = {}
+    worker.sampled_log = SampledLog()
+    worker.set_source(self.source_factory())
+    worker.set_target(self.target_factory())
+    return worker
+
+  def run_stage(self, name):
+    '''Run the sync_<name> stage and log a one-line summary of what it did.'''
+    start = self._begin_stage()
+    try:
+        if self.query_stats is None:
+            getattr(self, 'sync_' + name)()
+        else:
+            with self.query_stats.stage(name):
+                getattr(self, 'sync_' + name)()
+    except:
+        # leave the target as it was at the last commit, unless autocommitting
+        self.target_conn.rollback()
+        raise
+    self._end_stage(name, start)
+
+  def _begin_stage(self):
+    self.target_conn.begin_stage()
+    self.action_counts = {}
+    self.sampled_log = SampledLog()
+    return time.time()
+
+  def _end_stage(self, name, start):
+    self.sampled_log.summary(prefix='%s: ' % name)
+    log = logging.getLogger()
+    if log.isEnabledFor(logging.INFO):
+        counts = self.action_counts
+        statements = ''
+        if self.query_stats is not None:
+            statements = ' statements=%d' % self.query_stats.count(name)
+        log.info("stage=%s seconds=%.3f inserted=%d updated=%d deleted=%d unchanged=%d%s", name, time.time() - start,
+                 counts.get(INSERT, 0), counts.get(UPDATE, 0), counts.get(DELETE, 0), counts.get(UNCHANGED, 0), statements)
+
+  def _counted(self, actions):
+    '''Pass reconcile actions through, counting them by kind for run_stage's summary.'''
+    counts = self.action_counts
+    for action in actions:
+        counts[action[0]] = counts.get(action[0], 0) + 1
+        yield action
+
+  def close(self):
+    '''Release the connections of a sync_all worker.'''
+    self.source_conn.disconnect()
+    self.target_conn.disconnect()
 
   def sync_proposals(self):
     ''' Proposal state - from Sam Hough:
@@ -101,178 +358,316 @@ class DataSync:
     /** Proposal state: cancelled - final read only state. */
     public static final String STATE_CANCELLED = "Cancelled";
 '''
-    uas_rs = self.source_conn.extract_proposals()
-    ispyb_rs = self.target_conn.extract_proposals()
-
-    for uas_row in uas_rs:
-        print(uas_row)
-        for ispyb_row in ispyb_rs:
-            print(ispyb_row)
-
-            if (uas_row[1] == ispyb_row[1]) or (uas_row[0] == ispyb_row[0]): # UAS GUID vs ISPyB externalId OR UAS proposal name vs ISPyB proposal
-
-                if uas_row[3] == 'Cancelled':
-                    self.target_conn.delete_proposal(ispyb_row[3]) # ispyb_row[3] is the ISPyB proposalId
-                    break
-                if uas_row[0][0:2] != ispyb_row[0][0:2]: # UAS proposal code vs ISPyB proposal code
-                    self.target_conn.update_proposal_code(uas_row[0][0:2], ispyb_row[3])
-                if uas_row[2] != ispyb_row[2] or uas_row[1] != ispyb_row[1]: # UAS title vs ISPyB title OR UAS GUID vs ISPyB externalId
-                    self.target_conn.update_proposal(uas_row[2], uas_row[1], ispyb_row[3])
-                break
-        else:
-            if uas_row[3] != 'Cancelled':
-                self.target_conn.insert_proposal(uas_row[0], uas_row[2], uas_row[1])
-
+    since, mark = self._watermark_since('proposals')
+    strings = {}
+    uas_rs = rows.compact(self.source_conn.extract_proposals(since=since), rows.UASProposal, strings)
+    uas_rs, fingerprints = self._skip_unchanged('proposals', uas_rs, attrgetter('guid'), _proposal_fingerprint)
+    unapplied = []
+    if len(uas_rs) > 0 and self.target_mode == 'staged':
+        unapplied = self._merge('proposals', uas_rs)
+    elif len(uas_rs) > 0:
+        ispyb_rs = rows.compact(self.target_conn.extract_proposals(), rows.ISPyBProposal, strings)
+
+        for action in self._counted(reconcile(uas_rs, ispyb_rs, _PROPOSAL_KEYS, changed=_proposal_changed, deleted=_proposal_deleted)):
+            if not self._apply_proposal(*action):
+                unapplied.append(action[1].guid)
+        self.target_conn.commit()
+    self._watermark_done('proposals', since, mark)
+    self._fingerprints_done('proposals', fingerprints, unapplied)
+
+  def _apply_proposal(self, action, uas_row, ispyb_row):
+    '''Apply a reconcile action, returning False if it was an insert that didn't insert anything.'''
+    if action == DELETE:
+        self.target_conn.delete_proposal(ispyb_row.proposal_id)
+    elif action == UPDATE:
+        if uas_row.name[0:2] != ispyb_row.name[0:2]: # proposal codes
+            self.target_conn.update_proposal_code(uas_row.name[0:2], ispyb_row.proposal_id)
+        if uas_row.title != ispyb_row.title or uas_row.guid != ispyb_row.external_id:
+            self.target_conn.update_proposal(uas_row.title, uas_row.guid, ispyb_row.proposal_id)
+    elif action == INSERT:
+        return bool(self.target_conn.insert_proposal(uas_row.name, uas_row.title, uas_row.guid))
+    return True
 
   def sync_sessions(self):
-    uas_rs = self.source_conn.extract_sessions()
-    ispyb_rs = self.target_conn.extract_sessions()
-
-    for uas_row in uas_rs:
-        scheduled = 1
-        if uas_row[6] == 'Queued':
-            scheduled = 0
-        for ispyb_row in ispyb_rs:
-            if (uas_row[0] == ispyb_row[0]) or (uas_row[1] == ispyb_row[1]): # UAS GUID, ISPyB externalId
-                if uas_row[6] == 'Cancelled':
-                    self.target_conn.delete_session(ispyb_row[6])
-                # NOTE: deliberately not comparing comments, as they may have changed in ISPyB and we don't want to overwrite
-                elif uas_row[0] != ispyb_row[0] or uas_row[1] != ispyb_row[1] or uas_row[2] != ispyb_row[2] or uas_row[4] != ispyb_row[4] or uas_row[5] != ispyb_row[5] or uas_row[7] != ispyb_row[7] or ispyb_row[8] != scheduled:
-                    self.target_conn.update_session(uas_row[0], uas_row[2], uas_row[4], uas_row[5], uas_row[7], scheduled, ispyb_row[6])
-                break
+    since, mark = self._watermark_since('sessions')
+    fingerprints = None
+    unapplied = []
+    strings = {}
+    if since is None and self.reconcile_mode == 'merge' and self.target_mode == 'rows':
+        actions = merge_reconcile(rows.records(self.source_conn.iterate_sessions(), rows.UASSession),
+                                  rows.records(self.target_conn.iterate_sessions(), rows.ISPyBSession),
+                                  _SESSION_KEYS, changed=_session_changed, deleted=_session_deleted)
+    else:
+        prefixes = self._changed_ranges('sessions') if since is None else None
+        if prefixes is None:
+            uas_rs = rows.compact(self.source_conn.extract_sessions(since=since), rows.UASSession, strings)
+            uas_rs, fingerprints = self._skip_unchanged('sessions', uas_rs, attrgetter('guid'), _session_fingerprint)
         else:
-            if uas_row[6] != 'Cancelled':
-                person_rs = self.source_conn.retrieve_persons_for_session(uas_row[0])
-                self.target_conn.insert_session(uas_row[0], uas_row[2], uas_row[3], uas_row[4], uas_row[5], uas_row[1], uas_row[7], scheduled, person_rs)
+            uas_rs = rows.compact(self.source_conn.extract_sessions(prefixes=prefixes) if prefixes else [], rows.UASSession, strings)
+        if len(uas_rs) == 0:
+            actions = []
+        elif self.target_mode == 'staged':
+            unapplied = self._merge('sessions', uas_rs, self.source_conn.retrieve_persons_for_session)
+            actions = []
+        else:
+            visits = None if prefixes is None else [row.visit for row in uas_rs]
+            ispyb_rs = rows.compact(self.target_conn.extract_sessions(prefixes=prefixes, visits=visits), rows.ISPyBSession, strings)
+            actions = reconcile(uas_rs, ispyb_rs, _SESSION_KEYS, changed=_session_changed, deleted=_session_deleted)
+
+    # Cancelled sessions are deleted together, so that they are checked for data in bulk
+    cancelled = []
+    for action in self._counted(actions):
+        if action[0] == DELETE:
+            cancelled.append(action[2].session_id)
+        elif not self._apply_session(*action):
+            unapplied.append(action[1].guid)
+    if cancelled:
+        self.target_conn.delete_sessions(cancelled)
+    self.target_conn.commit()
+    self._watermark_done('sessions', since, mark)
+    self._fingerprints_done('sessions', fingerprints, unapplied)
+
+  def _apply_session(self, action, uas_row, ispyb_row):
+    '''As _apply_proposal.'''
+    if action == DELETE:
+        self.target_conn.delete_session(ispyb_row.session_id)
+    elif action == UPDATE:
+        self.target_conn.update_session(uas_row.guid, uas_row.beamline, uas_row.start_date, uas_row.end_date, uas_row.operators,
+                                        _session_scheduled(uas_row), ispyb_row.session_id)
+    elif action == INSERT:
+        person_rs = self.source_conn.retrieve_persons_for_session(uas_row.guid)
+        return bool(self.target_conn.insert_session(uas_row.guid, uas_row.beamline, uas_row.comments, uas_row.start_date,
+                                                    uas_row.end_date, uas_row.visit, uas_row.operators,
+                                                    _session_scheduled(uas_row), person_rs))
+    return True
 
   def sync_session_types(self):
-    uas_rs = self.source_conn.extract_session_types()
-    ispyb_rs = self.target_conn.extract_session_types()
+    strings = {}
+    uas_rs = rows.compact(self.source_conn.extract_session_types(), rows.UASSessionType, strings)
+    if self.target_mode == 'staged':
+        self._merge('session_types', uas_rs)
+    else:
+        ispyb_rs = rows.compact(self.target_conn.extract_session_types(), rows.ISPyBSessionType, strings)
+        for action in self._counted(reconcile(uas_rs, ispyb_rs, _SESSION_TYPE_KEYS, changed=_never_changed)):
+            self._apply_session_type(*action)
+    self.target_conn.commit()
 
-    for uas_row in uas_rs:
-        for ispyb_row in ispyb_rs:
-            if uas_row[0] == ispyb_row[0] and uas_row[1] == ispyb_row[1]:
-                break
-        else:
-            self.target_conn.insert_session_type(uas_row[0], uas_row[1], uas_row[2])
+  def _apply_session_type(self, action, uas_row, ispyb_row):
+    if action == INSERT:
+        self.target_conn.insert_session_type(uas_row.guid, uas_row.tag, uas_row.visit)
 
   def sync_persons(self):
-    uas_rs = self.source_conn.extract_persons()
-    ispyb_rs = self.target_conn.extract_persons()
-
-    for uas_row in uas_rs:
-        for ispyb_row in ispyb_rs:
-            if (uas_row[0] == ispyb_row[0]) or (uas_row[1] == ispyb_row[1]): # UAS GUID, ISPyB externalId
-
-                if uas_row[0] != ispyb_row[0] or uas_row[1] != ispyb_row[1] or uas_row[2] != ispyb_row[2] or uas_row[3] != ispyb_row[3] or uas_row[4] != ispyb_row[4]:
-                    self.target_conn.update_person(uas_row[0], uas_row[1], uas_row[2], uas_row[3], uas_row[4], ispyb_row[5])
-                break
+    since, mark = self._watermark_since('persons')
+    fingerprints = None
+    unapplied = []
+    strings = {}
+    if since is None and self.reconcile_mode == 'merge' and self.target_mode == 'rows':
+        actions = merge_reconcile(rows.records(self.source_conn.iterate_persons(), rows.UASPerson),
+                                  rows.records(self.target_conn.iterate_persons(), rows.ISPyBPerson),
+                                  _PERSON_KEYS, changed=_person_changed)
+    else:
+        prefixes = self._changed_ranges('persons') if since is None else None
+        if prefixes is None:
+            uas_rs = rows.compact(self.source_conn.extract_persons(since=since), rows.UASPerson, strings)
+            uas_rs, fingerprints = self._skip_unchanged('persons', uas_rs, attrgetter('guid'), _person_fingerprint)
+        else:
+            uas_rs = rows.compact(self.source_conn.extract_persons(prefixes=prefixes) if prefixes else [], rows.UASPerson, strings)
+        if len(uas_rs) == 0:
+            actions = []
+        elif self.target_mode == 'staged':
+            unapplied = self._merge('persons', uas_rs)
+            actions = []
         else:
-            uas_sessions_rs = self.source_conn.retrieve_sessions_for_person(uas_row[0])
-            self.target_conn.insert_person(uas_row[0], uas_row[1], uas_row[2], uas_row[3], uas_row[4], uas_sessions_rs)
+            logins = None if prefixes is None else [row.login for row in uas_rs]
+            ispyb_rs = rows.compact(self.target_conn.extract_persons(prefixes=prefixes, logins=logins), rows.ISPyBPerson, strings)
+            actions = reconcile(uas_rs, ispyb_rs, _PERSON_KEYS, changed=_person_changed)
+
+    for action in self._counted(actions):
+        if not self._apply_person(*action):
+            unapplied.append(action[1].guid)
+    self.target_conn.commit()
+    self._watermark_done('persons', since, mark)
+    self._fingerprints_done('persons', fingerprints, unapplied)
+
+  def _apply_person(self, action, uas_row, ispyb_row):
+    '''As _apply_proposal.'''
+    if action == UPDATE:
+        self.target_conn.update_person(uas_row.guid, uas_row.login, uas_row.title, uas_row.given_name, uas_row.family_name,
+                                       ispyb_row.person_id)
+    elif action == INSERT:
+        uas_sessions_rs = self.source_conn.retrieve_sessions_for_person(uas_row.guid)
+        return bool(self.target_conn.insert_person(uas_row.guid, uas_row.login, uas_row.title, uas_row.given_name,
+                                                   uas_row.family_name, uas_sessions_rs))
+    return True
 
 
   def sync_components(self):
-    uas_rs = self.source_conn.extract_components()
-    ispyb_rs = self.target_conn.extract_components()
-
-    # 0 - UAS protein ID
-    # 1 - UAS proposal ID
-    # 2 - protein name
-    # 3 - protein acronym
-    # 4 - UAS sample state, ISPyB protein ID
-
-    for uas_row in uas_rs:
-        for ispyb_row in ispyb_rs:
-            # IF same UAS sample ID:
-            if uas_row[0] == ispyb_row[0]:
-                # IF UAS state no longer valid:
-                if uas_row[4] != 'Accepted':
-                    self.target_conn.update_protein_src_id(None, ispyb_row[4])
-                if uas_row[2] != "" and uas_row[2] is not None and \
-                    (ispyb_row[2] is None or ispyb_row[2] == ''):
-                    self.target_conn.update_protein_name(uas_row[2], ispyb_row[4])
-                break
-            # IF no UAS sample ID in ispyb AND same UAS proposal ID AND same acronym:
-            elif ispyb_row[0] is None and uas_row[1] == ispyb_row[1] and uas_row[3] == ispyb_row[3]:
-                # IF state is 'Accepted'
-                if uas_row[4] == 'Accepted':
-                    # IF the protein's UAS ID doesn't already exist in ISPyB:
-                    if 0 == target_conn.retrieve_number_of_proteins_for_src_id(uas_row[0]):
-                        self.target_conn.update_protein_src_id(uas_row[0], ispyb_row[4])
-                        # IF ISPyB name is empty
-                        if ispyb_row[2] is None or ispyb_row[2] == '':
-                            self.target_conn.update_protein_name(uas_row[2], ispyb_row[4])
-                break
-        else:
-            if uas_row[4] == 'Accepted':
-                # At this point we know the protein's UAS ID doesn't exist in ISPyB,
-                # but we still need to make sure the acronym doesn't already exist in the proposal
-                if 0 == self.target_conn.retrieve_number_of_proteins_for_proposal_and_acronym(uas_row[1], uas_row[3]):
-                    ispyb_proposal_id = self.target_conn.retrieve_proposal_id_for_src_id(uas_row[1])
-                    if ispyb_proposal_id != None:
-                        self.target_conn.insert_protein(uas_row[0], ispyb_proposal_id, uas_row[2], uas_row[3], 'ORIGIN:UAS')
+    strings = {}
+    uas_rs = rows.compact(self.source_conn.extract_components(), rows.UASComponent, strings)
+    ispyb_rs = rows.compact(self.target_conn.extract_components(), rows.ISPyBComponent, strings)
+
+    for action in self._counted(reconcile(uas_rs, ispyb_rs, _COMPONENT_KEYS)):
+        self._apply_component(*action)
+    self.target_conn.commit()
+
+  def _apply_component(self, action, uas_row, ispyb_row):
+    # IF same UAS sample ID:
+    if action == UPDATE and uas_row.guid == ispyb_row.external_id:
+        # IF UAS state no longer valid:
+        if uas_row.state != 'Accepted':
+            self.target_conn.update_protein_src_id(None, ispyb_row.protein_id)
+        if uas_row.name != "" and uas_row.name is not None and \
+            (ispyb_row.name is None or ispyb_row.name == ''):
+            self.target_conn.update_protein_name(uas_row.name, ispyb_row.protein_id)
+    # IF no UAS sample ID in ispyb AND same UAS proposal ID AND same acronym:
+    elif action == UPDATE:
+        # IF state is 'Accepted'
+        if uas_row.state == 'Accepted':
+            # IF the protein's UAS ID doesn't already exist in ISPyB:
+            if 0 == self.target_conn.retrieve_number_of_proteins_for_src_id(uas_row.guid):
+                self.target_conn.update_protein_src_id(uas_row.guid, ispyb_row.protein_id)
+                # IF ISPyB name is empty
+                if ispyb_row.name is None or ispyb_row.name == '':
+                    self.target_conn.update_protein_name(uas_row.name, ispyb_row.protein_id)
+    elif action == INSERT:
+        if uas_row.state == 'Accepted':
+            # At this point we know the protein's UAS ID doesn't exist in ISPyB,
+            # but we still need to make sure the acronym doesn't already exist in the proposal
+            if 0 == self.target_conn.retrieve_number_of_proteins_for_proposal_and_acronym(uas_row.proposal_guid, uas_row.acronym):
+                ispyb_proposal_id = self.target_conn.retrieve_proposal_id_for_src_id(uas_row.proposal_guid)
+                if ispyb_proposal_id != None:
+                    self.target_conn.insert_protein(uas_row.guid, ispyb_proposal_id, uas_row.name, uas_row.acronym, 'ORIGIN:UAS')
 
 
   def sync_proposals_have_persons(self):
-    uas_rs = self.source_conn.extract_proposals_have_persons()
-    ispyb_rs = self.target_conn.extract_proposals_have_persons()
-
-    prev_proposal_id = None
-    prev_person_id = None
-    for uas_row in uas_rs:
-        if uas_row[0] == prev_proposal_id and uas_row[1] == prev_person_id: # UAS allows multiple roles per person per session. ISPyB doesn't, so ...
-            #logging.getLogger().debug("Skipping")
-            continue
-        prev_proposal_id = uas_row[0]
-        prev_person_id = uas_row[1]
-
-        for ispyb_row in ispyb_rs:
-            if (uas_row[0] == ispyb_row[0] and uas_row[1] == ispyb_row[1]): # Compare GUIDs of both session and person
-
-                if self.target_conn.uas_role_2_ispyb_role(uas_row[2]) != ispyb_row[2]:       # Compare roles
-                    self.target_conn.update_proposal_has_person(uas_row[2], ispyb_row[3], ispyb_row[4])
-                break
-        else:
-            pr_id = self.target_conn.retrieve_proposal_id_for_src_id(uas_row[0])
-            pe_id = self.target_conn.retrieve_person_id(uas_row[1])
-
-            if pr_id != None and pe_id != None:
-                self.target_conn.insert_proposal_has_person(self.target_conn.uas_role_2_ispyb_role(uas_row[2]), pr_id, pe_id)
-            elif pr_id is None:
-                logging.getLogger().debug("Not found: Proposal.externalId %s for personId %d" % (uas_row[0], pe_id if pe_id is not None else -1))
-            elif pe_id is None:
-                logging.getLogger().debug("Not found: Person.externalId %s for proposalId %d" % (uas_row[1], pr_id if pr_id is not None else -1))
+    strings = {}
+    uas_rs = rows.compact(_skip_repeated_pairs(self.source_conn.extract_proposals_have_persons()), rows.UASProposalHasPerson, strings)
+    if self.target_mode == 'staged':
+        self._merge('proposals_have_persons', uas_rs)
+    else:
+        ispyb_rs = rows.compact(self.target_conn.extract_proposals_have_persons(), rows.ISPyBProposalHasPerson, strings)
+        for action in self._counted(reconcile(uas_rs, ispyb_rs, _PAIR_KEYS, changed=self._proposal_has_person_changed)):
+            self._apply_proposal_has_person(*action)
+    self.target_conn.commit()
+
+  def _proposal_has_person_changed(self, uas_row, ispyb_row):
+    return self.target_conn.uas_role_2_ispyb_role(uas_row.role) != ispyb_row.role
+
+  def _apply_proposal_has_person(self, action, uas_row, ispyb_row):
+    if action == UPDATE:
+        self.target_conn.update_proposal_has_person(uas_row.role, ispyb_row.proposal_id, ispyb_row.person_id)
+    elif action == INSERT:
+        pr_id = self.target_conn.retrieve_proposal_id_for_src_id(uas_row.proposal_guid)
+        pe_id = self.target_conn.retrieve_person_id(uas_row.person_guid)
+
+        if pr_id != None and pe_id != None:
+            self.target_conn.insert_proposal_has_person(self.target_conn.uas_role_2_ispyb_role(uas_row.role), pr_id, pe_id)
+        elif pr_id is None:
+            self.sampled_log.debug("Not found: Proposal.externalId %s for personId %d", uas_row.proposal_guid, pe_id if pe_id is not None else -1)
+        elif pe_id is None:
+            self.sampled_log.debug("Not found: Person.externalId %s for proposalId %d", uas_row.person_guid, pr_id if pr_id is not None else -1)
 
   def sync_sessions_have_persons(self):
-    uas_rs = self.source_conn.extract_sessions_have_persons()
-    ispyb_rs = self.target_conn.extract_sessions_have_persons()
-
-    prev_session_id = None
-    prev_person_id = None
-    for uas_row in uas_rs:
-        if uas_row[0] == prev_session_id and uas_row[1] == prev_person_id: # UAS allows multiple roles per person per session. ISPyB doesn't, so ...
-            #logging.getLogger().debug("Skipping")
-            continue
-        prev_session_id = uas_row[0]
-        prev_person_id = uas_row[1]
-
-        for ispyb_row in ispyb_rs:
-            if (uas_row[0] == ispyb_row[0] and uas_row[1] == ispyb_row[1]): # Compare GUIDs of both session and person
-                uas_is_remote = 1 if uas_row[3] == 0 else 0 if uas_row[3] == 1 else None
-                ispyb_is_remote = 1 if ispyb_row[5] == 1 else 0 if ispyb_row[5] == 0 else None
-
-                if self.target_conn.uas_role_2_ispyb_role(uas_row[2]) != ispyb_row[2] or uas_is_remote != ispyb_is_remote:  # Compare roles and remote / on-site status
-                    self.target_conn.update_session_has_person(uas_row[2], uas_is_remote, ispyb_row[3], ispyb_row[4])
-                break
-        else:
-            s_id = self.target_conn.retrieve_session_id(uas_row[0])
-            p_id = self.target_conn.retrieve_person_id(uas_row[1])
-            is_remote = 1 if uas_row[3] == 0 else 0 if uas_row[3] == 1 else None
-
-            if s_id != None and p_id != None:
-                self.target_conn.insert_session_has_person(self.target_conn.uas_role_2_ispyb_role(uas_row[2]), s_id, p_id, is_remote)
-            elif s_id is None:
-                logging.getLogger().debug("Not found: BLSession.externalId %s for personId %d" % (uas_row[0], p_id if p_id is not None else -1))
-            elif p_id is None:
-                logging.getLogger().debug("Not found: Person.externalId %s for sessionId %d" % (uas_row[1], s_id if s_id is not None else -1))
+    strings = {}
+    uas_rs = rows.compact(_skip_repeated_pairs(self.source_conn.extract_sessions_have_persons()), rows.UASSessionHasPerson, strings)
+    if self.target_mode == 'staged':
+        self._merge('sessions_have_persons', uas_rs)
+    else:
+        ispyb_rs = rows.compact(self.target_conn.extract_sessions_have_persons(), rows.ISPyBSessionHasPerson, strings)
+        for action in self._counted(reconcile(uas_rs, ispyb_rs, _PAIR_KEYS, changed=self._session_has_person_changed)):
+            self._apply_session_has_person(*action)
+    self.target_conn.commit()
+
+  def _session_has_person_changed(self, uas_row, ispyb_row):
+    # Compare roles and remote / on-site status
+    return self.target_conn.uas_role_2_ispyb_role(uas_row.role) != ispyb_row.role or \
+        _uas_is_remote(uas_row.on_site) != _ispyb_is_remote(ispyb_row.remote)
+
+  def _apply_session_has_person(self, action, uas_row, ispyb_row):
+    if action == UPDATE:
+        self.target_conn.update_session_has_person(uas_row.role, _uas_is_remote(uas_row.on_site), ispyb_row.session_id, ispyb_row.person_id)
+    elif action == INSERT:
+        s_id = self.target_conn.retrieve_session_id(uas_row.session_guid)
+        p_id = self.target_conn.retrieve_person_id(uas_row.person_guid)
+        is_remote = _uas_is_remote(uas_row.on_site)
+
+        if s_id != None and p_id != None:
+            self.target_conn.insert_session_has_person(self.target_conn.uas_role_2_ispyb_role(uas_row.role), s_id, p_id, is_remote)
+        elif s_id is None:
+            self.sampled_log.debug("Not found: BLSession.externalId %s for personId %d", uas_row.session_guid, p_id if p_id is not None else -1)
+        elif p_id is None:
+            self.sampled_log.debug("Not found: Person.externalId %s for sessionId %d", uas_row.person_guid, s_id if s_id is not None else -1)
+
+
+def _skip_repeated_pairs(rs):
+  '''UAS allows multiple roles per person per session/proposal. ISPyB doesn't, so
+  only keep the first of consecutive rows with the same pair of GUIDs.'''
+  prev = None
+  for row in rs:
+    if (row[0], row[1]) == prev:
+        continue
+    prev = (row[0], row[1])
+    yield row
+
+def _without_keys(fingerprints, keys):
+  '''Return the key -> fingerprint map without the given GUIDs, whatever their case.'''
+  if not keys:
+      return fingerprints
+  keys = set([key.upper() for key in keys])
+  return dict((key, value) for (key, value) in fingerprints.items() if key is None or key.upper() not in keys)
+
+def _uas_is_remote(on_site):
+  return 1 if on_site == 0 else 0 if on_site == 1 else None
+
+def _ispyb_is_remote(remote):
+  return 1 if remote == 1 else 0 if remote == 0 else None
+
+def _session_scheduled(uas_row):
+  return 0 if uas_row.state == 'Queued' else 1
+
+def _never_changed(uas_row, ispyb_row):
+  return False
+
+def _proposal_deleted(uas_row):
+  return uas_row.state == 'Cancelled'
+
+def _proposal_changed(uas_row, ispyb_row):
+  return uas_row.name[0:2] != ispyb_row.name[0:2] or uas_row.title != ispyb_row.title or uas_row.guid != ispyb_row.external_id
+
+# The fingerprint of a source row covers the columns compared and whether it is cancelled
+def _proposal_fingerprint(uas_row):
+  return fingerprint((uas_row.name[0:2], uas_row.title, uas_row.guid, _proposal_deleted(uas_row)))
+
+def _session_deleted(uas_row):
+  return uas_row.state == 'Cancelled'
+
+def _session_changed(uas_row, ispyb_row):
+  # NOTE: deliberately not comparing comments, as they may have changed in ISPyB and we don't want to overwrite
+  return uas_row.guid != ispyb_row.external_id or uas_row.visit != ispyb_row.visit or uas_row.beamline != ispyb_row.beamline or \
+    uas_row.start_date != ispyb_row.start_date or uas_row.end_date != ispyb_row.end_date or \
+    uas_row.operators != ispyb_row.operators or ispyb_row.scheduled != _session_scheduled(uas_row)
+
+def _session_fingerprint(uas_row):
+  return fingerprint((uas_row.guid, uas_row.visit, uas_row.beamline, uas_row.start_date, uas_row.end_date, uas_row.operators,
+                      _session_scheduled(uas_row), _session_deleted(uas_row)))
+
+def _person_changed(uas_row, ispyb_row):
+  return uas_row.guid != ispyb_row.external_id or uas_row.login != ispyb_row.login or uas_row.title != ispyb_row.title or \
+    uas_row.given_name != ispyb_row.given_name or uas_row.family_name != ispyb_row.family_name
+
+def _person_fingerprint(uas_row):
+  return fingerprint((uas_row.guid, uas_row.login, uas_row.title, uas_row.given_name, uas_row.family_name))
+
+# (source key, target key) pairs used to match UAS rows to ISPyB rows, see datasync.reconcile
+_PROPOSAL_KEYS = [(attrgetter('guid'), attrgetter('external_id')),
+                  (attrgetter('name'), attrgetter('name'))]
+_SESSION_KEYS = [(attrgetter('guid'), attrgetter('external_id')),
+                 (attrgetter('visit'), attrgetter('visit'))]
+_SESSION_TYPE_KEYS = [(attrgetter('guid', 'tag'), attrgetter('external_id', 'type_name'))]
+_PERSON_KEYS = [(attrgetter('guid'), attrgetter('external_id')),
+                (attrgetter('login'), attrgetter('login'))]     # UAS federal ID vs ISPyB login
+_COMPONENT_KEYS = [(attrgetter('guid'), attrgetter('external_id')),
+                   # no UAS sample ID in ISPyB AND same UAS proposal ID AND same acronym:
+                   (attrgetter('proposal_guid', 'acronym'),
+                    lambda r: (r.proposal_external_id, r.acronym) if r.external_id is None else None)]
+_PAIR_KEYS = [(itemgetter(0, 1), itemgetter(0, 1))] # GUIDs of both session/proposal and person
@@ -0,0 +1,150 @@
+'''A pipelined engine for DataSync.sync_all, selected with -P|--pipelined.
+
+Within a stage, the source and target rows are extracted at the same time, and
+the writes of the reconcile actions are pipelined: they are queued to the
+target connection's thread while the stage goes on comparing the rows that
+follow. Independent stages run at the same time, scheduled by StageScheduler.
+
+The connectors are blocking and connections aren't thread safe, so each
+connection of a worker is driven from a thread of its own.'''
+import collections
+import concurrent.futures
+
+from datasync.main import (SYNC_STAGES, _skip_repeated_pairs, _never_changed, _proposal_changed, _proposal_deleted,
+                           _session_changed, _session_deleted, _person_changed, _PROPOSAL_KEYS, _SESSION_KEYS,
+                           _SESSION_TYPE_KEYS, _PERSON_KEYS, _COMPONENT_KEYS, _PAIR_KEYS)
+from datasync.reconcile import reconcile, DELETE, UNCHANGED
+from datasync.scheduler import StageScheduler
+from datasync import rows
+
+# Number of writes of a stage that may be waiting for the target's thread
+MAX_PENDING_WRITES = 1000
+
+# Stage -> (extract method of both source and target, source and target records, reconcile keys,
+# changed, deleted, DataSync method applying an action). changed is a function or the name of a
+# DataSync method.
+_STAGES = {
+  'proposals': ('extract_proposals', (rows.UASProposal, rows.ISPyBProposal), _PROPOSAL_KEYS,
+                _proposal_changed, _proposal_deleted, '_apply_proposal'),
+  'sessions': ('extract_sessions', (rows.UASSession, rows.ISPyBSession), _SESSION_KEYS,
+               _session_changed, _session_deleted, '_apply_session'),
+  'session_types': ('extract_session_types', (rows.UASSessionType, rows.ISPyBSessionType), _SESSION_TYPE_KEYS,
+                    _never_changed, None, '_apply_session_type'),
+  'persons': ('extract_persons', (rows.UASPerson, rows.ISPyBPerson), _PERSON_KEYS,
+              _person_changed, None, '_apply_person'),
+  'components': ('extract_components', (rows.UASComponent, rows.ISPyBComponent), _COMPONENT_KEYS,
+                 None, None, '_apply_component'),
+  'proposals_have_persons': ('extract_proposals_have_persons', (rows.UASProposalHasPerson, rows.ISPyBProposalHasPerson),
+                             _PAIR_KEYS, '_proposal_has_person_changed', None, '_apply_proposal_has_person'),
+  'sessions_have_persons': ('extract_sessions_have_persons', (rows.UASSessionHasPerson, rows.ISPyBSessionHasPerson),
+                            _PAIR_KEYS, '_session_has_person_changed', None, '_apply_session_has_person'),
+}
+
+class PipelinedWorker:
+  '''Runs the stages of a DataSync with a thread for each of its two connections, for
+  StageScheduler.
+
+  Stages that use watermarks, fingerprints, the 'merge' or 'range' reconcile modes
+  or the 'staged' target mode are run with DataSync.run_stage.'''
+
+  def __init__(self, ds, owned=True):
+    self.ds = ds
+    self.owned = owned        # close ds's connections with the worker
+    self.stage = None
+    self.source_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self.target_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+  def call(self, thread, fn, *args):
+    '''Run fn(*args) on thread, its statements attributed to the current stage, and
+    return its future.'''
+    query_stats = self.ds.query_stats
+    stage = self.stage
+    def run():
+        if query_stats is None:
+            return fn(*args)
+        with query_stats.stage(stage):
+            return fn(*args)
+    return thread.submit(run)
+
+  def target(self, name, *args):
+    return self.call(self.target_thread, getattr(self.ds.target_conn, name), *args)
+
+  def fetch(self, thread, conn, name, record, strings, skip_pairs=False):
+    '''Run extract name of conn on thread, compacting its rows into record as they
+    come (so a streamed extract is read on the thread that started it), and return
+    its future.'''
+    def run():
+        rs = getattr(conn, name)()
+        if skip_pairs:
+            rs = _skip_repeated_pairs(rs)
+        return rows.compact(rs, record, strings)
+    return self.call(thread, run)
+
+  def overlapped(self, name):
+    '''Whether stage name can run with extraction and writes overlapped.'''
+    ds = self.ds
+    if ds.target_mode != 'rows':
+        return False
+    if name in ('proposals', 'sessions', 'persons'):
+        return ds.watermarks is None and ds.fingerprints is None and (name == 'proposals' or ds.reconcile_mode == 'hash')
+    return True
+
+  def run_stage(self, name):
+    self.stage = name
+    if not self.overlapped(name):
+        self.call(self.target_thread, self.ds.run_stage, name).result()
+        return
+    ds = self.ds
+    extract, (uas_record, ispyb_record), keys, changed, deleted, apply = _STAGES[name]
+    if isinstance(changed, str):
+        changed = getattr(ds, changed)
+    apply = getattr(ds, apply)
+    start = ds._begin_stage()
+    pending = collections.deque()
+    try:
+        strings = {}
+        uas_future = self.fetch(self.source_thread, ds.source_conn, extract, uas_record, strings,
+                                skip_pairs=name in ('proposals_have_persons', 'sessions_have_persons'))
+        ispyb_future = self.fetch(self.target_thread, ds.target_conn, extract, ispyb_record, strings)
+        uas_rs = uas_future.result()
+        ispyb_rs = ispyb_future.result()
+        cancelled = []
+        for action in ds._counted(reconcile(uas_rs, ispyb_rs, keys, changed=changed, deleted=deleted)):
+            if action[0] == UNCHANGED:
+                pass
+            elif name == 'sessions' and action[0] == DELETE:
+                cancelled.append(action[2].session_id)
+            else:
+                pending.append(self.call(self.target_thread, apply, *action))
+            if len(pending) >= MAX_PENDING_WRITES:
+                pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+        if cancelled:
+            self.target('delete_sessions', cancelled).result()
+        self.target('commit').result()
+    except:
+        # runs after the writes still queued on the target's thread
+        for future in pending:
+            future.cancel()
+        self.target('rollback').result()
+        raise
+    ds._end_stage(name, start)
+
+  def close(self):
+    self.source_thread.shutdown()
+    self.target_thread.shutdown()
+    if self.owned:
+        self.ds.close()
+
+def sync_all(ds, workers):
+  '''Run all the stages of DataSync ds with up to workers at a time, each with its own
+  connections if ds has connection factories, otherwise one at a time on ds's own.'''
+  if workers <= 1 or ds.source_factory is None or ds.target_factory is None:
+    open_worker = lambda: PipelinedWorker(ds, owned=False)
+    workers = 1
+  else:
+    open_worker = lambda: PipelinedWorker(ds._open_worker())
+  failed = StageScheduler(SYNC_STAGES, open_worker, workers).run()
+  if failed:
+    raise RuntimeError('Sync stages failed or were skipped: %s' % ', '.join(failed))
@@ -0,0 +1,145 @@
+'''Reconciliation of source rows against target rows.
+
+Each source row is matched against the target rows using one or more keys
+(e.g. externalId, then login or visit name). A match on any of the keys
+counts, and when several target rows match, the one that comes first in the
+target result set wins - this is what the original nested loops in
+DataSync.sync_* did, but here the target side is indexed with one dict per key
+so a whole entity is classified in O(N+M) rather than O(N*M).
+'''
+
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+UNCHANGED = 'unchanged'
+
+class TargetIndex:
+  '''Hash indexes over a target result set, one per key.
+
+  keys is a list of (source_key, target_key) pairs of functions taking a row
+  and returning a hashable key. Rows for which a key function returns None
+  are not indexed under that key and never match on it.'''
+
+  def __init__(self, target_rows, keys):
+    self.rows = list(target_rows)
+    self.keys = keys
+    self.indexes = []
+    for (_, target_key) in keys:
+        index = {}
+        for pos, row in enumerate(self.rows):
+            key = target_key(row)
+            if key is not None and key not in index:
+                index[key] = pos
+        self.indexes.append(index)
+
+  def lookup(self, source_row):
+    '''Return the first target row matching source_row on any key, or None.'''
+    best = None
+    for (source_key, _), index in zip(self.keys, self.indexes):
+        key = source_key(source_row)
+        if key is None:
+            continue
+        pos = index.get(key)
+        if pos is not None and (best is None or pos < best):
+            best = pos
+    if best is None:
+        return None
+    return self.rows[best]
+
+def reconcile(source_rows, target_rows, keys, changed=None, deleted=None):
+  '''Classify each source row against the target rows.
+
+  Yields (action, source_row, target_row) tuples where action is one of
+  INSERT, UPDATE, DELETE or UNCHANGED. target_row is None for INSERT.
+
+  changed(source_row, target_row) decides between UPDATE and UNCHANGED for
+  matched rows; if omitted, every matched row is reported as UPDATE.
+  deleted(source_row) flags source rows that should no longer exist in the
+  target: they are reported as DELETE if matched and skipped otherwise.'''
+  index = TargetIndex(target_rows, keys)
+  for source_row in source_rows:
+    target_row = index.lookup(source_row)
+    if deleted is not None and deleted(source_row):
+        if target_row is not None:
+            yield (DELETE, source_row, target_row)
+    elif target_row is None:
+        yield (INSERT, source_row, None)
+    elif changed is None or changed(source_row, target_row):
+        yield (UPDATE, source_row, target_row)
+    else:
+        yield (UNCHANGED, source_row, target_row)
+
+def merge_reconcile(source_rows, target_rows, keys, changed=None, deleted=None):
+  '''Sorted merge-join variant of reconcile().
+
+  Both source_rows and target_rows must be iterables sorted on their first
+  (primary) key, so they can be streamed from the database cursors in
+  lock-step without materialising either side. Target rows with a None
+  primary key may come anywhere. Rows matched on the primary key are yielded
+  as the merge progresses; source rows without a primary-key match are
+  matched against the remaining target rows on the other keys once both
+  sides are exhausted, so memory is bounded by the number of unmatched rows
+  rather than the size of the tables.
+
+  Unlike reconcile(), a primary-key match always takes precedence over a
+  match on a secondary key, and a target row matched on its primary key is
+  not offered to other source rows.'''
+  source_key, target_key = keys[0]
+  unmatched_source = []
+  unmatched_target = []
+
+  target_iter = iter(target_rows)
+  target_row = None
+  last_target_key = None
+  last_source_key = None
+  exhausted = False
+
+  for source_row in source_rows:
+    key = source_key(source_row)
+    if last_source_key is not None and key < last_source_key:
+        raise ValueError('Source rows are not sorted on the merge key: %s after %s' % (key, last_source_key))
+    last_source_key = key
+
+    # Advance the target side up to the source key
+    while not exhausted:
+        if target_row is None:
+            try:
+                target_row = next(target_iter)
+            except StopIteration:
+                exhausted = True
+                break
+            tkey = target_key(target_row)
+            if tkey is None:
+                unmatched_target.append(target_row)
+                target_row = None
+                continue
+            if last_target_key is not None and tkey < last_target_key:
+                raise ValueError('Target rows are not sorted on the merge key: %s after %s' % (tkey, last_target_key))
+            last_target_key = tkey
+        if last_target_key < key:
+            unmatched_target.append(target_row)
+            target_row = None
+        else:
+            break
+
+    if target_row is not None and last_target_key == key:
+        matched = target_row
+        target_row = None
+        if deleted is not None and deleted(source_row):
+            yield (DELETE, source_row, matched)
+        elif changed is None or changed(source_row, matched):
+            yield (UPDATE, source_row, matched)
+        else:
+            yield (UNCHANGED, source_row, matched)
+    else:
+        unmatched_source.append(source_row)
+
+  if target_row is not None:
+    unmatched_target.append(target_row)
+  if len(unmatched_source) == 0:
+    return
+  unmatched_target.extend(target_iter)
+
+  # Whatever is left can only match on the secondary keys
+  for action in reconcile(unmatched_source, unmatched_target, keys[1:], changed=changed, deleted=deleted):
+    yield action
@@ -0,0 +1,135 @@
+'''Compact records for the rows of the reconciliation working set.
+
+Extracts come back from the drivers as tuples of separate objects, with the
+same GUID, role or state strings repeated across rows. compact() turns them into
+records - namedtuples, so no bigger than the tuples and still indexable - with
+named fields, sharing one string object for each distinct value of the columns
+that repeat. IdMap keeps the externalId -> primary key maps of the ISPyB
+connector in arrays rather than in dicts of strings and ints.'''
+import array
+import binascii
+import bisect
+from collections import namedtuple
+
+UASProposal = namedtuple('UASProposal', 'name guid title state')
+ISPyBProposal = namedtuple('ISPyBProposal', 'name external_id title proposal_id')
+UASSession = namedtuple('UASSession', 'guid visit beamline comments start_date end_date state operators')
+ISPyBSession = namedtuple('ISPyBSession', 'external_id visit beamline comments start_date end_date session_id operators scheduled')
+UASSessionType = namedtuple('UASSessionType', 'guid tag visit')
+ISPyBSessionType = namedtuple('ISPyBSessionType', 'external_id type_name')
+UASPerson = namedtuple('UASPerson', 'guid login title given_name family_name')
+ISPyBPerson = namedtuple('ISPyBPerson', 'external_id login title given_name family_name person_id')
+UASComponent = namedtuple('UASComponent', 'guid proposal_guid name acronym state')
+ISPyBComponent = namedtuple('ISPyBComponent', 'external_id proposal_external_id name acronym protein_id')
+UASProposalHasPerson = namedtuple('UASProposalHasPerson', 'proposal_guid person_guid role')
+ISPyBProposalHasPerson = namedtuple('ISPyBProposalHasPerson', 'proposal_external_id person_external_id role proposal_id person_id')
+UASSessionHasPerson = namedtuple('UASSessionHasPerson', 'session_guid person_guid role on_site')
+ISPyBSessionHasPerson = namedtuple('ISPyBSessionHasPerson', 'session_external_id person_external_id role session_id person_id remote')
+
+# Columns whose values repeat across the rows of an extract (or between extracts of a
+# stage), whose strings compact() shares
+_SHARED = {
+  UASProposal: (3,),
+  UASSession: (2, 6),
+  ISPyBSession: (2,),
+  UASSessionType: (0, 1, 2),
+  ISPyBSessionType: (0, 1),
+  UASComponent: (1, 4),
+  ISPyBComponent: (1,),
+  UASProposalHasPerson: (0, 1, 2),
+  ISPyBProposalHasPerson: (0, 1, 2),
+  UASSessionHasPerson: (0, 1, 2),
+  ISPyBSessionHasPerson: (0, 1, 2),
+}
+
+def compact(rs, record, strings=None):
+  '''Return the rows of rs as a list of record, replacing them one by one if rs is a
+  list, or appending them as they come if it is an iterator, so that both copies never
+  exist at once. strings is the dict of shared strings, pass the same one to share
+  them between extracts.'''
+  shared = _SHARED.get(record, ())
+  if strings is None:
+    strings = {}
+  make = record._make
+  def convert(row):
+    if shared:
+        row = list(row)
+        for c in shared:
+            value = row[c]
+            if value is not None:
+                row[c] = strings.setdefault(value, value)
+    return make(row)
+  if not isinstance(rs, list):
+    return [convert(row) for row in rs]
+  for i in range(len(rs)):
+    rs[i] = convert(rs[i])
+  return rs
+
+def records(rs, record):
+  '''Generator yielding the rows of the iterator rs as record.'''
+  make = record._make
+  for row in rs:
+    yield make(row)
+
+class IdMap:
+  '''A map from hex externalId to integer primary key, for maps of many entries that
+  are loaded in one go and then rarely added to.
+
+  The loaded entries are kept sorted, the keys as 16-byte binary strings packed into
+  one bytes object and the ids in an array, about 24 bytes an entry; lookups bisect
+  them, so hex keys match whatever their case. Entries added later, and keys that
+  aren't 32 hex digits, go in a dict.'''
+
+  def __init__(self, items=()):
+    loaded = []
+    self.extra = {}
+    for (key, id) in items:
+        binary = _binary(key)
+        if binary is None:
+            self.extra[key] = int(id)
+        else:
+            loaded.append((binary, int(id)))
+    loaded.sort()
+    self.keys = _Keys(b''.join([k for (k, _) in loaded]))
+    self.ids = array.array('L', [id for (_, id) in loaded])
+
+  def __len__(self):
+    return len(self.ids) + len(self.extra)
+
+  def get(self, key, default=None):
+    binary = _binary(key)
+    id = self.extra.get(key if binary is None else binary)
+    if id is not None or binary is None:
+        return default if id is None else id
+    i = bisect.bisect_left(self.keys, binary)
+    if i < len(self.ids) and self.keys[i] == binary:
+        return self.ids[i]
+    return default
+
+  def __setitem__(self, key, id):
+    binary = _binary(key)
+    if binary is not None:
+        i = bisect.bisect_left(self.keys, binary)
+        if i < len(self.ids) and self.keys[i] == binary:
+            self.ids[i] = int(id)
+            return
+    self.extra[key if binary is None else binary] = int(id)
+
+class _Keys:
+  '''Sequence view of packed 16-byte keys, for bisect.'''
+  def __init__(self, packed):
+    self.packed = packed
+
+  def __len__(self):
+    return len(self.packed) // 16
+
+  def __getitem__(self, i):
+    return self.packed[i * 16:(i + 1) * 16]
+
+def _binary(key):
+  if not isinstance(key, (str, type(u''))) or len(key) != 32:
+    return None
+  try:
+    return binascii.unhexlify(key)
+  except (TypeError, ValueError):
+    return None
@@ -0,0 +1,37 @@
+import logging
+import threading
+
+class SampledLog:
+  '''Log repeated messages sparingly: of each kind (its format string), the first
+  `first` are logged, then one in every `every`, and the others only counted.
+  Nothing is formatted unless the level is enabled and the message is sampled.
+  summary() logs how many of each kind there were, and resets the counts.'''
+
+  def __init__(self, logger=None, first=10, every=1000):
+    self.logger = logger if logger is not None else logging.getLogger()
+    self.first = first
+    self.every = every
+    self.lock = threading.Lock()
+    self.counts = {}
+
+  def log(self, level, msg, *args):
+    with self.lock:
+        n = self.counts.get(msg, 0) + 1
+        self.counts[msg] = n
+    if (n <= self.first or n % self.every == 0) and self.logger.isEnabledFor(level):
+        self.logger.log(level, msg + ' (%d so far)', *(args + (n,)))
+
+  def debug(self, msg, *args):
+    self.log(logging.DEBUG, msg, *args)
+
+  def warning(self, msg, *args):
+    self.log(logging.WARNING, msg, *args)
+
+  def summary(self, level=logging.INFO, prefix=''):
+    with self.lock:
+        counts = self.counts
+        self.counts = {}
+    if self.logger.isEnabledFor(level):
+        for (msg, n) in sorted(counts.items()):
+            if n > self.first:
+                self.logger.log(level, '%s%d messages like: %s', prefix, n, msg)
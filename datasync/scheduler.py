@@ -0,0 +1,100 @@
+import logging
+import threading
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+class StageScheduler:
+  '''Run stages on a pool of worker threads, each stage as soon as the stages it
+  depends on have completed.
+
+  stages is a list of (name, [names of the stages it depends on]). open_worker is
+  called once in each worker thread that gets a stage to run, and must return an
+  object with run_stage(name) and close() methods - typically one holding its own
+  database connections. A stage that fails is logged, and the stages depending
+  on it are skipped; the others still run.'''
+
+  def __init__(self, stages, open_worker, workers=4):
+    self.stages = stages
+    self.open_worker = open_worker
+    self.workers = max(1, int(workers))
+    self.lock = threading.Lock()
+    self.ready = queue.Queue()
+    self.state = {}       # name -> 'queued', 'done', 'failed' or 'skipped'
+    self.failed = []
+
+  def run(self):
+    '''Run all the stages and return the names of those that failed or were skipped.'''
+    names = set([name for (name, _) in self.stages])
+    for (name, deps) in self.stages:
+        for dep in deps:
+            if dep not in names:
+                raise ValueError('Stage %s depends on unknown stage %s' % (name, dep))
+    # The stages left once those that can be ordered are taken out depend on each other
+    ordered = set()
+    pending = list(self.stages)
+    while pending:
+        ready = [name for (name, deps) in pending if all(dep in ordered for dep in deps)]
+        if not ready:
+            raise ValueError('Stages depend on each other: %s' % ', '.join([name for (name, _) in pending]))
+        ordered.update(ready)
+        pending = [(name, deps) for (name, deps) in pending if name not in ordered]
+
+    with self.lock:
+        self._queue_ready()
+    threads = [threading.Thread(target=self._work, name='sync-worker-%d' % i) for i in range(self.workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return self.failed
+
+  def _queue_ready(self):
+    '''Queue the stages whose dependencies are done, skip those with a failed dependency.
+    Called with self.lock held.'''
+    progress = True
+    while progress:
+        progress = False
+        for (name, deps) in self.stages:
+            if name in self.state:
+                continue
+            dep_states = [self.state.get(dep) for dep in deps]
+            if any(s in ('failed', 'skipped') for s in dep_states):
+                logging.getLogger().warning("Skipping stage %s as a stage it depends on failed", name)
+                self.state[name] = 'skipped'
+                self.failed.append(name)
+                progress = True
+            elif all(s == 'done' for s in dep_states):
+                self.state[name] = 'queued'
+                self.ready.put(name)
+    if all(s in ('done', 'failed', 'skipped') for s in self.state.values()) and len(self.state) == len(self.stages):
+        for i in range(self.workers):
+            self.ready.put(None)
+
+  def _work(self):
+    worker = None
+    try:
+        while True:
+            name = self.ready.get()
+            if name is None:
+                break
+            logging.getLogger().info("Starting stage %s", name)
+            try:
+                if worker is None:
+                    worker = self.open_worker()
+                worker.run_stage(name)
+            except Exception:
+                logging.getLogger().exception("Stage %s failed", name)
+                state = 'failed'
+            else:
+                logging.getLogger().info("Finished stage %s", name)
+                state = 'done'
+            with self.lock:
+                self.state[name] = state
+                if state == 'failed':
+                    self.failed.append(name)
+                self._queue_ready()
+    finally:
+        if worker is not None:
+            worker.close()
@@ -0,0 +1,152 @@
+'''Snapshots of the source extracts, to sync from later or more than once.
+
+Usage: python -m datasync.snapshot -c <configuration file> -o <directory> [-s <source>]
+
+A snapshot is a directory with one msgpack file per entity - a stream of rows,
+each an array of column values, datetimes as an extension type - and a JSON
+manifest recording when it was taken, the source's watermark and, per entity,
+its file and number of rows. The snapshotuas connector replays a snapshot as
+a source; UASConnector records one as it goes with snapshot_dir set.'''
+from __future__ import print_function
+import datetime
+import getopt
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+import msgpack
+
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+
+# The extract_<entity> methods of a DBSource that a snapshot holds
+ENTITIES = ['proposals', 'sessions', 'session_types', 'persons', 'components',
+            'proposals_have_persons', 'sessions_have_persons']
+
+# Serialises the manifest updates of the writers of a process, e.g. those of sync_all's workers
+_manifest_lock = threading.Lock()
+
+_DATETIME = 1   # msgpack extension type code
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def _encode(value):
+  if isinstance(value, datetime.datetime):
+    return msgpack.ExtType(_DATETIME, value.strftime(_DATETIME_FORMAT).encode('ascii'))
+  raise TypeError('Cannot snapshot %r' % (value,))
+
+def _decode(code, data):
+  if code == _DATETIME:
+    return datetime.datetime.strptime(data.decode('ascii'), _DATETIME_FORMAT)
+  return msgpack.ExtType(code, data)
+
+class SnapshotWriter:
+  '''Writes the rows of entities to a snapshot directory, and its manifest.
+
+  Entities already in the directory's manifest are kept unless written again, so a
+  snapshot can be taken, or refreshed, one entity at a time.'''
+
+  def __init__(self, directory, watermark=None):
+    self.directory = directory
+    self.watermark = watermark
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+  def write(self, entity, rows):
+    '''Write rows as the snapshot of entity, replacing any previous one, and update the manifest.'''
+    name = entity + '.msgpack'
+    path = os.path.join(self.directory, name)
+    packer = msgpack.Packer(default=_encode, use_bin_type=True)
+    count = 0
+    with open(path + '.tmp', 'wb') as f:
+        for row in rows:
+            f.write(packer.pack(list(row)))
+            count += 1
+    os.rename(path + '.tmp', path)
+    with _manifest_lock:
+        manifest_path = os.path.join(self.directory, MANIFEST)
+        if os.path.exists(manifest_path):
+            manifest = read_manifest(self.directory)
+        else:
+            manifest = {'version': FORMAT_VERSION, 'entities': {}, 'watermark': None}
+        if self.watermark is not None:
+            manifest['watermark'] = self.watermark
+        manifest['entities'][entity] = {'file': name, 'rows': count, 'bytes': os.path.getsize(path),
+                                        'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.rename(manifest_path + '.tmp', manifest_path)
+    return count
+
+def read_manifest(directory):
+  with open(os.path.join(directory, MANIFEST)) as f:
+    manifest = json.load(f)
+  if manifest.get('version') != FORMAT_VERSION:
+    raise ValueError('Unsupported snapshot version %s in %s' % (manifest.get('version'), directory))
+  return manifest
+
+def iterate_rows(directory, entity, manifest=None):
+  '''Generator yielding the rows of entity in the snapshot as tuples.'''
+  if manifest is None:
+    manifest = read_manifest(directory)
+  entry = manifest['entities'].get(entity)
+  if entry is None:
+    raise KeyError('No %s in the snapshot in %s' % (entity, directory))
+  count = 0
+  with open(os.path.join(directory, entry['file']), 'rb') as f:
+    for row in msgpack.Unpacker(f, ext_hook=_decode, raw=False, use_list=False):
+        count += 1
+        yield row
+  if count != entry['rows']:
+    raise ValueError('Snapshot of %s in %s has %d rows, not %d' % (entity, directory, count, entry['rows']))
+
+def take_snapshot(source_conn, directory, entities=ENTITIES):
+  '''Extract entities from source_conn and write them to a snapshot in directory.'''
+  writer = SnapshotWriter(directory, source_conn.retrieve_watermark())
+  counts = {}
+  for entity in entities:
+    counts[entity] = writer.write(entity, getattr(source_conn, 'extract_' + entity)())
+  return counts
+
+def main():
+  def print_usage():
+    print("""Syntax: %s -c <configuration file> -o <directory> [-s <source>]
+        Arguments:
+             -h|--help : display this help
+             -c|--conf <conf file> : use the given configuration file
+             -o|--output <directory> : write the snapshot to the given directory
+             -s|--source <source> : the connector to extract from (default uas)""" % sys.argv[0])
+
+  try:
+    opts, args = getopt.gnu_getopt(sys.argv[1:], "hc:o:s:", ["help", "conf=", "output=", "source="])
+  except getopt.GetoptError:
+    print_usage()
+    sys.exit(2)
+
+  conf_file = None
+  directory = None
+  source = 'uas'
+  for o, a in opts:
+    if o in ("-h", "--help"):
+        print_usage()
+        sys.exit()
+    elif o in ("-c", "--conf"):
+        conf_file = a
+    elif o in ("-o", "--output"):
+        directory = a
+    elif o in ("-s", "--source"):
+        source = a
+  if conf_file is None or directory is None:
+    print_usage()
+    sys.exit(2)
+
+  source_conn = importlib.import_module('datasync.connector.%s' % source).open(conf_file)
+  try:
+    for (entity, count) in sorted(take_snapshot(source_conn, directory).items()):
+        print('%-24s %10d' % (entity, count))
+  finally:
+    source_conn.disconnect()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,46 @@
+import json
+import logging
+import os
+import threading
+import time
+
+class WatermarkStore:
+  '''High-water marks of the last successful sync per entity, kept in a JSON file.
+
+  For each entity the file holds the source's change mark (e.g. an Oracle SCN)
+  as of the start of the last successful sync, and when the entity was last
+  fully reconciled. An entity is synced in full when it has no mark yet, when
+  its last full sync is older than full_interval seconds, or when full is set.'''
+
+  def __init__(self, path, full_interval=86400, full=False):
+    self.path = path
+    self.full_interval = int(full_interval)
+    self.full = full
+    self.lock = threading.Lock()
+    self.marks = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            self.marks = json.load(f)
+
+  def since(self, entity):
+    '''Return the mark to extract changes from for entity, or None for a full sync.'''
+    with self.lock:
+        entry = self.marks.get(entity)
+        if self.full or entry is None or entry.get('mark') is None:
+            return None
+        if time.time() - entry.get('full', 0) > self.full_interval:
+            logging.getLogger().info("%s: last full sync too old, doing a full sync", entity)
+            return None
+        return entry['mark']
+
+  def update(self, entity, mark, full):
+    '''Record mark for entity after a successful sync and write the file.'''
+    with self.lock:
+        entry = self.marks.setdefault(entity, {})
+        entry['mark'] = mark
+        if full:
+            entry['full'] = time.time()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.marks, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.path)
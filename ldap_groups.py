@@ -8,13 +8,23 @@ import atexit
 import signal
 import time
 import sched
-import subprocess
 import ConfigParser
-        
+# Needs ldap3: pip install .[ldap]
+from datasync.ldapdirectory import LDAPDirectory
+from datasync.ldapcache import LDAPCache, CachedDirectory
+
+# The ISPyB UserGroups kept in step with LDAP, and the LDAP groups whose members they
+# should have, unless the configuration file has a [UserGroups] section
+USERGROUPS = [("super_admin", ["dls_dasc"]),
+              ("mx_admin", ["mx_staff"]),
+              ("saxs_admin", ["b21_staff"]),
+              ("powder_admin", ["i11_staff"]),
+              ("tomo_admin", ["i12_staff", "b24_staff"]),
+              ("em_admin", ["m01_staff", "m02_staff", "m03_staff", "m04_staff"])]
         
             
 class Replicator:
-    def __init__(self, conf_file, log_file = None):
+    def __init__(self, conf_file, log_file = None, directory = None):
 
         self.connInactivity = None
         self.conn = None
@@ -29,6 +39,29 @@ class Replicator:
         self.ispyb_host = config.get('ISPyB', 'host')
         self.ispyb_port = config.getint('ISPyB', 'port')
 
+        # One LDAP connection for the whole run. Without an [LDAP] section the server
+        # and base are those ldapsearch would use, from ldap.conf.
+        if directory is None:
+            ldap_options = {}
+            if config.has_section('LDAP'):
+                ldap_options = dict((k, v) for (k, v) in config.items('LDAP') if v)
+            cache_file = ldap_options.pop('cache_file', None)
+            cache_ttl = ldap_options.pop('cache_ttl', 3600)
+            cache_size = ldap_options.pop('cache_size', 10000)
+            directory = LDAPDirectory(**ldap_options)
+            if cache_file is not None:
+                directory = CachedDirectory(directory, LDAPCache(cache_file, cache_ttl, cache_size))
+        self.directory = directory
+
+        # [UserGroups]: <ISPyB UserGroup> = <LDAP group>[, <LDAP group> ...]
+        self.usergroups = USERGROUPS
+        mapping = ConfigParser.RawConfigParser(allow_no_value=True)
+        mapping.optionxform = str   # UserGroup names are case sensitive
+        mapping.read(conf_file)
+        if mapping.has_section('UserGroups'):
+            self.usergroups = [(name, ldap_names.replace(',', ' ').split())
+                               for (name, ldap_names) in mapping.items('UserGroups') if ldap_names]
+
     def connect(self):
         self.conn = None
         self.ispyb_cursor = None
@@ -39,7 +72,7 @@ class Replicator:
                                         db=self.ispyb_db, \
                                         port=int(self.ispyb_port))
         except Exception as e:
-            logging.getLogger().exception("%s: error while connecting to ISPyB DB :-(" % sys.argv[0])
+            logging.getLogger().exception("%s: error while connecting to ISPyB DB :-(", sys.argv[0])
             raise
         else:
             try:
@@ -47,17 +80,17 @@ class Replicator:
             except AttributeError:
                 sys.exit("Failed to set autocommit.")
 
-            logging.getLogger().info("%s: Connected to database %s on %s" % (sys.argv[0], self.conn.get_server_info(), self.conn.get_host_info()))
-            logging.getLogger().info("%s:    Database user: %s" % (sys.argv[0], self.ispyb_user))
-            logging.getLogger().info("%s:    DB name: %s" % (sys.argv[0], self.ispyb_db))
+            logging.getLogger().info("%s: Connected to database %s on %s", sys.argv[0], self.conn.get_server_info(), self.conn.get_host_info())
+            logging.getLogger().info("%s:    Database user: %s", sys.argv[0], self.ispyb_user)
+            logging.getLogger().info("%s:    DB name: %s", sys.argv[0], self.ispyb_db)
             
             try:
                 self.ispyb_cursor = self.conn.cursor()
             except Exception as e:
-                logging.getLogger().exception("%s: unable to create cursor :-(" % sys.argv[0])
+                logging.getLogger().exception("%s: unable to create cursor :-(", sys.argv[0])
                 raise
             else:
-                logging.getLogger().debug("%s: default cursor ok :-)" % sys.argv[0])
+                logging.getLogger().debug("%s: default cursor ok :-)", sys.argv[0])
 
         return (self.conn, self.ispyb_cursor)
 
@@ -66,41 +99,42 @@ class Replicator:
         if self.conn is not None:
             self.conn.close()
             self.conn = None
+        self.directory.close()
         return
 
     def dispose_cursor(self,cursor):
         if cursor is not None:
             cursor.close()
         else:
-            logging.getLogger().warning("%s: trying to dispose of an unknown cursor :-P" % sys.argv[0])
+            logging.getLogger().warning("%s: trying to dispose of an unknown cursor :-P", sys.argv[0])
 
     def cleanup(self, cursor=None):
         if cursor is not None:
             self.dispose_cursor(cursor)
 
-    def do_query(self,querystr,cursor=None,return_fetch=True,return_id=False):
+    def do_query(self,querystr,cursor=None,return_fetch=True,return_id=False,params=None):
         if cursor is None:
             cursor=self.ispyb_cursor
-            logging.getLogger().warning("%s: using default cursor :-P" % sys.argv[0])
+            logging.getLogger().warning("%s: using default cursor :-P", sys.argv[0])
             
         start_time=time.time()
         try:
-            ret=cursor.execute(querystr)
+            ret=cursor.execute(querystr, params)
         except:
-            logging.getLogger().exception("%s: exception running sql statement :-(" % sys.argv[0])
-            logging.getLogger().exception(querystr)
+            logging.getLogger().exception("%s: exception running sql statement :-(", sys.argv[0])
+            logging.getLogger().exception("%s %s", querystr, params)
             raise
         else:
-            logging.getLogger().debug("%s: query took %f seconds" %  (sys.argv[0], (time.time()-start_time)))
+            logging.getLogger().debug("%s: query took %f seconds", sys.argv[0], (time.time()-start_time))
 
         if return_fetch:
             start_time=time.time()
             try:
                 ret=cursor.fetchall()
             except:
-                logging.getLogger().exception("%s: exception fetching cursor :-(" % sys.argv[0])
+                logging.getLogger().exception("%s: exception fetching cursor :-(", sys.argv[0])
                 raise
-            logging.getLogger().debug("%s: fetch took %f seconds" %  (sys.argv[0], (time.time()-start_time)))
+            logging.getLogger().debug("%s: fetch took %f seconds", sys.argv[0], (time.time()-start_time))
         elif return_id:
             start_time=time.time()
             
@@ -111,173 +145,175 @@ class Replicator:
             #    raise
 
             ret = cursor.lastrowid
-            logging.getLogger().debug("%s: id took %f seconds" % (sys.argv[0], (time.time()-start_time)))
+            logging.getLogger().debug("%s: id took %f seconds", sys.argv[0], (time.time()-start_time))
 
         return ret
 
-    def update_person(self, login, family_name, given_name, cursor):
-        if login is None:
-            return None
-        q_login = "'%s'" % login.replace("'", "''")
-        if family_name is None:
-            q_family_name = "NULL"
-        else:
-            q_family_name = "'%s'" % family_name.replace("'", "''")
-        if given_name is None:
-            q_given_name = "NULL"
-        else:
-            q_given_name = "'%s'" % given_name.replace("'", "''")
-        
-        sql = """UPDATE %s.Person SET familyName=%s, givenName=%s WHERE login=%s"""\
-         % (self.ispyb_db, q_family_name, q_given_name, q_login)  
-        logging.getLogger().debug(sql)
-        return self.do_query(sql, cursor, return_fetch=False, return_id=False)
+    def do_many(self, querystr, seq_params, cursor):
+        '''Execute querystr once for each tuple of parameters in seq_params (an INSERT's rows
+        are sent as one multi-row statement).'''
+        start_time=time.time()
+        try:
+            cursor.executemany(querystr, seq_params)
+        except:
+            logging.getLogger().exception("%s: exception running sql statement :-(", sys.argv[0])
+            logging.getLogger().exception("%s [%d rows]", querystr, len(seq_params))
+            raise
+        logging.getLogger().debug("%s: %s [%d rows] took %f seconds", sys.argv[0], querystr, len(seq_params), time.time()-start_time)
 
-    def insert_person(self, login, cursor):
+    def update_person(self, login, family_name, given_name, cursor):
         if login is None:
             return None
-        (sn, given_name) = self.ldapsearch_person(login)
-        q_login = "'%s'" % login.replace("'", "''")
-        q_sn = "'%s'" % sn.replace("'", "''")
-        q_given_name = "'%s'" % given_name.replace("'", "''")
-        
-        sql = """insert into %s.Person (login, familyName, givenName) values (
-                %s, %s, %s
-            )""" % (self.ispyb_db, q_login, q_sn, q_given_name)  
-        logging.getLogger().debug(sql)
-        return self.do_query(sql, cursor, return_fetch=False, return_id=True)
+        sql = """UPDATE %s.Person SET familyName=%%s, givenName=%%s WHERE login=%%s""" % self.ispyb_db
+        logging.getLogger().debug("%s %s", sql, [family_name, given_name, login])
+        return self.do_query(sql, cursor, return_fetch=False, return_id=False, params=[family_name, given_name, login])
+
+    def insert_persons(self, persons, cursor):
+        '''Insert the (login, familyName, givenName) persons, and return the map of their
+        logins to the new personIds.'''
+        if not persons:
+            return {}
+        sql = """INSERT INTO %s.Person (login, familyName, givenName) VALUES (%%s, %%s, %%s)""" % self.ispyb_db
+        self.do_many(sql, persons, cursor)
+        return self.select_person_ids([person[0] for person in persons], cursor)
 
     def ldapsearch_person(self, uid):
-        output = subprocess.check_output("""ldapsearch -x -LLL -s sub -b uid=%s,ou=People,dc=diamond,dc=ac,dc=uk "(&(objectClass=person))" sn givenName""" % uid, stderr=subprocess.STDOUT, shell=True)
-        if output is not None and output != '':
-            lines = output.split('\n')
-            sn = None
-            given_name = None
-            sn_l = [i for i in lines if i.startswith('sn:')]
-            if len(sn_l) == 1:
-                sn = sn_l[0][4:]
-            given_name_l = [i for i in lines if i.startswith('givenName:')]
-            if len(given_name_l) == 1:
-                given_name = given_name_l[0][11:]
-            return (sn, given_name)
+        '''Return the (sn, givenName) of the LDAP person uid, each None unless it has exactly one.'''
+        return self.directory.person(uid)
+
+    def ldapsearch_persons(self, uids):
+        '''Return a dict of uid -> (sn, givenName) for the LDAP persons uids, fetching them
+        with a few searches for many uids each.'''
+        return self.directory.persons(uids)
 
     def ldapsearch_group(self, group_names):
-        people_set = set()
-        for group_name in group_names:
-            output = subprocess.check_output("""ldapsearch -x -LLL -s sub "(&(objectClass=posixGroup)(cn=%s))" memberUid | grep 'memberUid:' | cut -c 12-""" % group_name, stderr=subprocess.STDOUT, shell=True)
-            if output is not None and output != '':
-                people = output.split('\n')
-                people.pop() # remove last item which is empty
-                people_set = people_set | set(people)
-        return people_set
-
-    def select_usergroup(self, usergroup, cursor):
-        ugid = None
+        '''Return the set of uids of the members of the LDAP groups group_names.'''
+        return self.ldapsearch_groups([group_names])[0]
+
+    def ldapsearch_groups(self, group_name_lists):
+        '''Return the sets of uids of the members of each list of LDAP groups in
+        group_name_lists. Each LDAP group, nested groups included, is searched for once.'''
+        expanded = self.directory.expanded_groups(set([name for names in group_name_lists for name in names]))
+        people_sets = []
+        for group_names in group_name_lists:
+            people_set = set()
+            for group_name in group_names:
+                people_set |= expanded[group_name]
+            people_sets.append(people_set)
+        return people_sets
+
+    def select_usergroups(self, names, cursor):
+        '''Return a dict of UserGroup name -> (userGroupId, {personId: (login, familyName, givenName)})
+        for the UserGroups names and their members, in one query.'''
+        if not names:
+            return {}
         sql = \
-        """SELECT ug.userGroupId
+        """SELECT ug.name, ug.userGroupId, p.personId, p.login, p.familyName, p.givenName
         FROM %s.UserGroup ug
-        WHERE ug.name = '%s'""" % (self.ispyb_db, usergroup)
-        rs = self.do_query(sql, cursor, return_fetch=True)
-        
-        if rs is not None and len(rs) > 0 and rs[0] is not None:
-            ugid = rs[0][0]
-        else:
-            return (None, None)
-
-        sql = \
-        """SELECT p.login, p.familyName, p.givenName 
-        FROM %s.Person p
-            INNER JOIN %s.UserGroup_has_Person ughp ON ughp.personId = p.personId 
-        WHERE ughp.userGroupId = %s""" % (self.ispyb_db, self.ispyb_db, ugid)
+            LEFT JOIN %s.UserGroup_has_Person ughp ON ughp.userGroupId = ug.userGroupId
+            LEFT JOIN %s.Person p ON p.personId = ughp.personId
+        WHERE ug.name IN (%s)
+        ORDER BY ug.userGroupId""" % (self.ispyb_db, self.ispyb_db, self.ispyb_db, ', '.join(['%s'] * len(names)))
+        rs = self.do_query(sql, cursor, return_fetch=True, params=list(names))
+
+        usergroups = {}
+        for (name, ugid, pid, login, family_name, given_name) in rs:
+            # the first of UserGroups with the same name, as before
+            (group_ugid, members) = usergroups.setdefault(name, (ugid, {}))
+            if ugid == group_ugid and pid is not None:
+                members[pid] = (login, family_name, given_name)
+        return usergroups
+
+    def select_person_ids(self, logins, cursor):
+        '''Return a dict of lower case login -> personId (the lowest, if several) for those of logins in the Person table.'''
+        logins = sorted(set(logins))
+        if not logins:
+            return {}
+        sql = "SELECT lower(login), min(personId) FROM %s.Person WHERE login IN (%s) GROUP BY lower(login)" % (self.ispyb_db, ', '.join(['%s'] * len(logins)))
+        return dict(self.do_query(sql, cursor, return_fetch=True, params=logins))
+
+    def insert_usergroup_has_persons(self, ugid, pids, cursor):
+        if pids:
+            insert = "INSERT INTO %s.UserGroup_has_Person (userGroupId, personId) VALUES (%%s, %%s)" % self.ispyb_db
+            self.do_many(insert, [(ugid, pid) for pid in pids], cursor)
+
+    def delete_usergroup_has_persons(self, ugid, pids, cursor):
+        if pids:
+            delete = "DELETE FROM %s.UserGroup_has_Person WHERE userGroupId = %%s AND personId IN (%s)" % (self.ispyb_db, ', '.join(['%s'] * len(pids)))
+            self.do_query(delete, cursor, return_fetch=False, params=[ugid] + list(pids))
 
-        rs = self.do_query(sql, cursor, return_fetch=True)
-        return (ugid, rs)
-    
-    
     def run_group_propagation(self, cursor):
-        # sets of members of LDAP groups
-        ldap_super_admin = self.ldapsearch_group(["dls_dasc"])
-        ldap_mx_admin = self.ldapsearch_group(["mx_staff"])
-        ldap_saxs_admin = self.ldapsearch_group(["b21_staff"])
-        ldap_powder_admin = self.ldapsearch_group(["i11_staff"])
-        ldap_tomo_admin = self.ldapsearch_group(["i12_staff", "b24_staff"])
-        ldap_em_admin = self.ldapsearch_group(["m01_staff", "m02_staff", "m03_staff", "m04_staff"])
-        
-
-        # get sets (fed_id, DB personId) for members of DB usergroups
-        (db_super_admin_ugid, db_super_admin) = self.select_usergroup("super_admin", cursor)
-        (db_mx_admin_ugid, db_mx_admin) = self.select_usergroup("mx_admin", cursor)
-        (db_saxs_admin_ugid, db_saxs_admin) = self.select_usergroup("saxs_admin", cursor)
-        (db_powder_admin_ugid, db_powder_admin) = self.select_usergroup("powder_admin", cursor)
-        (db_tomo_admin_ugid, db_tomo_admin) = self.select_usergroup("tomo_admin", cursor)
-        (db_em_admin_ugid, db_em_admin) = self.select_usergroup("em_admin", cursor)
-
-        groups = [  [db_super_admin_ugid, db_super_admin, ldap_super_admin], 
-                    [db_mx_admin_ugid, db_mx_admin, ldap_mx_admin],
-                    [db_saxs_admin_ugid, db_saxs_admin, ldap_saxs_admin], 
-                    [db_powder_admin_ugid, db_powder_admin, ldap_powder_admin], 
-                    [db_tomo_admin_ugid, db_tomo_admin, ldap_tomo_admin], 
-                    [db_em_admin_ugid, db_em_admin, ldap_em_admin]
-                ]
-        for group in groups:
-            ugid = group[0]
-            db_group_members = group[1]
-            ldap_group_members = group[2]
-
-            if ugid is None or db_group_members is None:
-                continue
-
-            # Create DB logins set + update entry in Person table if needed 
+        # members of the DB usergroups, and the sets of members of their LDAP groups
+        usergroups = self.select_usergroups([name for (name, ldap_names) in self.usergroups], cursor)
+        mapped = [(name, ldap_names) for (name, ldap_names) in self.usergroups if name in usergroups]
+        for (name, ldap_names) in self.usergroups:
+            if name not in usergroups:
+                logging.getLogger().warning("%s: no UserGroup %s in ISPyB", sys.argv[0], name)
+        ldap_sets = self.ldapsearch_groups([ldap_names for (name, ldap_names) in mapped])
+        groups = []
+        for ((name, ldap_names), ldap_group_members) in zip(mapped, ldap_sets):
+            (ugid, db_group_members) = usergroups[name]
+            # Logins are compared in lower case, as MySQL compares them
+            db_group_members = dict((pid, (login.lower() if login is not None else None, family_name, given_name))
+                                    for (pid, (login, family_name, given_name)) in db_group_members.items())
+            groups.append((ugid, db_group_members, set([uid.lower() for uid in ldap_group_members])))
+
+        # Fetch the LDAP names of all the persons to compare or insert at once: staff
+        # in several groups are only looked up once
+        logins = set()
+        for (ugid, db_group_members, ldap_group_members) in groups:
+            logins |= set([login for (login, family_name, given_name) in db_group_members.values()]) | ldap_group_members
+        logins.discard(None)
+        ldap_persons = self.ldapsearch_persons(logins)
+
+        # All the changes are made in one transaction
+        self.conn.autocommit(False)
+        try:
+            # Update entries in the Person table if needed
             db_logins_set = set()
-            for row in db_group_members:
-                db_logins_set.add(row[0])
-                (ldap_family_name, ldap_given_name) = self.ldapsearch_person(row[0])
-                if ldap_family_name != row[1] or ldap_given_name != row[2]:
-                    self.update_person(row[0], ldap_family_name, ldap_given_name, cursor)
-            
-            # The set of ldap_group_members after removing elements found in db_group_members:
-            members_2_insert = ldap_group_members.difference(db_logins_set) 
-            logging.getLogger().debug("members_2_insert")
-            logging.getLogger().debug(members_2_insert)
-            # The set of db_group_members after removing elements found in ldap_group_members
-            members_2_delete = db_logins_set.difference(ldap_group_members) 
-            logging.getLogger().debug("members_2_delete")
-            logging.getLogger().debug(members_2_delete)
-            
-            if members_2_insert is not None:
-                for member in members_2_insert:
-                    self.insert_usergroup_has_person(ugid, member, cursor)
-            if members_2_delete is not None:
-                for member in members_2_delete:
-                    self.delete_usergroup_has_person(ugid, member, cursor)
-
-
-    def select_person(self, login, cursor):
-        pid = None
-        select  = "SELECT personId FROM %s.Person WHERE login = '%s'" % (self.ispyb_db, login)
-        logging.getLogger().debug(select)
-        rs = self.do_query(select, cursor, return_fetch=True)
-        if rs is not None and len(rs) > 0 and rs[0] is not None:
-            pid = rs[0][0]
-        return pid
-
-    def insert_usergroup_has_person(self, ugid, login, cursor):
-        pid = self.select_person(login, cursor)
-        if pid is None:
-            pid = self.insert_person(login, cursor)
-            
-        insert = "INSERT INTO %s.UserGroup_has_Person (userGroupId, personId) values (%s, %s)" % (self.ispyb_db, ugid, pid)
-        logging.getLogger().debug(insert)
-        self.do_query(insert, cursor, return_fetch=False)
-            
-    def delete_usergroup_has_person(self, ugid, login, cursor):
-        pid = self.select_person(login, cursor)
-        if pid is not None:
-            delete = "DELETE FROM %s.UserGroup_has_Person WHERE userGroupId = %s AND personId = %s" % (self.ispyb_db, ugid, pid)
-            self.do_query(delete, cursor, return_fetch=False)
+            for (ugid, db_group_members, ldap_group_members) in groups:
+                for (login, family_name, given_name) in db_group_members.values():
+                    if login is None or login in db_logins_set:
+                        continue
+                    db_logins_set.add(login)
+                    (ldap_family_name, ldap_given_name) = ldap_persons[login]
+                    if ldap_family_name != family_name or ldap_given_name != given_name:
+                        self.update_person(login, ldap_family_name, ldap_given_name, cursor)
+
+            # personIds of the LDAP group members, inserting those not in Person
+            person_ids = {}
+            new_logins = set()
+            for (ugid, db_group_members, ldap_group_members) in groups:
+                for (pid, (login, family_name, given_name)) in db_group_members.items():
+                    person_ids[login] = min(pid, person_ids.get(login, pid))
+                new_logins |= ldap_group_members
+            person_ids.update(self.select_person_ids(new_logins - db_logins_set, cursor))
+            person_ids.update(self.insert_persons([(login,) + ldap_persons[login]
+                                                   for login in sorted(new_logins - db_logins_set - set(person_ids))], cursor))
+
+            for (ugid, db_group_members, ldap_group_members) in groups:
+                db_logins = set([login for (login, family_name, given_name) in db_group_members.values()])
+                # The set of ldap_group_members after removing elements found in db_group_members:
+                members_2_insert = sorted(ldap_group_members.difference(db_logins))
+                logging.getLogger().debug("members_2_insert")
+                logging.getLogger().debug(members_2_insert)
+                # The db_group_members not found in ldap_group_members
+                pids_2_delete = sorted([pid for (pid, (login, family_name, given_name)) in db_group_members.items()
+                                        if login not in ldap_group_members])
+                logging.getLogger().debug("members_2_delete")
+                logging.getLogger().debug([db_group_members[pid][0] for pid in pids_2_delete])
+
+                self.insert_usergroup_has_persons(ugid, [person_ids[login] for login in members_2_insert if login in person_ids], cursor)
+                self.delete_usergroup_has_persons(ugid, pids_2_delete, cursor)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.autocommit(True)
             
 def printQuitMessage():
-    logging.getLogger().info("%s: exiting python interpreter :-(" % sys.argv[0])
+    logging.getLogger().info("%s: exiting python interpreter :-(", sys.argv[0])
     logging.shutdown()
 
 def printUsage():
@@ -287,11 +323,18 @@ def printUsage():
     print "     -h|--help : display this help"
     print "     -c|--conf <conf file> : use the given configuration file"
     print "     -l|--log <log file>: use the given log file"
+    print "The LDAP server is given by the optional [LDAP] section of the configuration file:"
+    print "server (an LDAP URI), base, people_base, user and pw. Without it the server and base"
+    print "are the URI and BASE of ldap.conf. With cache_file set, results are cached in that"
+    print "file for cache_ttl seconds (default 3600), then refreshed only if their entry's"
+    print "entryCSN or modifyTimestamp changed, keeping up to cache_size (default 10000)."
+    print "The optional [UserGroups] section maps ISPyB UserGroups to the LDAP groups whose"
+    print "members, nested groups included, they should have: <UserGroup> = <LDAP group>, ..."
     print "The default configuration file is config/credentials.cfg"
 
 def killHandler(sig,frame):
     hostname = os.uname()[1]
-    logging.getLogger().warning("%s: got SIGTERM on %s :-O" % (sys.argv[0], hostname))
+    logging.getLogger().warning("%s: got SIGTERM on %s :-O", sys.argv[0], hostname)
     logging.shutdown()
     os._exit(-1)
 
@@ -38,7 +38,12 @@ setup(
     install_requires=[
       'cx_Oracle',
       'mysql-connector<2.2.3',
+      'futures; python_version < "3"',
     ],
+    extras_require={
+      'snapshot': ['msgpack'],
+      'ldap': ['ldap3'],
+    },
     setup_requires=[
       'pytest-runner',
     ],
@@ -0,0 +1,40 @@
+import datetime
+
+import context
+from datasync.fingerprint import fingerprint, FingerprintStore
+
+def test_fingerprint_compares_values():
+    start = datetime.datetime(2018, 1, 15, 9, 0, 0)
+    assert fingerprint(('cm12345-6', start, 1)) == fingerprint((u'cm12345-6', datetime.datetime(2018, 1, 15, 9), 1))
+    assert fingerprint(('cm12345-6', start, 1)) != fingerprint(('cm12345-6', start, 0))
+    # None, empty strings and the text 'None' are all different
+    assert len(set([fingerprint((None,)), fingerprint(('',)), fingerprint(('None',))])) == 3
+    assert fingerprint(('a', 'b')) != fingerprint(('ab', ''))
+
+def test_fingerprint_store(tmpdir):
+    path = str(tmpdir.join('fingerprints.json'))
+    store = FingerprintStore(path, full_interval=100)
+    assert store.known('persons', 1000) == {}
+    store.update('persons', {'A': 1, 'B': 2}, True, 1000)
+    store.update('persons', {'B': 3}, False, 1050)
+
+    store = FingerprintStore(path, full_interval=100)
+    assert store.known('persons', 1050) == {'A': 1, 'B': 3}
+    # the last full sync is too old
+    assert store.known('persons', 1101) == {}
+    assert FingerprintStore(path, full=True).known('persons', 1050) == {}
+
+def test_unapplied_rows_are_not_recorded():
+    from datasync.main import _without_keys
+    fingerprints = {'A' * 32: 1, 'B' * 32: 2}
+    assert _without_keys(fingerprints, []) is fingerprints
+    assert _without_keys(fingerprints, ['b' * 32, 'C' * 32]) == {'A' * 32: 1}
+
+def test_fingerprint_store_writes_one_file_per_entity(tmpdir):
+    path = str(tmpdir.join('fingerprints'))
+    store = FingerprintStore(path)
+    store.update('persons', {'A': 1}, True, 1000)
+    assert sorted(f.basename for f in tmpdir.listdir()) == ['fingerprints.persons']
+    store.update('sessions', {'S': 2}, True, 1000)
+    assert sorted(f.basename for f in tmpdir.listdir()) == ['fingerprints.persons', 'fingerprints.sessions']
+    assert FingerprintStore(path).known('sessions', 1050) == {'S': 2}
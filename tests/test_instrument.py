@@ -0,0 +1,31 @@
+import json
+
+import context
+from datasync.instrument import QueryStats, normalise
+
+def test_normalise_collapses_values():
+    assert normalise("SELECT * FROM Person\n  WHERE login = 'abc' AND personId IN (1, 2, 3)") == \
+        "SELECT * FROM Person WHERE login = ? AND personId IN (?)"
+    assert normalise("INSERT INTO T (a, b) VALUES (%s, %s), (%s, %s), (%s, %s)") == \
+        normalise("INSERT INTO T (a, b) VALUES (%s, %s)") + ", ..."
+    assert normalise("SELECT rawtohex(id) FROM t1 WHERE ora_rowscn > :1") == "SELECT rawtohex(id) FROM t1 WHERE ora_rowscn > ?"
+
+def test_query_stats_aggregate_by_stage_and_statement():
+    stats = QueryStats()
+    with stats.stage('persons'):
+        for i in range(100):
+            stats.record("SELECT * FROM Person WHERE personId = %d" % i, 0.001 * (i + 1), rows=1)
+        stats.record("UPDATE Person SET login=%s WHERE personId=%s", 0.5, affected=10, executions=10)
+    stats.record("SELECT 1", 0.01)
+    results = stats.results()
+    assert [(r['stage'], r['statement']) for r in results] == [
+        ('persons', 'SELECT * FROM Person WHERE personId = ?'),
+        ('persons', 'UPDATE Person SET login=? WHERE personId=?'),
+        ('', 'SELECT ?')]
+    select = results[0]
+    assert select['count'] == 100 and select['rows'] == 100
+    assert abs(select['p50_s'] - 0.051) < 1e-9 and abs(select['max_s'] - 0.1) < 1e-9
+    assert results[1]['executions'] == 10 and results[1]['affected'] == 10
+    assert json.loads(stats.to_json())[0]['count'] == 100
+    prom = stats.to_prometheus()
+    assert 'datasync_query_seconds_count{stage="persons",statement="SELECT * FROM Person WHERE personId = ?"} 100' in prom
@@ -0,0 +1,75 @@
+import pytest
+
+import context
+pytest.importorskip('ldap3')
+from datasync.ldapcache import LDAPCache, CachedDirectory
+
+class Directory:
+    '''Stands in for an LDAPDirectory, recording what is searched for.'''
+    def __init__(self):
+        self.persons = {'abc12345': (('Smith', 'Ann'), '1'), 'xyz98765': (('Jones', 'Bob'), '1')}
+        self.groups = {'mx_staff': ((set(['abc12345']), set(['mx_visitors'])), '1'),
+                       'mx_visitors': ((set(['xyz98765']), set()), '1')}
+        self.searches = []
+        self.closed = False
+
+    def stamped_persons(self, uids):
+        if uids:
+            self.searches.append(('persons', sorted(uids)))
+        return dict((uid, self.persons.get(uid, ((None, None), None))) for uid in uids)
+
+    def person_stamps(self, uids):
+        self.searches.append(('person stamps', sorted(uids)))
+        return dict((uid, self.persons[uid][1]) for uid in uids if uid in self.persons)
+
+    def stamped_groups(self, names):
+        if names:
+            self.searches.append(('groups', sorted(names)))
+        return dict((name, self.groups.get(name, ((set(), set()), None))) for name in names)
+
+    def group_stamps(self, names):
+        self.searches.append(('group stamps', sorted(names)))
+        return dict((name, self.groups[name][1]) for name in names if name in self.groups)
+
+    def close(self):
+        self.closed = True
+
+def test_cached_directory(tmpdir):
+    path = str(tmpdir.join('ldap.json'))
+    directory = Directory()
+    cached = CachedDirectory(directory, LDAPCache(path, ttl=3600))
+    assert cached.persons(['abc12345', 'xyz98765']) == {'abc12345': ('Smith', 'Ann'), 'xyz98765': ('Jones', 'Bob')}
+    assert cached.group_members('mx_staff') == set(['abc12345', 'xyz98765'])
+    cached.close()
+    assert directory.closed
+    assert directory.searches == [('persons', ['abc12345', 'xyz98765']), ('groups', ['mx_staff']), ('groups', ['mx_visitors'])]
+
+    # fresh results come from the file
+    directory.searches = []
+    cached = CachedDirectory(directory, LDAPCache(path, ttl=3600))
+    assert cached.persons(['abc12345', 'nobody']) == {'abc12345': ('Smith', 'Ann'), 'nobody': (None, None)}
+    assert cached.group_members('mx_staff') == set(['abc12345', 'xyz98765'])
+    cached.close()
+    assert directory.searches == [('persons', ['nobody'])]
+
+    # stale results are checked by stamp and only the changed entries fetched
+    directory.searches = []
+    directory.persons['xyz98765'] = (('Jones', 'Robert'), '2')
+    cached = CachedDirectory(directory, LDAPCache(path, ttl=-1))
+    assert cached.persons(['abc12345', 'xyz98765']) == {'abc12345': ('Smith', 'Ann'), 'xyz98765': ('Jones', 'Robert')}
+    assert cached.group_members('mx_staff') == set(['abc12345', 'xyz98765'])
+    assert directory.searches == [('person stamps', ['abc12345', 'xyz98765']), ('persons', ['xyz98765']),
+                                  ('group stamps', ['mx_staff']), ('group stamps', ['mx_visitors'])]
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    path = str(tmpdir.join('ldap.json'))
+    cache = LDAPCache(path, max_entries=2)
+    cache.put('persons', 'a', ['A', 'a'], None, 100)
+    cache.put('persons', 'b', ['B', 'b'], None, 101)
+    cache.put('persons', 'c', ['C', 'c'], None, 102)
+    cache.used('persons', 'a', 103)
+    cache.save()
+    cache = LDAPCache(path)
+    assert cache.lookup('persons', 'b') is None
+    assert cache.lookup('persons', 'a')['value'] == ['A', 'a']
+    assert cache.lookup('persons', 'c') is not None
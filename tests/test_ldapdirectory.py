@@ -0,0 +1,76 @@
+import pytest
+
+import context
+pytest.importorskip('ldap3')
+from datasync.ldapdirectory import LDAPDirectory
+
+ENTRIES = {
+  'uid=abc12345,ou=People,dc=diamond,dc=ac,dc=uk': {'objectClass': ['person'], 'uid': 'abc12345',
+                                                    'sn': 'Smith', 'givenName': 'Ann', 'modifyTimestamp': '20180115090000Z'},
+  'uid=xyz98765,ou=People,dc=diamond,dc=ac,dc=uk': {'objectClass': ['person'], 'uid': 'xyz98765', 'sn': 'Jones'},
+  'cn=mx_staff,ou=Group,dc=diamond,dc=ac,dc=uk': {'objectClass': ['posixGroup'], 'cn': 'mx_staff',
+                                                  'memberUid': ['abc12345', 'xyz98765'], 'entryCSN': '20180115090000.000000Z#000000#000#000000'},
+  'cn=i12_staff,ou=Group,dc=diamond,dc=ac,dc=uk': {'objectClass': ['posixGroup'], 'cn': 'i12_staff',
+                                                   'memberUid': ['xyz98765']},
+  'cn=imaging_staff,ou=Group,dc=diamond,dc=ac,dc=uk': {'objectClass': ['groupOfNames'], 'cn': 'imaging_staff',
+      'member': ['cn=i12_staff,ou=Group,dc=diamond,dc=ac,dc=uk', 'uid=abc12345,ou=People,dc=diamond,dc=ac,dc=uk',
+                 'cn=all_staff,ou=Group,dc=diamond,dc=ac,dc=uk']},
+  'cn=all_staff,ou=Group,dc=diamond,dc=ac,dc=uk': {'objectClass': ['groupOfNames'], 'cn': 'all_staff',
+      'member': ['cn=imaging_staff,ou=Group,dc=diamond,dc=ac,dc=uk', 'uid=def55555,ou=People,dc=diamond,dc=ac,dc=uk']},
+}
+
+def test_person():
+    directory = LDAPDirectory.stand_in(ENTRIES)
+    assert directory.person('abc12345') == ('Smith', 'Ann')
+    assert directory.person('xyz98765') == ('Jones', None)
+    assert directory.person('nobody') == (None, None)
+    # filter characters in the uid are escaped
+    assert directory.person('abc*') == (None, None)
+
+def test_persons():
+    directory = LDAPDirectory.stand_in(ENTRIES)
+    searches = []
+    search = directory.search
+    def counted(*args):
+        searches.append(args)
+        return search(*args)
+    directory.search = counted
+    persons = directory.persons(['abc12345', 'XYZ98765', 'nobody', 'abc12345'], chunk_size=2)
+    assert persons == {'abc12345': ('Smith', 'Ann'), 'XYZ98765': ('Jones', None), 'nobody': (None, None)}
+    # three distinct uids, two at a time
+    assert len(searches) == 2
+
+def test_group_members():
+    directory = LDAPDirectory.stand_in(ENTRIES)
+    conn = directory.conn
+    assert directory.group_members('mx_staff') == set(['abc12345', 'xyz98765'])
+    assert directory.group_members('i12_staff') == set(['xyz98765'])
+    assert directory.group_members('no_staff') == set()
+    # one connection for all the searches
+    assert directory.connect() is conn
+
+def test_stamps():
+    directory = LDAPDirectory.stand_in(ENTRIES)
+    assert directory.stamped_persons(['abc12345', 'xyz98765']) == {'abc12345': (('Smith', 'Ann'), '20180115090000Z'),
+                                                                   'xyz98765': (('Jones', None), None)}
+    assert directory.person_stamps(['abc12345', 'xyz98765', 'nobody']) == {'abc12345': '20180115090000Z', 'xyz98765': None}
+    assert directory.stamped_groups(['mx_staff'])['mx_staff'][1] == '20180115090000.000000Z#000000#000#000000'
+    assert directory.group_stamps(['mx_staff', 'i12_staff', 'no_staff']) == {'mx_staff': '20180115090000.000000Z#000000#000#000000',
+                                                                             'i12_staff': None}
+
+def test_nested_groups():
+    directory = LDAPDirectory.stand_in(ENTRIES)
+    searches = []
+    search = directory.search
+    def counted(*args):
+        searches.append(args)
+        return search(*args)
+    directory.search = counted
+    # all_staff and imaging_staff contain each other
+    expanded = directory.expanded_groups(['imaging_staff', 'mx_staff'])
+    assert expanded == {'imaging_staff': set(['abc12345', 'xyz98765', 'def55555']),
+                        'mx_staff': set(['abc12345', 'xyz98765'])}
+    # one search per level of nesting
+    assert len(searches) == 2
+    assert directory.group_members('all_staff') == set(['abc12345', 'xyz98765', 'def55555'])
+    assert len(searches) == 2
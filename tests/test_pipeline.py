@@ -0,0 +1,61 @@
+import threading
+
+import context
+from datasync.main import DataSync
+from datasync.pipeline import PipelinedWorker
+from datasync.sampledlog import SampledLog
+
+GUID_A = 'A' * 32
+GUID_B = 'B' * 32
+
+class Source:
+    def __init__(self, target_extracting):
+        self.target_extracting = target_extracting
+
+    def extract_session_types(self):
+        # only returns once the target extract has started
+        assert self.target_extracting.wait(5)
+        return [(GUID_A, 'Remote', 'cm12345-1'), (GUID_B, 'Remote', 'cm12345-2')]
+
+class Target:
+    def __init__(self):
+        self.extracting = threading.Event()
+        self.log = []
+
+    def extract_session_types(self):
+        self.extracting.set()
+        return [(GUID_A, 'Remote')]
+
+    def insert_session_type(self, guid, tag, visit):
+        self.log.append(('insert', guid, threading.current_thread().name))
+
+    def begin_stage(self):
+        pass
+
+    def commit(self):
+        self.log.append(('commit',))
+
+    def rollback(self):
+        self.log.append(('rollback',))
+
+class Sync(DataSync):
+    def __init__(self, source, target):
+        self.source_conn = source
+        self.target_conn = target
+        self.query_stats = None
+        self.target_mode = 'rows'
+        self.reconcile_mode = 'hash'
+        self.watermarks = None
+        self.fingerprints = None
+        self.action_counts = {}
+        self.sampled_log = SampledLog()
+
+def test_extracts_overlap_and_writes_run_on_the_target_thread():
+    target = Target()
+    worker = PipelinedWorker(Sync(Source(target.extracting), target), owned=False)
+    try:
+        worker.run_stage('session_types')
+    finally:
+        worker.close()
+    assert [entry[0:2] for entry in target.log] == [('insert', GUID_B), ('commit',)]
+    assert target.log[0][2] != threading.current_thread().name
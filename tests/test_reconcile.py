@@ -0,0 +1,57 @@
+from operator import itemgetter
+
+import context
+from datasync.reconcile import reconcile, merge_reconcile, INSERT, UPDATE, DELETE, UNCHANGED
+
+KEYS = [(itemgetter(0), itemgetter(0)), (itemgetter(1), itemgetter(1))]
+
+def changed(src, tgt):
+    return src[2] != tgt[2]
+
+def deleted(src):
+    return src[2] == 'Cancelled'
+
+def test_reconcile_classifies_rows():
+    src = [('A', 'alice', 'x'), ('B', 'bob', 'y'), ('C', 'carol', 'z'), ('D', 'dave', 'Cancelled'), ('E', 'eve', 'Cancelled')]
+    tgt = [('A', 'alice', 'x', 1), ('B', 'bob', 'old', 2), (None, 'carol', 'z', 3), ('D', 'dave', 'w', 4)]
+    actions = [(a, s[0], t[3] if t else None) for a, s, t in reconcile(src, tgt, KEYS, changed=changed, deleted=deleted)]
+    assert actions == [(UNCHANGED, 'A', 1), (UPDATE, 'B', 2), (UNCHANGED, 'C', 3), (DELETE, 'D', 4)]
+
+def test_reconcile_inserts_unmatched_rows():
+    src = [('F', 'frank', 'x')]
+    actions = list(reconcile(src, [('A', 'alice', 'x', 1)], KEYS))
+    assert actions == [(INSERT, src[0], None)]
+
+def test_reconcile_prefers_first_matching_target_row():
+    # Matches row 2 on the secondary key and row 3 on the primary key: the nested loop picked row 2.
+    src = [('A', 'alice', 'x')]
+    tgt = [('Z', 'zed', 'x', 1), ('Y', 'alice', 'x', 2), ('A', 'other', 'x', 3)]
+    actions = list(reconcile(src, tgt, KEYS))
+    assert actions[0][2][3] == 2
+
+def test_merge_reconcile_matches_hash_reconcile():
+    src = [('A', 'alice', 'x'), ('B', 'bob', 'y'), ('C', 'carol', 'z'), ('D', 'dave', 'Cancelled'), ('G', 'gina', 'x')]
+    tgt = [(None, 'carol', 'z', 3), ('A', 'alice', 'x', 1), ('B', 'bob', 'old', 2), ('D', 'dave', 'w', 4), ('F', 'frank', 'x', 5)]
+    hashed = list(reconcile(src, tgt, KEYS, changed=changed, deleted=deleted))
+    merged = list(merge_reconcile(iter(src), iter(tgt), KEYS, changed=changed, deleted=deleted))
+    assert sorted(merged) == sorted(hashed)
+    assert (INSERT, src[4], None) in merged
+
+def test_merge_reconcile_rejects_unsorted_input():
+    src = [('B', 'bob', 'y'), ('A', 'alice', 'x')]
+    try:
+        list(merge_reconcile(src, [], KEYS))
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+
+def test_differing_ranges():
+    from datasync.checksum import range_checksums, differing_ranges, person_text
+    src = [('AA01', 'alice', 'Dr', 'Alice', 'A'), ('AB02', 'bob', 'Mr', 'Bob', 'B'), ('BC03', 'carol', None, 'Carol', 'C')]
+    tgt = [('AA01', 'alice', 'Dr', 'Alice', 'A'), ('AB02', 'bob', 'Mr', 'Bob', 'Smith'), ('DD04', 'dave', 'Dr', 'Dave', 'D')]
+    key = itemgetter(0)
+    assert differing_ranges(range_checksums(src, key, person_text, 1), range_checksums(tgt, key, person_text, 1)) == ['A', 'B', 'D']
+    assert differing_ranges(range_checksums(src, key, person_text, 2), range_checksums(tgt, key, person_text, 2)) == ['AB', 'BC', 'DD']
+    # None and empty strings are the same, as in the SQL checksums
+    assert person_text(('BC03', 'carol', None, 'Carol', 'C')) == person_text(('BC03', 'carol', '', 'Carol', 'C'))
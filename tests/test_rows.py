@@ -0,0 +1,53 @@
+import datetime
+
+import context
+from datasync import rows
+from datasync.main import _SESSION_KEYS, _session_changed, _session_deleted, _person_changed, _person_fingerprint
+from datasync.fingerprint import fingerprint
+from datasync.reconcile import reconcile, INSERT, UPDATE, DELETE, UNCHANGED
+
+GUID_A = 'A' * 32
+GUID_B = 'B' * 32
+
+def test_compact_shares_strings():
+    start = datetime.datetime(2018, 1, 15, 9)
+    rs = [(GUID_A, 'cm12345-1', ''.join(['i', '03']), None, start, start, ''.join(['Sch', 'eduled']), 'ops'),
+          (GUID_B, 'cm12345-2', ''.join(['i', '03']), None, start, start, ''.join(['Sch', 'eduled']), None)]
+    assert rs[0][2] is not rs[1][2]
+    compacted = rows.compact(rs, rows.UASSession)
+    assert compacted is rs
+    assert rs[0].beamline is rs[1].beamline
+    assert rs[0].state is rs[1].state
+    assert rs[1].guid == GUID_B and rs[1].operators is None
+    assert tuple(rs[0]) == (GUID_A, 'cm12345-1', 'i03', None, start, start, 'Scheduled', 'ops')
+
+def test_compact_records_reconcile():
+    start = datetime.datetime(2018, 1, 15, 9)
+    strings = {}
+    uas_rs = rows.compact(iter([(GUID_A, 'cm1-1', 'i03', None, start, start, 'Scheduled', None),
+                                (GUID_B, 'cm1-2', 'i03', None, start, start, 'Cancelled', None)]), rows.UASSession, strings)
+    ispyb_rs = rows.compact([(GUID_A, 'cm1-1', 'i03', 'a comment', start, start, 1, None, 1),
+                             (GUID_B, 'cm1-2', 'i04', None, start, start, 2, None, 1)], rows.ISPyBSession, strings)
+    actions = list(reconcile(uas_rs, ispyb_rs, _SESSION_KEYS, changed=_session_changed, deleted=_session_deleted))
+    assert [(action, ispyb_row.session_id) for (action, uas_row, ispyb_row) in actions] == [(UNCHANGED, 1), (DELETE, 2)]
+
+def test_person_records():
+    uas_row = rows.UASPerson(GUID_A, 'abc12345', 'Dr', 'Ann', 'Smith')
+    assert not _person_changed(uas_row, rows.ISPyBPerson(GUID_A, 'abc12345', 'Dr', 'Ann', 'Smith', 1))
+    assert _person_changed(uas_row, rows.ISPyBPerson(GUID_A, 'abc12345', 'Dr', 'Anne', 'Smith', 1))
+    assert _person_fingerprint(uas_row) == fingerprint((GUID_A, 'abc12345', 'Dr', 'Ann', 'Smith'))
+
+def test_id_map():
+    ids = rows.IdMap([(GUID_B, 2), (GUID_A, '1'), ('not hex', 3), (('cm', '12345'), 4)])
+    assert len(ids) == 4
+    assert ids.get(GUID_A) == 1
+    assert ids.get(GUID_B.lower()) == 2
+    assert ids.get('not hex') == 3
+    assert ids.get(('cm', '12345')) == 4
+    assert ids.get('C' * 32) is None
+    assert ids.get('C' * 32, -1) == -1
+    ids[GUID_A] = 5
+    ids['c' * 32] = 6
+    assert ids.get(GUID_A) == 5
+    assert ids.get('C' * 32) == 6
+    assert len(ids) == 5
@@ -0,0 +1,40 @@
+import logging
+
+import context
+from datasync.sampledlog import SampledLog
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def _logger(level):
+    logger = logging.getLogger('test_sampledlog.%d' % level)
+    logger.propagate = False
+    logger.setLevel(level)
+    logger.handlers = [ListHandler()]
+    return logger
+
+def test_sampled_log_keeps_first_and_every_nth():
+    logger = _logger(logging.DEBUG)
+    log = SampledLog(logger, first=3, every=10)
+    for i in range(25):
+        log.debug("Not found: %s", i)
+    log.summary()
+    messages = logger.handlers[0].messages
+    assert messages[:3] == ['Not found: 0 (1 so far)', 'Not found: 1 (2 so far)', 'Not found: 2 (3 so far)']
+    assert messages[3:5] == ['Not found: 9 (10 so far)', 'Not found: 19 (20 so far)']
+    assert messages[5] == '25 messages like: Not found: %s'
+
+class Unformattable:
+    def __str__(self):
+        raise AssertionError('formatted a disabled message')
+
+def test_sampled_log_does_not_format_disabled_messages():
+    logger = _logger(logging.INFO)
+    log = SampledLog(logger)
+    log.debug("row %s", Unformattable())
+    assert logger.handlers[0].messages == []
@@ -0,0 +1,40 @@
+import threading
+
+import pytest
+
+import context
+from datasync.main import SYNC_STAGES
+from datasync.scheduler import StageScheduler
+
+class Worker:
+    def __init__(self, log, fail=()):
+        self.log = log
+        self.fail = fail
+
+    def run_stage(self, name):
+        if name in self.fail:
+            raise Exception('failing %s' % name)
+        self.log.append(name)
+
+    def close(self):
+        pass
+
+def test_stages_run_after_their_dependencies():
+    log = []
+    failed = StageScheduler(SYNC_STAGES, lambda: Worker(log), workers=3).run()
+    assert failed == []
+    assert sorted(log) == sorted(name for (name, _) in SYNC_STAGES)
+    for (name, deps) in SYNC_STAGES:
+        for dep in deps:
+            assert log.index(dep) < log.index(name)
+
+def test_dependents_of_failed_stage_are_skipped():
+    log = []
+    failed = StageScheduler(SYNC_STAGES, lambda: Worker(log, fail=('sessions',)), workers=2).run()
+    assert sorted(failed) == ['session_types', 'sessions', 'sessions_have_persons']
+    assert 'proposals_have_persons' in log
+
+def test_dependency_cycle_is_rejected():
+    stages = [('proposals', []), ('sessions', ['session_types']), ('session_types', ['sessions'])]
+    with pytest.raises(ValueError):
+        StageScheduler(stages, lambda: Worker([]), workers=2).run()
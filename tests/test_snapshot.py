@@ -0,0 +1,40 @@
+import datetime
+
+import pytest
+
+import context
+msgpack = pytest.importorskip('msgpack')
+from datasync import snapshot
+
+class Source:
+    def retrieve_watermark(self):
+        return 1234
+
+    def extract_proposals(self):
+        return [('cm12345', '99017EB35BD34E55E04017AC41627BFF', u'Commissioning é', 'Open')]
+
+    def extract_sessions(self):
+        return [('99017EB35BD34E55E04017AC41627AFE', 'cm12345-6', 'i03', None,
+                 datetime.datetime(2018, 1, 15, 9, 0, 0), datetime.datetime(2018, 1, 16, 8, 59, 59, 500), 'Queued', 'Dr Garcia')]
+
+def test_snapshot_round_trip(tmpdir):
+    directory = str(tmpdir.join('snap'))
+    source = Source()
+    counts = snapshot.take_snapshot(source, directory, entities=['proposals', 'sessions'])
+    assert counts == {'proposals': 1, 'sessions': 1}
+
+    manifest = snapshot.read_manifest(directory)
+    assert manifest['watermark'] == 1234
+    assert manifest['entities']['sessions']['rows'] == 1
+    assert list(snapshot.iterate_rows(directory, 'proposals')) == source.extract_proposals()
+    assert list(snapshot.iterate_rows(directory, 'sessions')) == source.extract_sessions()
+
+def test_entities_are_added_to_the_manifest(tmpdir):
+    directory = str(tmpdir)
+    snapshot.SnapshotWriter(directory).write('persons', [('E70E', 'abc12345', 'Mr', 'A', 'B')])
+    snapshot.SnapshotWriter(directory).write('components', [])
+    manifest = snapshot.read_manifest(directory)
+    assert sorted(manifest['entities']) == ['components', 'persons']
+    assert list(snapshot.iterate_rows(directory, 'components')) == []
+    with pytest.raises(KeyError):
+        list(snapshot.iterate_rows(directory, 'sessions'))
@@ -31,3 +31,37 @@ def test_sync_sessions_have_persons(testconfig):
 def test_sync_components(testconfig):
     with datasync.open(conf_file = testconfig, source='dummyuas', target='ispyb') as ds:
         ds.sync_components()
+
+def test_sync_all(testconfig):
+    with datasync.open(conf_file = testconfig, source='dummyuas', target='ispyb') as ds:
+        ds.sync_all()
+
+def test_sync_all_synthetic(testconfig):
+    # a small synthetic data set, then the next generation of it
+    from datasync.connector.synthuas import SynthUASConnector
+    with datasync.open(conf_file = testconfig, source='dummyuas', target='ispyb') as ds:
+        ds.set_source(SynthUASConnector(persons=200, proposals=50, sessions=500, change_fraction=0.1))
+        ds.sync_all(workers=1)
+        ds.source_conn.advance()
+        ds.sync_all(workers=1)
+
+def test_sync_all_staged(testconfig):
+    with datasync.open(conf_file = testconfig, source='dummyuas', target='ispyb') as ds:
+        ds.set_target_mode('staged')
+        ds.sync_all(workers=1)
+
+def test_sync_all_pipelined(testconfig):
+    with datasync.open(conf_file = testconfig, source='dummyuas', target='ispyb') as ds:
+        ds.engine = 'pipelined'
+        ds.sync_all(workers=2)
+
+def test_sync_sessions_staged_adds_persons(testconfig):
+    with datasync.open(conf_file = testconfig, source='dummyuas', target='ispyb') as ds:
+        ds.set_target_mode('staged')
+        ds.sync_proposals()
+        ds.sync_sessions()
+        # the persons of new sessions are added as in row mode, Person rows included
+        session_id = ds.target_conn.retrieve_session_id('99017EB35BD34E55E04017AC41627AFF')
+        assert session_id is not None
+        rs = ds.target_conn.do_query('SELECT count(*) FROM Session_has_Person WHERE sessionId = %s', [session_id])
+        assert rs[0][0] >= 3
@@ -0,0 +1,15 @@
+import context
+from datasync.watermark import WatermarkStore
+
+def test_watermarks(tmpdir):
+    path = str(tmpdir.join('marks.json'))
+    store = WatermarkStore(path)
+    assert store.since('persons') is None # no mark yet: full sync
+    store.update('persons', 1234, True)
+
+    store = WatermarkStore(path)
+    assert store.since('persons') == 1234
+    assert store.since('sessions') is None
+
+    assert WatermarkStore(path, full=True).since('persons') is None
+    assert WatermarkStore(path, full_interval=-1).since('persons') is None